@@ -0,0 +1,354 @@
+# bench_shelf.py - Offline end-to-end benchmark for /get_books
+#
+# Serves synthetic Goodreads shelf pages and cover JPEGs from a local stand-in server
+# (with optional per-request latency), loads each shelf through the Flask app's
+# /get_books + /stream/<job_id> API, and prints one JSON record per shelf size:
+#
+#     python benchmarks/bench_shelf.py --sizes 50 1000 --latency-ms 40 --output bench.jsonl
+#
+# Fixture pages are generated once into benchmarks/fixtures/ and reused, so runs on the
+# same tree are comparable. Caches are disabled unless --warm is given, in which case
+# every shelf is loaded twice against fresh cache files and both runs are reported.
+#
+# Every run happens in a fresh child process; this process only serves fixtures and samples
+# the resident memory of the child and its analysis workers while the run is in progress.
+
+# --- Imports ---
+import argparse
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# --- psutil Import ---
+try:
+    import psutil
+except ImportError:
+    psutil = None # process memory is read from /proc instead (Linux only)
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+FIXTURE_DIR = os.path.join(BENCH_DIR, "fixtures")
+ROWS_PER_PAGE = 30
+COVER_VARIANTS = 64 # distinct cover images; URLs stay unique per book
+RATINGS = ["did not like it", "it was ok", "liked it", "really liked it", "it was amazing"]
+
+# --- Fixtures ---
+def shelf_page_html(size, page):
+    start = (page - 1) * ROWS_PER_PAGE
+    rows = []
+    for i in range(start, min(size, start + ROWS_PER_PAGE)):
+        rnd = random.Random(i)
+        review = f"Notes on book {i}. " * rnd.randrange(0, 12)
+        rows.append(f'''<tr id="review_{100000 + i}" class="bookalike review">
+  <td class="field checkbox"><div class="value"><input type="checkbox" name="reviews[{100000 + i}]"></div></td>
+  <td class="field position"><div class="value">{i + 1}</div></td>
+  <td class="field cover"><div class="value"><a href="/book/show/{i}"><img alt="Book {i}" src="{{HOST}}/covers/{size}/{i}._SY75_.jpg"></a></div></td>
+  <td class="field title"><label>title</label><div class="value"><a title="Book {i}" href="/book/show/{i}">Synthetic Book {i}: A Novel</a></div></td>
+  <td class="field author"><label>author</label><div class="value"><a href="/author/show/{i % 97}">Author{i % 97}, Pat</a></div></td>
+  <td class="field publisher"><label>publisher</label><div class="value">Press {i % 13}</div></td>
+  <td class="field num_pages"><label>num pages</label><div class="value"><nobr>{80 + rnd.randrange(900)}<span class="greyText">pp</span></nobr></div></td>
+  <td class="field rating"><label>rating</label><div class="value"><div class="stars"><span class=" staticStars notranslate" title="{RATINGS[i % 5]}"><span size="15x15" class="staticStar p10">{RATINGS[i % 5]}</span></span></div></div></td>
+  <td class="field review"><label>review</label><div class="value"><span id="freeTextContainer{i}">{review}</span></div></td>
+  <td class="field date_read"><label>date read</label><div class="value"><span class="date_read_value">Jan 01, 2020</span></div></td>
+</tr>''')
+    chrome = "<div class='siteHeader'>" + "<a href='#'>nav</a>" * 200 + "</div>"
+    return f'''<!DOCTYPE html><html><head><meta charset="utf-8"><title>Shelf</title>{"<script>var x = 1;</script>" * 20}</head>
+<body>{chrome}<div id="shelfHeader"><h1>Synthetic shelf</h1><span class="greyText">(showing {start + 1}-{min(size, start + ROWS_PER_PAGE)} of {size:,} books)</span></div>
+<a class="selectedShelf" href="#">read ({size})</a>
+<table id="books"><tbody id="booksBody">{"".join(rows)}</tbody></table>{chrome}</body></html>'''
+
+def ensure_fixtures(size):
+    shelf_dir = os.path.join(FIXTURE_DIR, f"shelf-{size}")
+    pages = max(1, -(-size // ROWS_PER_PAGE))
+    if not os.path.exists(os.path.join(shelf_dir, f"page-{pages}.html")):
+        os.makedirs(shelf_dir, exist_ok=True)
+        for page in range(1, pages + 1):
+            with open(os.path.join(shelf_dir, f"page-{page}.html"), "w", encoding="utf-8") as f:
+                f.write(shelf_page_html(size, page))
+    cover_dir = os.path.join(FIXTURE_DIR, "covers")
+    if not os.path.exists(os.path.join(cover_dir, f"{COVER_VARIANTS - 1}.jpg")):
+        from PIL import Image, ImageDraw
+        os.makedirs(cover_dir, exist_ok=True)
+        for n in range(COVER_VARIANTS):
+            rnd = random.Random(n)
+            img = Image.new("RGB", (600, 900), tuple(rnd.randrange(256) for _ in range(3)))
+            draw = ImageDraw.Draw(img)
+            for _ in range(12):
+                x0, y0 = rnd.randrange(600), rnd.randrange(900)
+                draw.rectangle([x0, y0, x0 + rnd.randrange(300), y0 + rnd.randrange(400)], fill=tuple(rnd.randrange(256) for _ in range(3)))
+            img.save(os.path.join(cover_dir, f"{n}.jpg"), "JPEG", quality=85)
+    return shelf_dir, pages
+
+# --- Stand-in Goodreads / CDN Server ---
+class StandInServer:
+    def __init__(self, latency_s):
+        self.latency_s = latency_s
+        self.shelves = {}
+        self.covers = {}
+        self.counts = {"pages": 0, "covers": 0, "bytes": 0}
+        self._lock = threading.Lock()
+        cover_dir = os.path.join(FIXTURE_DIR, "covers")
+        for n in range(COVER_VARIANTS):
+            with open(os.path.join(cover_dir, f"{n}.jpg"), "rb") as f:
+                self.covers[n] = f.read()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            def log_message(self, *args): pass
+            def do_GET(self):
+                if server.latency_s: time.sleep(server.latency_s)
+                body, content_type = server.respond(self.path)
+                if body is None:
+                    self.send_response(404); self.send_header("Content-Length", "0"); self.end_headers(); return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def add_shelf(self, size):
+        shelf_dir, pages = ensure_fixtures(size)
+        self.shelves[str(size)] = (shelf_dir, pages)
+        return f"{self.base_url}/review/list/{size}?shelf=read&sort=date_updated"
+
+    def respond(self, path):
+        cover = re.match(r'^/covers/\d+/(\d+)\.jpg$', path)
+        if cover:
+            body, content_type, counter = self.covers[int(cover.group(1)) % COVER_VARIANTS], "image/jpeg", "covers"
+        else:
+            shelf = re.match(r'^/review/list/(\d+)\?.*page=(\d+)', path)
+            if not shelf or shelf.group(1) not in self.shelves:
+                return None, None
+            shelf_dir, pages = self.shelves[shelf.group(1)]
+            page = int(shelf.group(2))
+            if page > pages:
+                html = shelf_page_html(0, page)
+            else:
+                with open(os.path.join(shelf_dir, f"page-{page}.html"), encoding="utf-8") as f:
+                    html = f.read()
+            body, content_type, counter = html.replace("{HOST}", self.base_url).encode("utf-8"), "text/html; charset=utf-8", "pages"
+        with self._lock:
+            self.counts[counter] += 1
+            self.counts["bytes"] += len(body)
+        return body, content_type
+
+    def reset_counts(self):
+        with self._lock:
+            self.counts = {"pages": 0, "covers": 0, "bytes": 0}
+
+# --- Harness ---
+RSS_SAMPLE_INTERVAL_S = 0.05
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def proc_rss_bytes(pid):
+    try:
+        with open(f"/proc/{pid}/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+def proc_descendants(pid):
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat", encoding="ascii", errors="replace") as f:
+                    parents.setdefault(int(f.read().rsplit(")", 1)[1].split()[1]), []).append(int(entry))
+            except (OSError, IndexError, ValueError):
+                continue
+    found, stack = [], list(parents.get(pid, ()))
+    while stack:
+        child = stack.pop()
+        found.append(child)
+        stack.extend(parents.get(child, ()))
+    return found
+
+# (app process RSS, summed RSS of all its descendants) in bytes. With the default forkserver
+# start method the analysis workers are grandchildren, hence the full descendant walk.
+def tree_rss_bytes(pid):
+    if psutil is not None:
+        try:
+            proc = psutil.Process(pid)
+            own = proc.memory_info().rss
+        except psutil.Error:
+            return 0, 0
+        workers = 0
+        for child in proc.children(recursive=True):
+            try: workers += child.memory_info().rss
+            except psutil.Error: pass
+        return own, workers
+    if not os.path.exists("/proc/self/status"):
+        return 0, 0
+    return proc_rss_bytes(pid), sum(proc_rss_bytes(child) for child in proc_descendants(pid))
+
+def load_shelf(client, shelf_url):
+    start = time.perf_counter()
+    submit = client.get("/get_books", query_string={"url": shelf_url})
+    job_id = submit.get_json()["job_id"]
+    arrivals, summary = [], None
+    response = client.get(f"/stream/{job_id}", buffered=False)
+    buffered = ""
+    for chunk in response.response:
+        buffered += chunk.decode("utf-8") if isinstance(chunk, bytes) else chunk
+        *lines, buffered = buffered.split("\n")
+        for line in lines:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record["type"] == "book":
+                arrivals.append(time.perf_counter() - start)
+            else:
+                summary = record
+    return time.perf_counter() - start, arrivals, summary
+
+# Per-book latency: from the book's cover download starting (or, when its colors come from the
+# cache, from the book entering the cover pipeline) until its colors are known. Measured before
+# the shelf-order buffering, which the arrival percentiles include.
+def instrument_cover_pipeline(bookshelf_app):
+    entered, download_started, latencies = {}, {}, []
+    fetch_cover_bytes, iter_analyzed_covers = bookshelf_app.fetch_cover_bytes, bookshelf_app.iter_analyzed_covers
+
+    def timed_fetch(image_url):
+        download_started.setdefault(image_url, time.perf_counter())
+        return fetch_cover_bytes(image_url)
+
+    def timed_pipeline(books, timings=None):
+        def entering():
+            for book in books:
+                entered[id(book)] = time.perf_counter()
+                yield book
+        for book in iter_analyzed_covers(entering(), timings):
+            start = download_started.get(book.get("image")) or entered.get(id(book))
+            if start is not None:
+                latencies.append(time.perf_counter() - start)
+            yield book
+
+    bookshelf_app.fetch_cover_bytes, bookshelf_app.iter_analyzed_covers = timed_fetch, timed_pipeline
+    return latencies
+
+# Child side: import the app (settings come from the environment) and load one shelf.
+def run_child(shelf_url, record_path):
+    sys.path.insert(0, REPO_DIR)
+    import bookshelf_app
+    latencies = instrument_cover_pipeline(bookshelf_app)
+    wall, arrivals, summary = load_shelf(bookshelf_app.app.test_client(), shelf_url)
+    with open(record_path, "w", encoding="utf-8") as f:
+        json.dump({"wall": wall, "arrivals": arrivals, "latencies": latencies, "summary": summary}, f)
+
+# Parent side: run one load in a fresh process while sampling its memory.
+def run_once(server, size, shelf_url, label, env):
+    server.reset_counts()
+    fd, record_path = tempfile.mkstemp(prefix="bookshelf-bench-", suffix=".json")
+    os.close(fd)
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--child", shelf_url, record_path],
+                             env=env, stdout=subprocess.DEVNULL)
+    peak_app = peak_workers = peak_total = 0
+    while child.poll() is None:
+        own, workers = tree_rss_bytes(child.pid)
+        peak_app, peak_workers, peak_total = max(peak_app, own), max(peak_workers, workers), max(peak_total, own + workers)
+        time.sleep(RSS_SAMPLE_INTERVAL_S)
+    counts = dict(server.counts)
+    try:
+        with open(record_path, encoding="utf-8") as f:
+            result = json.load(f)
+    except (OSError, ValueError):
+        result = {"wall": None, "arrivals": [], "latencies": [], "summary": {"error": f"benchmark child exited with {child.returncode}"}}
+    finally:
+        os.remove(record_path)
+    wall, arrivals, latencies, summary = result["wall"], result["arrivals"], result["latencies"], result["summary"]
+    mb = lambda n: round(n / (1024 * 1024), 1) if n else None
+    return {
+        "run": label,
+        "shelf_size": size,
+        "books_returned": len(arrivals),
+        "error": (summary or {}).get("error"),
+        "wall_s": round(wall, 3) if wall else None,
+        "time_to_first_book_s": round(arrivals[0], 3) if arrivals else None,
+        "pages_fetched": counts["pages"],
+        "covers_fetched": counts["covers"],
+        "bytes_served": counts["bytes"],
+        "pages_per_s": round(counts["pages"] / wall, 2) if wall else None,
+        "covers_per_s": round(counts["covers"] / wall, 2) if wall else None,
+        "books_per_s": round(len(arrivals) / wall, 2) if wall else None,
+        # Per-book latency (see instrument_cover_pipeline); None when every book came from the shelf cache.
+        "book_latency_p50_s": round(percentile(latencies, 50), 3) if latencies else None,
+        "book_latency_p99_s": round(percentile(latencies, 99), 3) if latencies else None,
+        # When the p-th percentile book reached the client, measured from submit.
+        "arrival_p50_s": round(percentile(arrivals, 50), 3) if arrivals else None,
+        "arrival_p99_s": round(percentile(arrivals, 99), 3) if arrivals else None,
+        # Sampled every RSS_SAMPLE_INTERVAL_S during the run; None where memory can't be read.
+        "peak_rss_app_mb": mb(peak_app),
+        "peak_rss_workers_mb": mb(peak_workers),
+        "peak_rss_total_mb": mb(peak_total),
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == "--child":
+        run_child(sys.argv[2], sys.argv[3])
+        return
+    parser = argparse.ArgumentParser(description="Offline /get_books benchmark against a local Goodreads stand-in.")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[50, 1000, 10000], help="shelf sizes to load (default: 50 1000 10000)")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="delay added to every stand-in response")
+    parser.add_argument("--warm", action="store_true", help="enable fresh caches and load each shelf twice (cold, then warm)")
+    parser.add_argument("--env", nargs="*", default=[], metavar="KEY=VALUE", help="extra app settings, e.g. SHELF_HOST_MIN_INTERVAL=0")
+    parser.add_argument("--output", help="append JSON records to this file as well as printing them")
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        ensure_fixtures(size)
+    server = StandInServer(args.latency_ms / 1000.0)
+    revision = git_revision()
+    out = open(args.output, "a", encoding="utf-8") if args.output else None
+    try:
+        for size in args.sizes:
+            shelf_url = server.add_shelf(size)
+            # Settings are read at import time, so each child gets them through its environment.
+            cache_dir = tempfile.mkdtemp(prefix="bookshelf-bench-")
+            env = dict(os.environ)
+            env["COVER_CACHE_PATH"] = os.path.join(cache_dir, "covers.sqlite3") if args.warm else ""
+            env["SHELF_CACHE_PATH"] = os.path.join(cache_dir, "shelves.sqlite3") if args.warm else ""
+            env["THUMB_CACHE_DIR"] = os.path.join(cache_dir, "thumbs") # never the repo's cache/
+            env.setdefault("SHELF_CACHE_FRESH_SECONDS", "0")
+            for item in args.env:
+                key, _, value = item.partition("=")
+                env[key] = value
+            for label in (["cold", "warm"] if args.warm else ["cold"]):
+                record = run_once(server, size, shelf_url, label, env)
+                record.update({"revision": revision, "latency_ms": args.latency_ms, "timestamp": time.time(),
+                               "settings": {k: env.get(k) for k in ("COVER_FETCH_WORKERS", "COVER_ANALYSIS_PROCESSES", "SHELF_PAGE_WORKERS", "SHELF_HOST_MIN_INTERVAL", "COVER_ANALYSIS_MAX_SIDE") if env.get(k) is not None}})
+                line = json.dumps(record, sort_keys=True)
+                print(line, flush=True)
+                if out: out.write(line + "\n"); out.flush()
+    finally:
+        if out: out.close()
+        server.httpd.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,56 @@
 # app.py - FINAL: Fixed Invalid Regex Error
 # --- Imports ---
-from flask import Flask, request, render_template_string, jsonify
+from flask import Flask, Response, request, jsonify
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup, SoupStrainer
 import os
 import threading
+import multiprocessing
 import re
-from urllib.parse import quote_plus
+from urllib.parse import quote_plus, urlparse, urlsplit, urlunsplit, parse_qs
 import io
+import gzip
+import zlib
 import traceback
 import math
+import time
+import json
+import csv
+import sqlite3
+import uuid
+import hashlib
+import random
+import queue
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 # --- Pillow Check ---
 try:
-    from PIL import Image, ImageStat
+    from PIL import Image, ImageStat, ImageDraw, ImageFont, ImageFilter, features as pil_features
     print("Pillow loaded.")
 except ImportError:
     print("WARNING: Pillow not found...")
-    Image = None; ImageStat = None
+    Image = None; ImageStat = None; ImageDraw = None; ImageFont = None; ImageFilter = None; pil_features = None
+
+# --- lxml Check ---
+try:
+    import lxml.html as lxml_html
+    from lxml import etree as lxml_etree
+    print("lxml loaded.")
+except ImportError:
+    print("WARNING: lxml not found. Shelf pages use html.parser. pip install lxml")
+    lxml_html = None; lxml_etree = None
+
+# --- NumPy Import ---
+try:
+    import numpy as np
+    print("NumPy loaded.")
+except ImportError:
+    print("WARNING: NumPy not found. Palettes fall back to colorgram.py. pip install numpy")
+    np = None
 
 # --- Colorgram Import ---
 try:
@@ -27,21 +60,731 @@ except ImportError:
      print("WARNING: colorgram.py not found. pip install colorgram.py")
      colorgram = None
 
-# --- Global Data ---
-progress_data = { "total_books": 0, "books_processed": 0, "complete": False, "error": None }
+# --- Brotli Import ---
+try:
+    import brotli
+    print("brotli loaded.")
+except ImportError:
+    print("WARNING: brotli not found. Responses are gzip-compressed only. pip install brotli")
+    brotli = None
+
+# --- Metrics ---
+# Per-stage timing histograms and counters (cache hits, retries, bytes downloaded) kept in
+# process and exposed in Prometheus text format at /metrics. Each job also keeps its own
+# per-stage totals, returned by /progress/<job_id>?timings=1.
+METRIC_STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 120.0)
+METRIC_HELP = {
+    "bookshelf_stage_seconds": "Time spent in each shelf pipeline stage.",
+    "bookshelf_http_requests_total": "Outbound HTTP responses by status code.",
+    "bookshelf_http_retries_total": "Outbound HTTP retries (connection errors and retryable statuses).",
+    "bookshelf_http_downloaded_bytes_total": "Response body bytes downloaded (304 revalidations excluded).",
+    "bookshelf_cover_cache_requests_total": "Cover color cache lookups by result.",
+    "bookshelf_shelf_cache_requests_total": "Shelf result cache lookups by result.",
+    "bookshelf_cover_lookups_total": "Cover URL lookups for CSV-imported books by result.",
+    "bookshelf_jobs_total": "Finished shelf jobs by outcome.",
+}
+
+class StageTimings:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def add(self, stage, seconds):
+        with self._lock:
+            entry = self._stages.setdefault(stage, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {stage: {"count": count, "total_s": round(total, 4), "max_s": round(longest, 4)} for stage, (count, total, longest) in self._stages.items()}
+
+class MetricsRegistry:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound: histogram["buckets"][i] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    def count(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    # Prometheus text exposition format; gauges are (name, help, value) read at scrape time.
+    def render(self, gauges=()):
+        def label_text(labels):
+            if not labels: return ""
+            return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels) + "}"
+        lines = []
+        with self._lock:
+            histograms = {stage: dict(h, buckets=list(h["buckets"])) for stage, h in self._histograms.items()}
+            counters = dict(self._counters)
+        lines += ["# HELP bookshelf_stage_seconds " + METRIC_HELP["bookshelf_stage_seconds"], "# TYPE bookshelf_stage_seconds histogram"]
+        for stage in sorted(histograms):
+            histogram = histograms[stage]
+            for bound, value in zip(self.buckets, histogram["buckets"]):
+                lines.append(f"bookshelf_stage_seconds_bucket{label_text([('stage', stage), ('le', repr(bound))])} {value}")
+            lines.append(f"bookshelf_stage_seconds_bucket{label_text([('stage', stage), ('le', '+Inf')])} {histogram['count']}")
+            lines.append(f"bookshelf_stage_seconds_sum{label_text([('stage', stage)])} {histogram['sum']:.6f}")
+            lines.append(f"bookshelf_stage_seconds_count{label_text([('stage', stage)])} {histogram['count']}")
+        for name in sorted({name for name, _ in counters} | {n for n in METRIC_HELP if n.endswith("_total")}):
+            lines += [f"# HELP {name} {METRIC_HELP.get(name, name)}", f"# TYPE {name} counter"]
+            for (counter, labels), value in sorted(counters.items()):
+                if counter == name: lines.append(f"{name}{label_text(labels)} {value}")
+        for name, help_text, value in gauges:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry(METRIC_STAGE_BUCKETS)
+
+def record_stage(stage, seconds, timings=None):
+    metrics.observe(stage, seconds)
+    if timings is not None: timings.add(stage, seconds)
+
+@contextmanager
+def timed(stage, timings=None):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start, timings)
+
+# --- Job Progress ---
+# Every shelf load runs as a background job with its own id and lock-protected progress
+# record, so concurrent users don't overwrite each other. At most JOB_WORKERS scrapes run at
+# once and JOB_QUEUE_LIMIT may be queued or running; identical shelf URLs share one in-flight
+# job. Finished jobs (and their results) are dropped after JOB_TTL_SECONDS. A running job that
+# nobody is streaming and nobody has asked about for JOB_ABANDON_SECONDS is cancelled, which
+# stops its pending page and cover downloads (0 = never cancel).
+JOB_TTL_SECONDS = max(1.0, float(os.environ.get("JOB_TTL_SECONDS", 600)))
+JOB_ABANDON_SECONDS = max(0.0, float(os.environ.get("JOB_ABANDON_SECONDS", 30)))
+JOB_WORKERS = max(1, int(os.environ.get("JOB_WORKERS", 4)))
+JOB_QUEUE_LIMIT = max(1, int(os.environ.get("JOB_QUEUE_LIMIT", 32)))
+
+class JobProgress:
+    def __init__(self, shelf_url=None):
+        self._lock = threading.Lock()
+        self._data = {"total_books": 0, "books_parsed": 0, "books_processed": 0, "complete": False, "error": None}
+        self._books_added = threading.Condition(self._lock)
+        self.shelf_url = shelf_url
+        self.finished_at = None
+        self.books = []
+        self.done = threading.Event()
+        self.timings = StageTimings()
+        self.watchers = 0
+        self.last_seen = time.monotonic()
+
+    def __getitem__(self, key):
+        with self._lock:
+            return self._data[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            if key == "complete" and value and self.finished_at is None:
+                self.finished_at = time.time()
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._data.get(key, default)
+
+    def increment(self, key, amount=1):
+        with self._lock:
+            self._data[key] += amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._data)
+
+    # Clients mark the job as wanted: every lookup touches it, open streams watch it.
+    def touch(self):
+        with self._lock:
+            self.last_seen = time.monotonic()
+
+    def watch(self, delta=1):
+        with self._lock:
+            self.watchers += delta
+            self.last_seen = time.monotonic()
+
+    def abandoned(self, grace_seconds):
+        with self._lock:
+            return grace_seconds > 0 and self.watchers == 0 and time.monotonic() - self.last_seen > grace_seconds
+
+    def add_book(self, book):
+        with self._books_added:
+            self.books.append(book)
+            self._books_added.notify_all()
+
+    def finish(self):
+        with self._books_added:
+            self.done.set()
+            self._books_added.notify_all()
+
+    # Blocks until there are books past `start` or the job is done; returns (new books, done).
+    def wait_for_books(self, start, timeout=None):
+        with self._books_added:
+            self._books_added.wait_for(lambda: len(self.books) > start or self.done.is_set(), timeout)
+            return self.books[start:], self.done.is_set()
+
+class JobRegistry:
+    def __init__(self, ttl_seconds, workers, queue_limit):
+        self.ttl_seconds = ttl_seconds
+        self.queue_limit = queue_limit
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._active_by_url = {}
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="shelf-job")
+
+    # Returns (job_id, progress, deduplicated); job_id is None when the queue is full.
+    # iter_books(shelf_url, progress) produces the books; shelf_url is just the dedup key for other sources.
+    def submit(self, shelf_url, iter_books=None):
+        with self._lock:
+            self._expire_locked()
+            job_id = self._active_by_url.get(shelf_url)
+            if job_id:
+                self._jobs[job_id].touch()
+                return job_id, self._jobs[job_id], True
+            if len(self._active_by_url) >= self.queue_limit:
+                return None, None, False
+            job_id = uuid.uuid4().hex
+            progress = JobProgress(shelf_url)
+            self._jobs[job_id] = progress
+            self._active_by_url[shelf_url] = job_id
+        self._executor.submit(self._run, shelf_url, progress, iter_books or iter_books_from_shelf)
+        return job_id, progress, False
+
+    def get(self, job_id):
+        with self._lock:
+            self._expire_locked()
+            progress = self._jobs.get(job_id)
+        if progress is not None:
+            progress.touch()
+        return progress
+
+    def active_count(self):
+        with self._lock:
+            return len(self._active_by_url)
+
+    def _run(self, shelf_url, progress, iter_books):
+        started = time.perf_counter()
+        books = iter_books(shelf_url, progress)
+        cancelled = False
+        try:
+            for book in books:
+                progress.add_book(book)
+                if progress.abandoned(JOB_ABANDON_SECONDS):
+                    print(f"Job for {shelf_url} abandoned by its clients. Cancelling.")
+                    progress["error"] = "Cancelled: no client is waiting for this shelf."
+                    cancelled = True
+                    break
+        except Exception as e:
+            traceback.print_exc()
+            progress["error"] = str(e)
+        finally:
+            books.close() # runs the pipeline's finally blocks, cancelling queued downloads
+            progress["complete"] = True
+            record_stage("job", time.perf_counter() - started, progress.timings)
+            metrics.count("bookshelf_jobs_total", outcome="cancelled" if cancelled else "error" if progress.get("error") and not progress.books else "ok")
+            with self._lock:
+                self._active_by_url.pop(shelf_url, None)
+            progress.finish()
+
+    def _expire_locked(self):
+        cutoff = time.time() - self.ttl_seconds
+        for job_id in [j for j, p in self._jobs.items() if p.finished_at is not None and p.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+jobs = JobRegistry(JOB_TTL_SECONDS, JOB_WORKERS, JOB_QUEUE_LIMIT)
+
+# --- Worker Pool Settings ---
+# Threads download covers; a process pool runs the CPU-bound Pillow/colorgram work.
+# COVER_ANALYSIS_PROCESSES=0 analyzes inline on the download threads instead. The pool is started
+# lazily from a job thread while other threads hold locks and SQLite handles, so workers are never
+# forked from this process: they come from a forkserver (spawn where that isn't available).
+COVER_FETCH_WORKERS = max(1, int(os.environ.get("COVER_FETCH_WORKERS", 16)))
+COVER_ANALYSIS_PROCESSES = max(0, int(os.environ.get("COVER_ANALYSIS_PROCESSES", os.cpu_count() or 1)))
+COVER_ANALYSIS_START_METHOD = os.environ.get("COVER_ANALYSIS_START_METHOD", "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+# Longest side, in pixels, covers are decoded at for color analysis (0 = full resolution). On the
+# 64 benchmark fixture covers at 256, spine colors match a full decode to within 1 per channel, but
+# 2 near-tie covers pick a different text color (drift 79 and 51), which --check-fidelity reports
+# as BAD. 512 passes all 64 at about 2.7x the load time.
+COVER_ANALYSIS_MAX_SIDE = max(0, int(os.environ.get("COVER_ANALYSIS_MAX_SIDE", 256)))
+_analysis_pool = None
+_analysis_pool_lock = threading.Lock()
+
+# --- Shared HTTP Session ---
+# One keep-alive, connection-pooled session for every outbound fetch. Goodreads pages and the
+# cover CDN get their own pool sizes. Covers are downloaded on up to JOB_WORKERS x COVER_FETCH_WORKERS
+# threads at once, so the cover and default pools are sized for that by default (a smaller pool
+# opens extra connections and throws them away); the cover CDN pools block rather than overflow
+# when set lower. Transient 429/5xx answers are retried with jittered
+# exponential backoff (honoring Retry-After). Responses carrying an ETag or Last-Modified are
+# kept in a byte-bounded LRU and revalidated with If-None-Match / If-Modified-Since.
+HTTP_RETRIES = max(0, int(os.environ.get("HTTP_RETRIES", 3)))
+HTTP_BACKOFF_FACTOR = max(0.0, float(os.environ.get("HTTP_BACKOFF_FACTOR", 0.5)))
+HTTP_BACKOFF_JITTER = max(0.0, float(os.environ.get("HTTP_BACKOFF_JITTER", 0.5)))
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+COVER_FETCH_CONCURRENCY = JOB_WORKERS * COVER_FETCH_WORKERS
+HTTP_COVER_POOL_SIZE = max(1, int(os.environ.get("HTTP_COVER_POOL_SIZE", COVER_FETCH_CONCURRENCY)))
+HTTP_HOST_POOL_SIZES = {
+    "https://www.goodreads.com": max(1, int(os.environ.get("HTTP_GOODREADS_POOL_SIZE", 8))),
+    "https://i.gr-assets.com": HTTP_COVER_POOL_SIZE,
+    "https://images.gr-assets.com": HTTP_COVER_POOL_SIZE,
+}
+HTTP_BLOCKING_POOLS = {"https://i.gr-assets.com", "https://images.gr-assets.com"}
+HTTP_DEFAULT_POOL_SIZE = max(1, int(os.environ.get("HTTP_DEFAULT_POOL_SIZE", max(16, COVER_FETCH_CONCURRENCY)))) # covers on other hosts, Open Library
+HTTP_CONDITIONAL_CACHE_BYTES = max(0, int(os.environ.get("HTTP_CONDITIONAL_CACHE_BYTES", 32 * 1024 * 1024)))
+_http_session = None
+_http_session_lock = threading.Lock()
+_conditional_cache = OrderedDict()
+_conditional_cache_bytes = 0
+_conditional_cache_lock = threading.Lock()
+
+# Retry that counts every retry it performs into the metrics registry. The final increment raises
+# MaxRetryError instead of retrying, so it isn't counted.
+class CountingRetry(Retry):
+    def increment(self, *args, **kwargs):
+        retry = super().increment(*args, **kwargs)
+        metrics.count("bookshelf_http_retries_total")
+        return retry
+
+def make_retry():
+    retry_args = dict(total=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF_FACTOR, status_forcelist=HTTP_RETRY_STATUSES,
+                      allowed_methods=frozenset(["GET", "HEAD"]), respect_retry_after_header=True, raise_on_status=False)
+    try:
+        return CountingRetry(backoff_jitter=HTTP_BACKOFF_JITTER, **retry_args)
+    except TypeError: # urllib3 < 2 has no backoff_jitter
+        return CountingRetry(**retry_args)
+
+def get_http_session():
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            default_adapter = HTTPAdapter(pool_connections=len(HTTP_HOST_POOL_SIZES) + 4, pool_maxsize=HTTP_DEFAULT_POOL_SIZE, max_retries=make_retry())
+            session.mount("https://", default_adapter)
+            session.mount("http://", default_adapter)
+            for prefix, pool_size in HTTP_HOST_POOL_SIZES.items():
+                session.mount(prefix, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=prefix in HTTP_BLOCKING_POOLS, max_retries=make_retry()))
+            _http_session = session
+        return _http_session
+
+def remember_response(url, response):
+    global _conditional_cache_bytes
+    size = len(response.content or b'')
+    if size > HTTP_CONDITIONAL_CACHE_BYTES // 4:
+        return
+    with _conditional_cache_lock:
+        previous = _conditional_cache.pop(url, None)
+        if previous is not None:
+            _conditional_cache_bytes -= len(previous.content or b'')
+        _conditional_cache[url] = response
+        _conditional_cache_bytes += size
+        while _conditional_cache_bytes > HTTP_CONDITIONAL_CACHE_BYTES and _conditional_cache:
+            _, evicted = _conditional_cache.popitem(last=False)
+            _conditional_cache_bytes -= len(evicted.content or b'')
+
+# GET through the shared session. A 304 answer returns the previously stored response.
+def http_get(url, headers=None, timeout=10):
+    request_headers = dict(headers or {})
+    with _conditional_cache_lock:
+        cached = _conditional_cache.get(url)
+        if cached is not None:
+            _conditional_cache.move_to_end(url)
+    if cached is not None:
+        if cached.headers.get("ETag"): request_headers["If-None-Match"] = cached.headers["ETag"]
+        if cached.headers.get("Last-Modified"): request_headers["If-Modified-Since"] = cached.headers["Last-Modified"]
+    response = get_http_session().get(url, headers=request_headers, timeout=timeout)
+    metrics.count("bookshelf_http_requests_total", status=str(response.status_code))
+    if response.status_code == 304 and cached is not None:
+        return cached
+    metrics.count("bookshelf_http_downloaded_bytes_total", len(response.content or b''))
+    if response.ok and HTTP_CONDITIONAL_CACHE_BYTES and (response.headers.get("ETag") or response.headers.get("Last-Modified")):
+        remember_response(url, response)
+    return response
+
+# --- Cover Color Cache ---
+# A Goodreads cover URL always yields the same spine colors, so results are kept in SQLite
+# keyed by the normalized URL. Least-recently-used rows are evicted past COVER_CACHE_MAX_ENTRIES.
+# Each row records the analysis that produced it (see cover_analysis_signature); rows from another
+# version, decode size or palette engine count as misses and are overwritten. Set COVER_CACHE_PATH="" to disable.
+COVER_ANALYSIS_VERSION = 3 # bump when edge/palette/contrast results change
+COVER_CACHE_PATH = os.environ.get("COVER_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "covers.sqlite3"))
+COVER_CACHE_MAX_ENTRIES = max(1, int(os.environ.get("COVER_CACHE_MAX_ENTRIES", 50000)))
+_cover_cache = None
+_cover_cache_lock = threading.Lock()
+
+def cover_analysis_signature():
+    return f"{COVER_ANALYSIS_VERSION}:{COVER_ANALYSIS_MAX_SIDE}:{'numpy' if np is not None else 'colorgram'}"
+
+def normalize_cover_url(image_url):
+    parts = urlsplit(str(image_url or '').strip())
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, ''))
+
+class CoverColorCache:
+    EVICT_EVERY = 64
+
+    def __init__(self, path, max_entries):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS covers (url TEXT PRIMARY KEY, spine_color TEXT, spine_text_color TEXT, palette TEXT, last_used REAL, analysis TEXT)")
+            if "analysis" not in [row[1] for row in self._db.execute("PRAGMA table_info(covers)")]:
+                self._db.execute("ALTER TABLE covers ADD COLUMN analysis TEXT") # older rows stay NULL, i.e. stale
+            self._db.execute("CREATE INDEX IF NOT EXISTS covers_last_used ON covers (last_used)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS cover_keys (key TEXT PRIMARY KEY, url TEXT)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS cover_lookups (source TEXT PRIMARY KEY, url TEXT)")
+
+    def get(self, image_url):
+        key = normalize_cover_url(image_url)
+        with self._lock:
+            row = self._db.execute("SELECT spine_color, spine_text_color, palette FROM covers WHERE url = ? AND analysis = ?", (key, cover_analysis_signature())).fetchone()
+            if row is None:
+                self.misses += 1
+                metrics.count("bookshelf_cover_cache_requests_total", result="miss")
+                return None
+            self.hits += 1
+            metrics.count("bookshelf_cover_cache_requests_total", result="hit")
+            with self._db:
+                self._db.execute("UPDATE covers SET last_used = ? WHERE url = ?", (time.time(), key))
+        palette = json.loads(row[2]) if row[2] else None
+        return {"spine_color": row[0], "spine_text_color": row[1], "palette": [hex_to_rgb(c) for c in palette] if palette is not None else None}
+
+    def put(self, image_url, spine_color, spine_text_color, palette):
+        key = normalize_cover_url(image_url)
+        palette_json = json.dumps(["#{:02x}{:02x}{:02x}".format(*c) for c in palette]) if palette is not None else None
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO covers (url, spine_color, spine_text_color, palette, last_used, analysis) VALUES (?, ?, ?, ?, ?, ?)",
+                             (key, spine_color, spine_text_color, palette_json, time.time(), cover_analysis_signature()))
+            self._puts += 1
+            if self._puts % self.EVICT_EVERY == 0:
+                self._db.execute("DELETE FROM covers WHERE url IN (SELECT url FROM covers ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    # (key, url) pairs for the thumbnail proxy; see register_cover_url.
+    def put_keys(self, pairs):
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR IGNORE INTO cover_keys VALUES (?, ?)", pairs)
+
+    def url_for_key(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT url FROM cover_keys WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    # Cover URLs found for CSV-imported books (see resolve_cover_url); "" records a lookup that found nothing.
+    def put_lookup(self, source, image_url):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO cover_lookups VALUES (?, ?)", (source, image_url or ""))
+
+    def get_lookup(self, source):
+        with self._lock:
+            row = self._db.execute("SELECT url FROM cover_lookups WHERE source = ?", (source,)).fetchone()
+        return row[0] if row else None
+
+    def stats(self):
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM covers").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "max_entries": self.max_entries}
+
+def get_cover_cache():
+    global _cover_cache
+    if not COVER_CACHE_PATH:
+        return None
+    with _cover_cache_lock:
+        if _cover_cache is None:
+            try:
+                _cover_cache = CoverColorCache(COVER_CACHE_PATH, COVER_CACHE_MAX_ENTRIES)
+            except Exception as e:
+                print(f"Warn: Cover cache unavailable ({e}). Continuing without it.")
+                return None
+        return _cover_cache
+
+# --- Helper Function: fetch_cover_bytes / fetch_cover_image ---
+def fetch_cover_bytes(image_url):
+    if not image_url:
+        return None
+    try:
+        response = http_get(image_url, timeout=10)
+        response.raise_for_status()
+        if not response.content: raise ValueError("Empty image content")
+        return response.content
+    except Exception as e:
+        print(f"Warn: Img process fail (request) {image_url.split('/')[-1]} {e}")
+        return None
+
+# max_side > 0 decodes a reduced image for color analysis: JPEGs are DCT-scaled by draft()
+# while decoding, then reduce() box-averages the rest of the way, which keeps strip means intact.
+def open_cover_image(content, max_side=0):
+    if not Image or not content:
+        return None
+    try:
+        img = Image.open(io.BytesIO(content))
+        if max_side > 0:
+            img.draft('RGB', (max_side, max_side))
+        img.load()
+        if max_side > 0 and max(img.size) > max_side:
+            if img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB') # reduce() rejects P, 1 and I;16; the analysis converts to RGB anyway
+            img = img.reduce(math.ceil(max(img.size) / max_side))
+        return img
+    except Exception as e:
+        print(f"Warn: Img process fail (open) {e}")
+        return None
+
+def fetch_cover_image(image_url):
+    if not Image:
+        return None
+    return open_cover_image(fetch_cover_bytes(image_url))
+
+# --- Book Geometry ---
+# Book size and spine/back texture constants, defined once here. The page reads them from
+# window.BOOKSHELF_BOOK (BOOK_CONFIG injected into THREE_TEMPLATE) and the static export and the
+# cover thumbnails use them directly, so the live view and the exported images can't drift apart.
+BOOK_HEIGHT, BOOK_WIDTH, BOOK_THICKNESS = 9.0, 6.075, 1.125
+MIN_THICKNESS, MAX_THICKNESS, AVG_PAGE_COUNT = 0.2, 4.0, 350
+SPINE_TEXTURE_HEIGHT, SPINE_TITLE_SIZE_PX, SPINE_AUTHOR_SIZE_PX, SPINE_PUBLISHER_SIZE_PX = 450, 14, 9, 6
+SPINE_PADDING_PX, SPINE_AUTHOR_PADDING_PX, SPINE_EDGE_WIDTH = 15, 5, 8
+SPINE_TEXT_OPACITY, SPINE_HIGHLIGHT_OPACITY, SPINE_SHADOW_OPACITY = 0.75, 0.4, 0.3
+SPINE_TITLE_MAX_LINES, SPINE_AUTHOR_MAX_LINES = 2, 4
+SPINE_LINE_SPACING = 1.1 # line height as a multiple of the font size
+BACK_TEXTURE_WIDTH, BACK_SCRIBBLE_OPACITY, BACK_SCRIBBLE_LINE_HEIGHT = 300, 0.75, 5
+BOOK_CONFIG = {"BOOK_DEFAULTS": {"HEIGHT": BOOK_HEIGHT, "WIDTH": BOOK_WIDTH, "THICKNESS": BOOK_THICKNESS}}
+BOOK_CONFIG.update((name, globals()[name]) for name in ("MIN_THICKNESS", "MAX_THICKNESS", "AVG_PAGE_COUNT", "SPINE_TEXTURE_HEIGHT", "SPINE_TITLE_SIZE_PX", "SPINE_AUTHOR_SIZE_PX", "SPINE_PUBLISHER_SIZE_PX", "SPINE_PADDING_PX", "SPINE_AUTHOR_PADDING_PX", "SPINE_EDGE_WIDTH", "SPINE_TEXT_OPACITY", "SPINE_HIGHLIGHT_OPACITY", "SPINE_SHADOW_OPACITY", "SPINE_TITLE_MAX_LINES", "SPINE_AUTHOR_MAX_LINES", "SPINE_LINE_SPACING", "BACK_TEXTURE_WIDTH", "BACK_SCRIBBLE_OPACITY", "BACK_SCRIBBLE_LINE_HEIGHT"))
+
+# --- Cover Thumbnail Proxy ---
+# /cover/<key> serves covers cropped to the book's front-face aspect and resized to power-of-two
+# textures (WebP when Pillow supports it). The key is a hash of the normalized cover URL, and only
+# URLs seen on a scraped shelf are registered, so the route is not an open proxy. Bytes downloaded
+# for color analysis are kept in memory (the newest COVER_SOURCE_MEMORY_BYTES of them) and handed
+# to a background writer that stores them under THUMB_CACHE_DIR, so the shelf load does no disk
+# I/O itself and a cover evicted from memory is still on disk when the browser asks for it. Only
+# covers this server never downloaded (colors from the cover cache, source since pruned) are
+# fetched upstream. Rendered sizes are cached beside the sources and the oldest files are pruned
+# past THUMB_CACHE_MAX_BYTES. Set THUMB_CACHE_DIR="" to disable the disk cache.
+THUMB_CACHE_DIR = os.environ.get("THUMB_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "thumbs"))
+THUMB_CACHE_MAX_BYTES = max(1, int(os.environ.get("THUMB_CACHE_MAX_BYTES", 512 * 1024 * 1024)))
+COVER_SOURCE_MEMORY_BYTES = max(0, int(os.environ.get("COVER_SOURCE_MEMORY_BYTES", 64 * 1024 * 1024)))
+THUMB_SIZES = (64, 128, 256, 512) # texture widths; heights are the next power of two for the cover aspect
+THUMB_DEFAULT_SIZE = int(os.environ.get("THUMB_DEFAULT_SIZE", 256))
+THUMB_QUALITY = 80
+THUMB_FORMAT = "WEBP" if pil_features and pil_features.check("webp") else "JPEG"
+THUMB_MIMETYPE = "image/webp" if THUMB_FORMAT == "WEBP" else "image/jpeg"
+COVER_TEXTURE_ASPECT = BOOK_WIDTH / BOOK_HEIGHT
+COVER_KEY_PATTERN = re.compile(r'^[0-9a-f]{20}$')
+COVER_URL_MEMORY = 100000
+if THUMB_DEFAULT_SIZE not in THUMB_SIZES: THUMB_DEFAULT_SIZE = 256
+_cover_urls = OrderedDict()
+_cover_urls_lock = threading.Lock()
+_thumb_locks = [threading.Lock() for _ in range(64)]
+_thumb_writes = 0
+_thumb_prune_lock = threading.Lock()
+_cover_sources = OrderedDict()
+_cover_sources_bytes = 0
+_cover_sources_lock = threading.Lock()
+_cover_source_writes = queue.Queue()
+_cover_source_writer = None
+_cover_source_writer_lock = threading.Lock()
+
+def cover_key(image_url):
+    return hashlib.sha1(normalize_cover_url(image_url).encode("utf-8")).hexdigest()[:20]
+
+# Points book["cover_url"] at the proxy and remembers the key in memory.
+def register_cover_url(book):
+    if not book.get("image"):
+        return
+    key = cover_key(book["image"])
+    book["cover_url"] = f"/cover/{key}"
+    with _cover_urls_lock:
+        _cover_urls[key] = book["image"]
+        _cover_urls.move_to_end(key)
+        while len(_cover_urls) > COVER_URL_MEMORY:
+            _cover_urls.popitem(last=False)
+
+# Saves the keys of registered books in the cover cache so they survive a restart.
+def persist_cover_urls(books):
+    cache = get_cover_cache()
+    pairs = [(cover_key(book["image"]), book["image"]) for book in books if book.get("image")]
+    if cache and pairs:
+        cache.put_keys(pairs)
+
+def url_for_cover_key(key):
+    with _cover_urls_lock:
+        url = _cover_urls.get(key)
+    if url is None and get_cover_cache():
+        url = get_cover_cache().url_for_key(key)
+    return url
+
+def thumb_cache_path(key, suffix):
+    return os.path.join(THUMB_CACHE_DIR, key[:2], f"{key}.{suffix}")
+
+def write_thumb_cache_file(path, data):
+    global _thumb_writes
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+    with _thumb_prune_lock:
+        _thumb_writes += 1
+        prune = _thumb_writes % 256 == 0
+    if prune:
+        prune_thumb_cache()
+
+def prune_thumb_cache():
+    entries = []
+    for root, _, names in os.walk(THUMB_CACHE_DIR):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= THUMB_CACHE_MAX_BYTES * 0.9:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+# Keeps a cover's downloaded bytes for the thumbnail proxy: in memory, and queued for the
+# background writer so the caller never waits on the disk.
+def remember_cover_source(image_url, content, write=True):
+    global _cover_sources_bytes
+    if not content or not image_url:
+        return
+    key = cover_key(image_url)
+    if len(content) <= COVER_SOURCE_MEMORY_BYTES:
+        with _cover_sources_lock:
+            if key in _cover_sources:
+                _cover_sources_bytes -= len(_cover_sources.pop(key))
+            _cover_sources[key] = content
+            _cover_sources_bytes += len(content)
+            while _cover_sources_bytes > COVER_SOURCE_MEMORY_BYTES:
+                _cover_sources_bytes -= len(_cover_sources.popitem(last=False)[1])
+    if THUMB_CACHE_DIR and write:
+        start_cover_source_writer()
+        _cover_source_writes.put((key, content))
+
+def start_cover_source_writer():
+    global _cover_source_writer
+    with _cover_source_writer_lock:
+        if _cover_source_writer is None:
+            _cover_source_writer = threading.Thread(target=write_cover_sources, name="cover-source-writer", daemon=True)
+            _cover_source_writer.start()
+
+def write_cover_sources():
+    while True:
+        key, content = _cover_source_writes.get()
+        try:
+            if not os.path.exists(thumb_cache_path(key, "src")):
+                store_cover_source(key, content)
+        finally:
+            _cover_source_writes.task_done()
+
+def peek_cover_source(key):
+    with _cover_sources_lock:
+        content = _cover_sources.get(key)
+        if content is not None:
+            _cover_sources.move_to_end(key)
+    return content
+
+def store_cover_source(key, content):
+    if not THUMB_CACHE_DIR or not content:
+        return
+    try:
+        write_thumb_cache_file(thumb_cache_path(key, "src"), content)
+    except OSError as e:
+        print(f"Warn: Could not store cover bytes ({e}).")
+
+def next_power_of_two(n):
+    return 1 << max(0, math.ceil(math.log2(max(1, n))))
+
+# Crops to the front-face aspect (centered, like the client's texture offset) and resizes.
+def render_cover_thumb(content, size):
+    height = next_power_of_two(size / COVER_TEXTURE_ASPECT)
+    img = Image.open(io.BytesIO(content))
+    img.draft('RGB', (size, height))
+    img = img.convert('RGB')
+    w, h = img.size
+    if w / h < COVER_TEXTURE_ASPECT:
+        crop_h = round(w / COVER_TEXTURE_ASPECT)
+        img = img.crop((0, (h - crop_h) // 2, w, (h - crop_h) // 2 + crop_h))
+    else:
+        crop_w = round(h * COVER_TEXTURE_ASPECT)
+        img = img.crop(((w - crop_w) // 2, 0, (w - crop_w) // 2 + crop_w, h))
+    img = img.resize((size, height), Image.LANCZOS)
+    out = io.BytesIO()
+    img.save(out, THUMB_FORMAT, quality=THUMB_QUALITY)
+    return out.getvalue()
+
+# Returns the encoded thumbnail, or None when the key is unknown or the cover can't be loaded.
+def get_cover_thumb(key, size):
+    image_url = url_for_cover_key(key)
+    if image_url is None:
+        return None
+    path = thumb_cache_path(key, f"{size}.{THUMB_FORMAT.lower()}")
+    with _thumb_locks[int(key[:4], 16) % len(_thumb_locks)]:
+        if THUMB_CACHE_DIR and os.path.exists(path):
+            with open(path, "rb") as f:
+                return f.read()
+        content = peek_cover_source(key)
+        source_path = thumb_cache_path(key, "src")
+        if content is None and THUMB_CACHE_DIR and os.path.exists(source_path):
+            with open(source_path, "rb") as f:
+                content = f.read()
+        if content is None:
+            with timed("cover_download"):
+                content = fetch_cover_bytes(image_url)
+            # Already on the request path, so it's written here rather than queued.
+            store_cover_source(key, content)
+            remember_cover_source(image_url, content, write=False)
+        if content is None:
+            return None
+        try:
+            with timed("thumbnail"):
+                data = render_cover_thumb(content, size)
+        except Exception as e:
+            print(f"Warn: Thumbnail failed for {image_url.split('/')[-1]} ({e}).")
+            return None
+        if THUMB_CACHE_DIR:
+            try:
+                write_thumb_cache_file(path, data)
+            except OSError as e:
+                print(f"Warn: Could not store thumbnail ({e}).")
+        return data
 
 # --- Helper Function: get_edge_color (Copied from User) ---
 def get_edge_color(image_url, edge_width_percent=10):
     if not Image or not ImageStat or not io:
         return "#808080"
-    try:
-        response = requests.get(image_url, stream=True, timeout=10)
-        response.raise_for_status()
-        img = Image.open(io.BytesIO(response.content))
-    except Exception as e:
-        print(f"Warn: Img process fail (request/open) {image_url.split('/')[-1]} {e}")
-        return "#808080"
+    if edge_width_percent == 10 and get_cover_cache():
+        return analyze_cover(image_url)[0]
+    return edge_color_from_image(fetch_cover_image(image_url), edge_width_percent)
 
+def edge_color_from_image(img, edge_width_percent=10):
+    if img is None or not ImageStat:
+        return "#808080"
     try:
         if img.mode not in ('RGB', 'L'):
             img = img.convert('RGB')
@@ -75,7 +818,7 @@ def get_edge_color(image_url, edge_width_percent=10):
         hex_color = "#{:02x}{:02x}{:02x}".format(*avg_color)
         return hex_color
     except Exception as e:
-        print(f"Warn: Img process fail (analysis) {image_url.split('/')[-1]} {e}")
+        print(f"Warn: Img process fail (analysis) {e}")
         return "#808080"
 
 # --- Contrast Calculation Helpers (Copied from User) ---
@@ -118,171 +861,869 @@ def get_contrast_ratio(lum1, lum2):
 
 # --- Contrasting Text Color Helper (Copied from User) ---
 def get_contrasting_text_color(image_url, spine_bg_hex, min_contrast=4.5, fallback_light='#FFFFFF', fallback_dark='#000000'):
+    if not Image or not io or not (np or colorgram) or not image_url:
+        return pick_text_color(None, spine_bg_hex, min_contrast, fallback_light, fallback_dark)
+    cache = get_cover_cache()
+    cached = cache.get(image_url) if cache else None
+    palette = cached["palette"] if cached else analyze_cover(image_url)[2]
+    return pick_text_color(palette, spine_bg_hex, min_contrast, fallback_light, fallback_dark)
+
+def extract_palette(img, number_of_colors=6):
+    if img is None or not (np or colorgram):
+        return None
+    try:
+        if np is not None:
+            if img.mode not in ('RGB', 'RGBA', 'RGBa'):
+                img = img.convert('RGB')
+            return extract_palette_array(np.asarray(img), number_of_colors)
+        return [(color.rgb.r, color.rgb.g, color.rgb.b) for color in colorgram.extract(img, number_of_colors)]
+    except Exception as e:
+        # print(f"Warn: Failed palette extraction: {e}.") # Less verbose
+        return None
+
+# --- NumPy Palette + Contrast Engine ---
+# Same bucketing as colorgram.extract (top two bits of luminance, hue and lightness packed into
+# 12 bits, buckets ranked by pixel count, each color the mean of its bucket), done as array ops.
+def extract_palette_array(pixels, number_of_colors=6):
+    rgb = pixels.reshape(-1, pixels.shape[-1])[:, :3].astype(np.int64)
+    r, g, b = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+    most, least = rgb.max(axis=1), rgb.min(axis=1)
+    diff = most - least
+    safe_diff = np.where(diff == 0, 1, diff)
+    hue = np.where(most == r, (g - b) * 255 // safe_diff + np.where(g < b, 1530, 0),
+          np.where(most == g, (b - r) * 255 // safe_diff + 510, (r - g) * 255 // safe_diff + 1020)) // 6
+    hue = np.where(diff == 0, 0, hue)
+    lightness = (most + least) >> 1
+    luma = (r * 0.2126 + g * 0.7152 + b * 0.0722).astype(np.int64)
+    packed = ((luma & 0b11000000) << 4) | ((hue & 0b11000000) << 2) | (lightness & 0b11000000)
+
+    counts = np.bincount(packed, minlength=4096)
+    used = np.flatnonzero(counts)
+    top = used[np.argsort(-counts[used], kind='stable')][:number_of_colors]
+    sums = np.stack([np.bincount(packed, weights=channel, minlength=4096)[top] for channel in (r, g, b)], axis=1)
+    means = np.rint(sums).astype(np.int64) // counts[top][:, None]
+    return [tuple(int(c) for c in color) for color in means]
+
+def luminance_array(rgb):
+    c = np.asarray(rgb, dtype=np.float64) / 255.0
+    linear = np.where(c <= 0.03928, c / 12.92, ((c + 0.055) / 1.055) ** 2.4)
+    return linear @ np.array([0.2126, 0.7152, 0.0722])
+
+# Scores every palette against its background in one pass; returns one text color per cover.
+def pick_text_colors(palettes, spine_bg_hexes, min_contrast=4.5, fallback_light='#FFFFFF', fallback_dark='#000000'):
+    count = len(spine_bg_hexes)
+    if count == 0:
+        return []
+    width = max([len(p) for p in palettes if p] or [1])
+    colors = np.zeros((count, width, 3), dtype=np.int64)
+    valid = np.zeros((count, width), dtype=bool)
+    for i, palette in enumerate(palettes):
+        if palette:
+            colors[i, :len(palette)] = palette
+            valid[i, :len(palette)] = True
+    bg_lum = luminance_array([hex_to_rgb(h) for h in spine_bg_hexes])
+    lum = luminance_array(colors)
+    lighter, darker = np.maximum(lum, bg_lum[:, None]), np.minimum(lum, bg_lum[:, None])
+    contrast = np.where(valid, (lighter + 0.05) / (darker + 0.05), 0.0)
+    best = contrast.argmax(axis=1)
+    best_contrast = contrast[np.arange(count), best]
+    results = []
+    for i in range(count):
+        if best_contrast[i] >= min_contrast:
+            results.append("#{:02x}{:02x}{:02x}".format(*(int(c) for c in colors[i, best[i]])))
+        else:
+            results.append(fallback_dark if bg_lum[i] > 0.5 else fallback_light)
+    return results
+
+def pick_text_color(palette, spine_bg_hex, min_contrast=4.5, fallback_light='#FFFFFF', fallback_dark='#000000'):
+    if np is not None:
+        return pick_text_colors([palette], [spine_bg_hex], min_contrast, fallback_light, fallback_dark)[0]
     r_bg, g_bg, b_bg = hex_to_rgb(spine_bg_hex)
     bg_lum = get_luminance(r_bg, g_bg, b_bg)
     default_color = fallback_dark if bg_lum > 0.5 else fallback_light
 
-    if not Image or not io or not colorgram or not image_url:
+    if not palette:
         return default_color
 
     best_color_hex = None
     highest_contrast = 0.0
 
-    try:
-        response = requests.get(image_url, stream=True, timeout=10)
-        response.raise_for_status()
-        if not response.content: raise ValueError("Empty image content")
-
-        img_buffer = io.BytesIO(response.content)
-        img_buffer.seek(0)
-        colors = colorgram.extract(img_buffer, 6)
+    for c_r, c_g, c_b in palette:
+        c_lum = get_luminance(c_r, c_g, c_b)
+        contrast = get_contrast_ratio(bg_lum, c_lum)
 
-        if not colors: raise ValueError("Could not extract colors")
+        if contrast > highest_contrast:
+            highest_contrast = contrast
+            best_color_hex = "#{:02x}{:02x}{:02x}".format(c_r, c_g, c_b)
 
-        for color in colors:
-            c_r, c_g, c_b = color.rgb.r, color.rgb.g, color.rgb.b
-            c_lum = get_luminance(c_r, c_g, c_b)
-            contrast = get_contrast_ratio(bg_lum, c_lum)
-
-            if contrast > highest_contrast:
-                highest_contrast = contrast
-                best_color_hex = "#{:02x}{:02x}{:02x}".format(c_r, c_g, c_b)
+    if highest_contrast >= min_contrast:
+        return best_color_hex
+    else:
+        return default_color
 
-        if highest_contrast >= min_contrast:
-            return best_color_hex
+# --- Cover Analysis: download + decode once, derive both spine colors ---
+# Returns (spine_color, spine_text_color, palette); palette is None when nothing could be decoded.
+def analyze_cover_bytes(content, max_side=None):
+    return analyze_cover_bytes_timed(content, max_side)[0]
+
+# Same, plus {stage: seconds}. Runs in the analysis processes, so the caller records the timings.
+def analyze_cover_bytes_timed(content, max_side=None):
+    durations = {}
+    start = time.perf_counter()
+    img = open_cover_image(content, COVER_ANALYSIS_MAX_SIDE if max_side is None else max_side)
+    durations["cover_decode"] = time.perf_counter() - start
+    start = time.perf_counter()
+    spine_color = edge_color_from_image(img)
+    durations["edge_color"] = time.perf_counter() - start
+    start = time.perf_counter()
+    palette = extract_palette(img)
+    spine_text_color = pick_text_color(palette, spine_color)
+    durations["palette"] = time.perf_counter() - start
+    return (spine_color, spine_text_color, palette), durations
+
+def record_analysis(durations, timings=None):
+    for stage, seconds in durations.items():
+        record_stage(stage, seconds, timings)
+
+# Cache-aware single-cover analysis: a cached URL never touches the network.
+def analyze_cover(image_url):
+    cache = get_cover_cache()
+    cached = cache.get(image_url) if cache and image_url else None
+    if cached:
+        return cached["spine_color"], cached["spine_text_color"], cached["palette"]
+    with timed("cover_download"):
+        content = fetch_cover_bytes(image_url) if Image else None
+    remember_cover_source(image_url, content)
+    result, durations = analyze_cover_bytes_timed(content)
+    record_analysis(durations)
+    if cache and result[2] is not None: # undecodable bytes are retried next time, not cached
+        cache.put(image_url, *result)
+    return result
+
+# --- Fidelity Check: downscaled analysis vs full-resolution decode ---
+# Reports the largest per-channel difference in spine/text colors for each cover (URL or local path).
+def check_cover_fidelity(sources, max_side=None, tolerance=2):
+    max_side = COVER_ANALYSIS_MAX_SIDE if max_side is None else max_side
+    report = []
+    for source in sources:
+        if os.path.exists(source):
+            with open(source, 'rb') as f: content = f.read()
         else:
-            return default_color
-
-    except Exception as e:
-        # print(f"Warn: Failed palette/contrast for {image_url[-30:]}: {e}. Using default.") # Less verbose
-        return default_color
+            content = fetch_cover_bytes(source)
+        if content is None:
+            continue
+        full = analyze_cover_bytes(content, 0)
+        reduced = analyze_cover_bytes(content, max_side)
+        delta = lambda a, b: max(abs(x - y) for x, y in zip(hex_to_rgb(a), hex_to_rgb(b)))
+        spine_delta, text_delta = delta(full[0], reduced[0]), delta(full[1], reduced[1])
+        report.append({"source": source, "full": full[:2], "reduced": reduced[:2], "spine_delta": spine_delta,
+                       "text_delta": text_delta, "ok": spine_delta <= tolerance and text_delta <= tolerance})
+    return report
+
+def get_analysis_pool():
+    global _analysis_pool
+    if COVER_ANALYSIS_PROCESSES <= 0 or not Image:
+        return None
+    with _analysis_pool_lock:
+        if _analysis_pool is None:
+            try:
+                _analysis_pool = ProcessPoolExecutor(max_workers=COVER_ANALYSIS_PROCESSES, mp_context=multiprocessing.get_context(COVER_ANALYSIS_START_METHOD))
+            except Exception as e:
+                print(f"Warn: Could not start analysis processes ({e}). Analyzing inline.")
+                return None
+        return _analysis_pool
+
+# Fills in spine colors for every book in place and yields each book as it finishes
+# (completion order). books may be a generator: covers start downloading as soon as each book is yielded.
+# Stage timings also go to `timings` (a job's StageTimings) when given.
+def iter_analyzed_covers(books, timings=None):
+    pool = get_analysis_pool()
+    cache = get_cover_cache()
+
+    def fetch_and_analyze(book):
+        if not book["image"] and book.get("book_url"):
+            book["image"] = resolve_cover_url(book, timings)
+        image_url = book["image"]
+        cached = cache.get(image_url) if cache and image_url else None
+        if cached:
+            return cached["spine_color"], cached["spine_text_color"], cached["palette"]
+        with timed("cover_download", timings):
+            content = fetch_cover_bytes(image_url) if Image else None
+        if content is None:
+            return analyze_cover_bytes(content)
+        remember_cover_source(image_url, content)
+        result = None
+        if pool is not None:
+            try:
+                submitted = time.perf_counter()
+                result, durations = pool.submit(analyze_cover_bytes_timed, content).result()
+                # Round trip minus work done = time queued for a worker plus pickling.
+                record_stage("analysis_queue", max(0.0, time.perf_counter() - submitted - sum(durations.values())), timings)
+            except Exception as e:
+                print(f"Warn: Analysis process failed for {image_url.split('/')[-1]} ({e}). Retrying inline.")
+        if result is None:
+            result, durations = analyze_cover_bytes_timed(content)
+        record_analysis(durations, timings)
+        if cache and result[2] is not None: # undecodable bytes are retried next time, not cached
+            cache.put(image_url, *result)
+        return result
+
+    def finish(future, book):
+        try:
+            book["spine_color"], book["spine_text_color"], _ = future.result()
+        except Exception as e:
+            print(f"Warn: Cover analysis failed for {book.get('title')}: {e}")
+            book["spine_color"], book["spine_text_color"], _ = analyze_cover_bytes(None)
+        return book
+
+    fetchers = ThreadPoolExecutor(max_workers=COVER_FETCH_WORKERS)
+    pending = {}
+    try:
+        for book in books:
+            pending[fetchers.submit(fetch_and_analyze, book)] = book
+            for future in [f for f in pending if f.done()]:
+                yield finish(future, pending.pop(future))
+        for future in as_completed(pending):
+            yield finish(future, pending[future])
+    finally:
+        # Also reached when the job is cancelled and closes this generator: drop covers nobody will read.
+        fetchers.shutdown(wait=False, cancel_futures=True)
+
+# --- Shelf Page Fetching ---
+# Pages past the first are fetched concurrently once the shelf size is known; each host
+# gets at most one new request per SHELF_HOST_MIN_INTERVAL seconds.
+SHELF_HEADERS = {"User-Agent": "Mozilla/5.0"}
+SHELF_PAGE_WORKERS = max(1, int(os.environ.get("SHELF_PAGE_WORKERS", 4)))
+SHELF_HOST_MIN_INTERVAL = max(0.0, float(os.environ.get("SHELF_HOST_MIN_INTERVAL", 0.25)))
+_host_next_slot = {}
+_host_slot_lock = threading.Lock()
+
+def wait_for_host_slot(url):
+    host = urlparse(url).netloc
+    with _host_slot_lock:
+        now = time.monotonic()
+        slot = max(now, _host_next_slot.get(host, 0.0))
+        _host_next_slot[host] = slot + SHELF_HOST_MIN_INTERVAL
+    if slot > now:
+        time.sleep(slot - now)
+
+def fetch_shelf_page(url, page, timeout=10, timings=None):
+    page_url = f"{url}&page={page}"
+    with timed("host_wait", timings):
+        wait_for_host_slot(page_url)
+    with timed("page_fetch", timings):
+        response = http_get(page_url, headers=SHELF_HEADERS, timeout=timeout)
+        response.raise_for_status()
+        return response.text
+
+# --- Shelf HTML Parsing ---
+# Only the review rows are walked. With lxml the page is parsed in C and rows are found by
+# XPath; without it, a SoupStrainer keeps html.parser from building the page chrome. Either
+# way each row's cells are indexed in one pass instead of running a CSS query per field.
+REVIEW_ROW_ID = re.compile(r'^review_')
+FREE_TEXT_ID = re.compile(r'^freeTextContainer')
+REVIEW_ROW_STRAINER = SoupStrainer("tr", id=REVIEW_ROW_ID)
+SHELF_HEADER_STRAINER = SoupStrainer(id="shelfHeader")
+SELECTED_SHELF_STRAINER = SoupStrainer(class_="selectedShelf")
+TOTAL_BOOKS_PATTERN = re.compile(r'of (\d{1,3}(?:,\d{3})*|\d+) books')
+PAGE_COUNT_PATTERN = re.compile(r'(\d+)\s*(?:pages?)?') # applied after thousands separators are stripped
+MORE_SUFFIX_PATTERN = re.compile(r'\s*\.\.\.\(more\)$')
+COVER_SIZE_PATTERN = re.compile(r'\._S[XY]?\d+(_?\.|\.jpg)')
+DEFAULT_PAGE_COUNT = 350
+
+def total_books_from_text(count_text, fallback_text):
+    total_books = 0
+    if count_text is not None and 'books)' in count_text:
+        match = TOTAL_BOOKS_PATTERN.search(count_text.replace(',',''))
+        if match: total_books = int(match.group(1))
+    if total_books == 0 and fallback_text is not None:
+        digits = ''.join(filter(str.isdigit, fallback_text))
+        if digits: total_books = int(digits)
+    return total_books
+
+def parse_total_books(html):
+    if lxml_html is not None:
+        doc = lxml_document(html)
+        if doc is None:
+            return 0
+        count_elems = doc.xpath('//*[@id="shelfHeader"]//*[contains(concat(" ", normalize-space(@class), " "), " greyText ")]')
+        fallback_elems = doc.xpath('//*[contains(concat(" ", normalize-space(@class), " "), " selectedShelf ")]')
+        return total_books_from_text(count_elems[0].text_content() if count_elems else None,
+                                     fallback_elems[0].text_content() if fallback_elems else None)
+    count_elem = BeautifulSoup(html, "html.parser", parse_only=SHELF_HEADER_STRAINER).select_one('#shelfHeader .greyText')
+    total_books = total_books_from_text(count_elem.text if count_elem else None, None)
+    if total_books == 0:
+        fallback_elem = BeautifulSoup(html, "html.parser", parse_only=SELECTED_SHELF_STRAINER).select_one('.selectedShelf')
+        total_books = total_books_from_text(None, fallback_elem.text if fallback_elem else None)
+    return total_books
+
+# --- Helper Function: book_from_fields (Rating/Review Included) ---
+# Takes the raw strings pulled out of one review row (None where the element is missing).
+def book_from_fields(row_id, title_text, author_text, image_src, publisher_text, page_count_text, rating_title, review_parts):
+    if title_text is None or author_text is None:
+        return None
+    book_title = title_text.strip()
+    author_text = author_text.strip()
+    if ', ' in author_text:
+        parts = author_text.split(', ', 1)
+        author_name = f"{parts[1]} {parts[0]}" if len(parts) == 2 else author_text
+    else:
+        author_name = author_text
+
+    review_text = ""
+    if review_parts is not None:
+        review_text = ' '.join(review_parts).strip()
+        review_text = MORE_SUFFIX_PATTERN.sub('', review_text)
+
+    publisher_name = publisher_text.strip() if publisher_text is not None else ""
+    page_count = DEFAULT_PAGE_COUNT
+    if page_count_text is not None:
+        page_text_raw = page_count_text.strip()
+        match = PAGE_COUNT_PATTERN.search(page_text_raw.replace(',',''))
+        if match:
+            try: page_count = max(1, int(match.group(1)))
+            except ValueError: pass
+
+    rating_value = rating_title.strip() if rating_title is not None else None
+
+    raw_image_url = image_src
+    high_res_image_url = raw_image_url
+    if raw_image_url:
+        high_res_image_url = COVER_SIZE_PATTERN.sub('.', raw_image_url, count=1)
+
+    return {
+        "review_id": (row_id or "").replace("review_", "", 1),
+        "title": book_title,
+        "author": author_name,
+        "publisher": publisher_name,
+        "image": high_res_image_url,
+        "spine_color": "#808080",
+        "spine_text_color": None,
+        "page_count": page_count,
+        "rating": rating_value,
+        "review": review_text
+    }
+
+def book_from_tags(row, title_elem, author_elem, image_elem, publisher_elem, page_count_elem, rating_elem, review_container_elem):
+    return book_from_fields(row.get("id", ""),
+        title_elem.text if title_elem else None,
+        author_elem.text if author_elem else None,
+        image_elem.get("src") if image_elem else "",
+        publisher_elem.text if publisher_elem else None,
+        page_count_elem.text if page_count_elem else None,
+        rating_elem["title"] if rating_elem and rating_elem.has_attr("title") else None,
+        [elem.text for elem in review_container_elem.find_all(string=True, recursive=False)] if review_container_elem else None)
+
+# None for a blank or unparsable body (html.parser just finds nothing in those).
+def lxml_document(html):
+    try:
+        try:
+            return lxml_html.fromstring(html)
+        except ValueError: # str input with an XML encoding declaration
+            return lxml_html.fromstring(html.encode('utf-8'))
+    except lxml_etree.ParserError:
+        return None
 
-# --- Helper Function: get_books_from_shelf (Rating/Review Included) ---
-def get_books_from_shelf(url):
-    global progress_data
-    progress_data = {"total_books":0, "books_processed":0, "complete":False, "error":None}
-    books=[]
-    headers={"User-Agent": "Mozilla/5.0"}
-    PAGE_COUNT_SELECTOR = 'td.field.num_pages .value'
-    DEFAULT_PAGE_COUNT = 350
-    RATING_SELECTOR = 'td.field.rating .value span.staticStars'
-    REVIEW_SELECTOR = 'td.field.review .value span[id^="freeTextContainer"]'
+def lxml_has_class(elem, name):
+    return name in (elem.get("class") or "").split()
+
+# cells: every td of one field class in the row, in document order (rows can repeat a class).
+def lxml_first_in_value(cells, tag, match=None):
+    for cell in cells:
+        for value in cell.iterdescendants():
+            if isinstance(value.tag, str) and lxml_has_class(value, "value"):
+                for found in value.iterdescendants(tag):
+                    if match is None or match(found):
+                        return found
+    return None
+
+def lxml_first_descendant(cells, match):
+    return next((e for cell in cells for e in cell.iterdescendants() if isinstance(e.tag, str) and match(e)), None)
+
+# Direct text children as html.parser sees them: a comment child counts as an empty string.
+def lxml_direct_strings(elem):
+    parts = [elem.text] if elem.text is not None else []
+    for child in elem:
+        if child.tag is lxml_etree.Comment:
+            parts.append("")
+        if child.tail is not None:
+            parts.append(child.tail)
+    return parts
+
+def parse_shelf_rows_lxml(html):
+    books = []
+    doc = lxml_document(html)
+    if doc is None:
+        return books
+    for row in doc.xpath('//tr[starts-with(@id, "review_")]'):
+        cells = {}
+        for cell in row.iterdescendants("td"):
+            classes = (cell.get("class") or "").split()
+            if "field" in classes:
+                for name in classes:
+                    cells.setdefault(name, []).append(cell)
+        is_value = lambda e: lxml_has_class(e, "value")
+        title_elem = lxml_first_in_value(cells.get("title", ()), "a")
+        author_elem = lxml_first_in_value(cells.get("author", ()), "a")
+        image_elem = lxml_first_descendant(cells.get("cover", ()), lambda e: e.tag == "img")
+        publisher_elem = lxml_first_descendant(cells.get("publisher", ()), is_value)
+        page_count_elem = lxml_first_descendant(cells.get("num_pages", ()), is_value)
+        rating_elem = lxml_first_in_value(cells.get("rating", ()), "span", lambda e: lxml_has_class(e, "staticStars"))
+        review_elem = lxml_first_in_value(cells.get("review", ()), "span", lambda e: FREE_TEXT_ID.match(e.get("id") or ""))
+        book = book_from_fields(row.get("id"),
+            title_elem.text_content() if title_elem is not None else None,
+            author_elem.text_content() if author_elem is not None else None,
+            image_elem.get("src") if image_elem is not None else "",
+            publisher_elem.text_content() if publisher_elem is not None else None,
+            page_count_elem.text_content() if page_count_elem is not None else None,
+            rating_elem.get("title") if rating_elem is not None else None,
+            lxml_direct_strings(review_elem) if review_elem is not None else None)
+        if book: books.append(book)
+    return books
+
+def first_in_value(cells, *args, **kwargs):
+    for cell in cells:
+        for value in cell.find_all(class_="value"):
+            found = value.find(*args, **kwargs)
+            if found is not None:
+                return found
+    return None
+
+def first_in_cells(cells, *args, **kwargs):
+    for cell in cells:
+        found = cell.find(*args, **kwargs)
+        if found is not None:
+            return found
+    return None
+
+def parse_shelf_rows(html, timings=None):
+    with timed("parse", timings):
+        if lxml_html is not None:
+            return parse_shelf_rows_lxml(html)
+        books = []
+        for row in BeautifulSoup(html, "html.parser", parse_only=REVIEW_ROW_STRAINER).find_all("tr", id=REVIEW_ROW_ID):
+            cells = {}
+            for cell in row.find_all("td", class_="field"):
+                for name in cell.get("class", ()):
+                    cells.setdefault(name, []).append(cell)
+            book = book_from_tags(row,
+                first_in_value(cells.get("title", ()), "a"),
+                first_in_value(cells.get("author", ()), "a"),
+                first_in_cells(cells.get("cover", ()), "img"),
+                first_in_cells(cells.get("publisher", ()), class_="value"),
+                first_in_cells(cells.get("num_pages", ()), class_="value"),
+                first_in_value(cells.get("rating", ()), "span", class_="staticStars"),
+                first_in_value(cells.get("review", ()), "span", id=FREE_TEXT_ID))
+            if book: books.append(book)
+        return books
 
-    try:
-        page = 1
-        initial_url = f"{url}&page=1"
-        initial_response = requests.get(initial_url, headers=headers, timeout=15)
-        initial_response.raise_for_status()
-        initial_soup = BeautifulSoup(initial_response.text, "html.parser")
-
-        total_books = 0
-        count_elem = initial_soup.select_one('#shelfHeader .greyText')
-        if count_elem and 'books)' in count_elem.text:
-            match = re.search(r'of (\d{1,3}(?:,\d{3})*|\d+) books', count_elem.text.replace(',',''))
-            if match: total_books = int(match.group(1))
-        if total_books == 0:
-             count_elem_fallback = initial_soup.select_one('.selectedShelf')
-             if count_elem_fallback: total_books = int(''.join(filter(str.isdigit, count_elem_fallback.text)))
-
-        progress_data["total_books"] = max(1, total_books)
-
-        while True:
-            current_url = f"{url}&page={page}"
-
-            if page == 1:
-                soup = initial_soup
-            else:
+# Original full-tree, CSS-selector row parser. Kept as the reference for --check-parser.
+def parse_shelf_rows_reference(html):
+    books = []
+    for row in BeautifulSoup(html, "html.parser").select('tr[id^="review_"]'):
+        book = book_from_tags(row,
+            row.select_one('td.field.title .value a'),
+            row.select_one('td.field.author .value a'),
+            row.select_one('td.field.cover img'),
+            row.select_one('td.field.publisher .value'),
+            row.select_one('td.field.num_pages .value'),
+            row.select_one('td.field.rating .value span.staticStars'),
+            row.select_one('td.field.review .value span[id^="freeTextContainer"]'))
+        if book: books.append(book)
+    return books
+
+# Parses saved shelf pages with both parsers; returns a list of (file, row index, fast, reference) mismatches.
+def check_shelf_parser(paths):
+    mismatches = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f: html = f.read()
+        fast, reference = parse_shelf_rows(html), parse_shelf_rows_reference(html)
+        for i in range(max(len(fast), len(reference))):
+            a = fast[i] if i < len(fast) else None
+            b = reference[i] if i < len(reference) else None
+            if a != b: mismatches.append((path, i, a, b))
+    return mismatches
+
+# Yields (page_number, books) as pages arrive. Page 1 is already parsed; the remaining
+# known pages are fetched concurrently, then any overflow sequentially until an empty page.
+def iter_shelf_pages(url, first_page_books, total_books, progress):
+    yield 1, first_page_books
+    per_page = len(first_page_books)
+    if not per_page:
+        return
+
+    last_page = 1
+    last_page_full = True
+    if total_books > per_page:
+        last_page = math.ceil(total_books / per_page)
+        page_fetchers = ThreadPoolExecutor(max_workers=SHELF_PAGE_WORKERS)
+        try:
+            futures = {page_fetchers.submit(fetch_shelf_page, url, page, timings=progress.timings): page for page in range(2, last_page + 1)}
+            for future in as_completed(futures):
+                page = futures[future]
                 try:
-                    response = requests.get(current_url, headers=headers, timeout=10)
-                    response.raise_for_status()
-                    soup = BeautifulSoup(response.text, "html.parser")
+                    page_books = parse_shelf_rows(future.result(), progress.timings)
                 except requests.exceptions.RequestException as page_err:
                     print(f"Error fetching page {page}: {page_err}.")
-                    progress_data["error"] = f"Warn: Failed page {page}."
-                    break
+                    progress["error"] = f"Warn: Failed page {page}."
+                    continue
+                if page == last_page:
+                    last_page_full = len(page_books) >= per_page
+                yield page, page_books
+        finally:
+            page_fetchers.shutdown(wait=False, cancel_futures=True)
+    elif total_books:
+        last_page_full = False
+
+    page = last_page + 1
+    while last_page_full and not progress.get("error"):
+        try:
+            page_books = parse_shelf_rows(fetch_shelf_page(url, page, timings=progress.timings), progress.timings)
+        except requests.exceptions.RequestException as page_err:
+            print(f"Error fetching page {page}: {page_err}.")
+            progress["error"] = f"Warn: Failed page {page}."
+            break
+        if not page_books:
+            break
+        yield page, page_books
+        page += 1
+
+# --- Shelf Result Cache ---
+# Finished shelves are stored per shelf URL. A repeat load inside SHELF_CACHE_FRESH_SECONDS is
+# served straight from the cache; after that, shelves sorted by date_updated (newest first) are
+# refreshed by walking pages only until a page of unchanged rows, and the cached tail is reused.
+# Only that sort is delta-safe: an edited row moves to the top, whereas under date_added/date_read
+# an edit deep in the shelf would never be reached. Cover changes don't bump date_updated, so a
+# full scrape still runs once the last one is SHELF_CACHE_MAX_AGE seconds old. The walk finishes
+# before the first book is sent, so outside the fresh window a cached shelf still waits on at
+# least one page fetch. Set SHELF_CACHE_PATH="" to disable.
+SHELF_CACHE_PATH = os.environ.get("SHELF_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "shelves.sqlite3"))
+SHELF_CACHE_MAX_ENTRIES = max(1, int(os.environ.get("SHELF_CACHE_MAX_ENTRIES", 500)))
+SHELF_CACHE_FRESH_SECONDS = max(0.0, float(os.environ.get("SHELF_CACHE_FRESH_SECONDS", 60)))
+SHELF_CACHE_MAX_AGE = max(0.0, float(os.environ.get("SHELF_CACHE_MAX_AGE", 24 * 60 * 60)))
+INCREMENTAL_SORTS = {"date_updated"}
+BOOK_METADATA_KEYS = ("title", "author", "publisher", "image", "page_count", "rating", "review")
+_shelf_cache = None
+_shelf_cache_lock = threading.Lock()
+
+class ShelfCache:
+    def __init__(self, path, max_entries):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS shelves (url TEXT PRIMARY KEY, books TEXT, updated REAL, scraped REAL)")
+            if "scraped" not in [row[1] for row in self._db.execute("PRAGMA table_info(shelves)")]:
+                self._db.execute("ALTER TABLE shelves ADD COLUMN scraped REAL") # older rows stay NULL, i.e. due a full scrape
+
+    # updated: last write of any kind; scraped: last full scrape (refreshes keep the old value).
+    def get(self, url):
+        with self._lock:
+            row = self._db.execute("SELECT books, updated, scraped FROM shelves WHERE url = ?", (url.strip(),)).fetchone()
+        if row is None:
+            return None
+        return {"books": json.loads(row[0]), "updated": row[1], "scraped": row[2] or 0.0}
+
+    def put(self, url, books, full_scrape=True):
+        url, now = url.strip(), time.time()
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO shelves (url, books, updated, scraped) VALUES (?, ?, ?, COALESCE(?, (SELECT scraped FROM shelves WHERE url = ?)))",
+                             (url, json.dumps(books), now, now if full_scrape else None, url))
+            self._db.execute("DELETE FROM shelves WHERE url IN (SELECT url FROM shelves ORDER BY updated DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+def get_shelf_cache():
+    global _shelf_cache
+    if not SHELF_CACHE_PATH:
+        return None
+    with _shelf_cache_lock:
+        if _shelf_cache is None:
+            try:
+                _shelf_cache = ShelfCache(SHELF_CACHE_PATH, SHELF_CACHE_MAX_ENTRIES)
+            except Exception as e:
+                print(f"Warn: Shelf cache unavailable ({e}). Continuing without it.")
+                return None
+        return _shelf_cache
+
+def shelf_supports_incremental(url):
+    query = parse_qs(urlsplit(url).query)
+    sort = query.get("sort", ["date_added"])[0]
+    order = query.get("order", ["d"])[0]
+    return sort in INCREMENTAL_SORTS and order != "a"
+
+def same_book_metadata(a, b):
+    return all(a.get(key) == b.get(key) for key in BOOK_METADATA_KEYS)
+
+# Returns (patched book list, new/changed books), or None when the delta can't be trusted and a
+# full scrape is needed. Unchanged rows keep their cached colors; the changed ones still need analysis.
+def refresh_shelf_books(url, cached_books, initial_html, total_books, progress):
+    cached_index = {book.get("review_id"): i for i, book in enumerate(cached_books) if book.get("review_id")}
+    head, changed = [], []
+    last_known_index = -1
+    page, html, per_page = 1, initial_html, None
+    while True:
+        page_books = parse_shelf_rows(html, progress.timings)
+        if not page_books:
+            break
+        per_page = per_page or len(page_books)
+        page_unchanged = True
+        for book in page_books:
+            i = cached_index.get(book["review_id"])
+            if i is not None and same_book_metadata(cached_books[i], book):
+                book["spine_color"] = cached_books[i].get("spine_color", book["spine_color"])
+                book["spine_text_color"] = cached_books[i].get("spine_text_color")
+                last_known_index = max(last_known_index, i)
+            else:
+                page_unchanged = False
+                changed.append(book)
+            head.append(book)
+        if page_unchanged or len(page_books) < per_page:
+            break
+        page += 1
+        try:
+            html = fetch_shelf_page(url, page, timings=progress.timings)
+        except requests.exceptions.RequestException as e:
+            print(f"Shelf cache: page {page} failed during refresh ({e}). Doing a full scrape.")
+            return None
+
+    seen_ids = {book["review_id"] for book in head}
+    tail = [book for book in cached_books[last_known_index + 1:] if book.get("review_id") not in seen_ids]
+    books = head + tail
+    if total_books and len(books) != total_books:
+        print(f"Shelf cache: delta gave {len(books)} books but shelf reports {total_books}. Doing a full scrape.")
+        return None
 
-            rows = soup.select('tr[id^="review_"]')
-            if not rows:
-                break
+    progress["total_books"] = progress["books_parsed"] = max(1, len(books))
+    progress["books_processed"] = len(books) - len(changed)
+    print(f"Shelf cache: {len(changed)} new/changed books found in {page} page(s).")
+    return books, changed
+
+# Re-emits books in shelf order. pages maps page number -> books and may still be filling in
+# while finished_books runs; a book is released once it and every book before it is finished.
+def iter_in_shelf_order(pages, finished_books, already_finished=()):
+    finished = {id(book) for book in already_finished}
+    next_page, next_row = 1, 0
+
+    def release():
+        nonlocal next_page, next_row
+        while next_page in pages:
+            page_books = pages[next_page]
+            if next_row >= len(page_books):
+                next_page, next_row = next_page + 1, 0
+            elif id(page_books[next_row]) in finished:
+                yield page_books[next_row]
+                next_row += 1
+            else:
+                return
+
+    yield from release()
+    for book in finished_books:
+        finished.add(id(book))
+        yield from release()
+    # Anything still held back sits behind a page that failed to load.
+    for page in sorted(p for p in pages if p >= next_page):
+        yield from pages[page][next_row if page == next_page else 0:]
+
+# --- Helper Function: iter_books_from_shelf / get_books_from_shelf ---
+# Yields books in shelf order as soon as their colors are known; progress is updated along the way.
+def iter_books_from_shelf(url, progress=None):
+    progress = progress if progress is not None else JobProgress()
+    shelf_cache = get_shelf_cache()
+    cached = shelf_cache.get(url) if shelf_cache else None
+
+    def counted(finished_books):
+        for book in finished_books:
+            progress.increment("books_processed")
+            yield book
 
-            for row in rows:
-                title_elem = row.select_one('td.field.title .value a')
-                author_elem = row.select_one('td.field.author .value a')
-
-                if title_elem and author_elem:
-                    book_title = title_elem.text.strip()
-                    author_text = author_elem.text.strip()
-                    if ', ' in author_text:
-                        parts = author_text.split(', ', 1)
-                        author_name = f"{parts[1]} {parts[0]}" if len(parts) == 2 else author_text
-                    else:
-                        author_name = author_text
-
-                    image_elem = row.select_one('td.field.cover img')
-                    publisher_elem = row.select_one('td.field.publisher .value')
-                    page_count_elem = row.select_one(PAGE_COUNT_SELECTOR)
-                    rating_elem = row.select_one(RATING_SELECTOR)
-                    review_container_elem = row.select_one(REVIEW_SELECTOR)
-                    review_text = ""
-                    if review_container_elem:
-                        review_parts = [elem.text for elem in review_container_elem.find_all(string=True, recursive=False)]
-                        review_text = ' '.join(review_parts).strip()
-                        review_text = re.sub(r'\s*\.\.\.\(more\)$', '', review_text)
-
-                    publisher_name = publisher_elem.text.strip() if publisher_elem else ""
-                    page_count = DEFAULT_PAGE_COUNT
-                    if page_count_elem:
-                        page_text_raw = page_count_elem.text.strip()
-                        match = re.search(r'(\d{1,3}(?:,\d{3})*|\d+)\s*(?:pages?)?', page_text_raw.replace(',',''))
-                        if match:
-                            try: page_count = max(1, int(match.group(1)))
-                            except ValueError: pass
-
-                    rating_value = None
-                    if rating_elem and rating_elem.has_attr("title"):
-                        rating_value = rating_elem["title"].strip()
-
-                    raw_image_url = image_elem.get("src") if image_elem else ""
-                    high_res_image_url = raw_image_url
-                    if raw_image_url:
-                        high_res_image_url = re.sub(r'\._S[XY]?\d+(_?\.|\.jpg)', '.', raw_image_url, count=1)
-
-                    spine_color = get_edge_color(high_res_image_url) if high_res_image_url and Image else "#808080"
-                    spine_text_color = get_contrasting_text_color(high_res_image_url, spine_color) if high_res_image_url and Image and colorgram else ('#000000' if get_luminance(*hex_to_rgb(spine_color)) > 0.5 else '#FFFFFF')
-
-                    books.append({
-                        "title": book_title,
-                        "author": author_name,
-                        "publisher": publisher_name,
-                        "image": high_res_image_url,
-                        "spine_color": spine_color,
-                        "spine_text_color": spine_text_color,
-                        "page_count": page_count,
-                        "rating": rating_value,
-                        "review": review_text
-                    })
-                    progress_data["books_processed"] = len(books)
-
-            page += 1
-
-        if not books and not progress_data.get("error"):
-            progress_data["error"] = "No valid books found."
-        progress_data["total_books"] = max(progress_data["total_books"], progress_data["books_processed"])
-        progress_data["complete"] = True
+    try:
+        if cached and time.time() - cached["updated"] < SHELF_CACHE_FRESH_SECONDS:
+            metrics.count("bookshelf_shelf_cache_requests_total", result="fresh")
+            progress["total_books"] = progress["books_parsed"] = progress["books_processed"] = max(1, len(cached["books"]))
+            for book in cached["books"]:
+                register_cover_url(book)
+                yield book
+            persist_cover_urls(cached["books"])
+            progress["complete"] = True
+            print(f"\nServed {len(cached['books'])} books from shelf cache.")
+            return
+
+        initial_html = fetch_shelf_page(url, 1, timeout=15, timings=progress.timings)
+        with timed("parse", progress.timings):
+            total_books = parse_total_books(initial_html)
+        progress["total_books"] = max(1, total_books)
+
+        refreshed = None
+        if cached and shelf_supports_incremental(url) and time.time() - cached["scraped"] < SHELF_CACHE_MAX_AGE:
+            refreshed = refresh_shelf_books(url, cached["books"], initial_html, total_books, progress)
+        if shelf_cache:
+            metrics.count("bookshelf_shelf_cache_requests_total", result="incremental" if refreshed is not None else "miss")
+        if refreshed is not None:
+            shelf_books, changed = refreshed
+            changed_ids = {id(book) for book in changed}
+            pages = {1: shelf_books}
+            finished_books = counted(iter_analyzed_covers(changed, progress.timings))
+            already_finished = [book for book in shelf_books if id(book) not in changed_ids]
+        else:
+            # Rows stream into the cover pipeline as each page lands.
+            progress["books_processed"] = 0
+            pages = {}
+            def books_as_pages_arrive():
+                for page, page_books in iter_shelf_pages(url, parse_shelf_rows(initial_html, progress.timings), total_books, progress):
+                    pages[page] = page_books
+                    progress.increment("books_parsed", len(page_books))
+                    yield from page_books
+            finished_books = counted(iter_analyzed_covers(books_as_pages_arrive(), progress.timings))
+            already_finished = ()
+
+        books = []
+        for book in iter_in_shelf_order(pages, finished_books, already_finished):
+            register_cover_url(book)
+            books.append(book)
+            yield book
+        persist_cover_urls(books)
+
+        if not books and not progress.get("error"):
+            progress["error"] = "No valid books found."
+        if books and shelf_cache and not progress.get("error"):
+            with timed("shelf_cache_write", progress.timings):
+                shelf_cache.put(url, books, full_scrape=refreshed is None)
+        progress["total_books"] = max(progress["total_books"], progress["books_processed"])
+        progress["complete"] = True
         print(f"\nScraping finished. Found: {len(books)} books.")
-        return books
+        if get_cover_cache(): print(f"Cover cache: {get_cover_cache().stats()}")
 
     except requests.exceptions.RequestException as req_err:
         print(f"Initial request failed: {req_err}")
-        progress_data["error"] = f"Error connecting to Goodreads: {req_err}"
-        progress_data["complete"] = True
-        return None
+        progress["error"] = f"Error connecting to Goodreads: {req_err}"
+        progress["complete"] = True
     except Exception as e:
         print(f"Unexpected scraping error in get_books_from_shelf: {e}")
         traceback.print_exc()
-        progress_data["error"] = str(e)
-        progress_data["complete"] = True
+        progress["error"] = str(e)
+        progress["complete"] = True
+
+def get_books_from_shelf(url, progress=None):
+    return list(iter_books_from_shelf(url, progress))
+
+
+# --- Goodreads Library Export Import ---
+# The library export CSV (My Books > Import and export) has every field the shelf pages give us
+# except the cover, so importing it costs no page fetches. Rows are streamed through csv.DictReader
+# into the same cover pipeline; covers are looked up lazily in the fetch threads (Open Library by
+# ISBN, then the Goodreads book page) and the URL found is remembered in the cover cache.
+CSV_IMPORT_SHELF = os.environ.get("CSV_IMPORT_SHELF", "read")
+CSV_RATING_TITLES = {1: "did not like it", 2: "it was ok", 3: "liked it", 4: "really liked it", 5: "it was amazing"}
+CSV_ISBN_PATTERN = re.compile(r'\b(?:[0-9]{13}|[0-9]{9}[0-9Xx])\b')
+CSV_REVIEW_BREAK_PATTERN = re.compile(r'(?:\s*<br\s*/?>)+\s*', re.IGNORECASE)
+OPEN_LIBRARY_COVER_URL = "https://covers.openlibrary.org/b/isbn/{isbn}-L.jpg?default=false"
+GOODREADS_BOOK_URL = "https://www.goodreads.com/book/show/{book_id}"
+OG_IMAGE_PATTERN = re.compile(r'<meta[^>]+property=["\']og:image["\'][^>]+content=["\']([^"\']+)')
+
+def csv_isbn(row):
+    for column in ("ISBN13", "ISBN"):
+        match = CSV_ISBN_PATTERN.search(row.get(column) or "") # exported as ="9780..."
+        if match:
+            return match.group(0)
+    return None
+
+def book_from_csv_row(row):
+    try: rating = CSV_RATING_TITLES.get(int(row.get("My Rating") or 0))
+    except ValueError: rating = None
+    review = row.get("My Review")
+    # "Author l-f" is "Last, First" like the shelf pages, so book_from_fields turns it the right way round.
+    book = book_from_fields(None, row.get("Title"), row.get("Author l-f") or row.get("Author"), None, row.get("Publisher"),
+                            row.get("Number of Pages") or None, rating, [CSV_REVIEW_BREAK_PATTERN.sub(' ', review)] if review else None)
+    if book is None:
         return None
+    book["book_id"] = (row.get("Book Id") or "").strip() or None # the export has no review ids
+    book["isbn"] = csv_isbn(row)
+    book["book_url"] = GOODREADS_BOOK_URL.format(book_id=book["book_id"]) if book["book_id"] else None
+    return book
+
+# lines: any iterable of CSV text lines (an open file, io.StringIO, ...).
+def iter_csv_books(lines, shelf=CSV_IMPORT_SHELF):
+    for row in csv.DictReader(lines):
+        if (row.get("Exclusive Shelf") or "").strip() != shelf:
+            continue
+        book = book_from_csv_row(row)
+        if book is not None:
+            yield book
+
+def find_cover_url(book):
+    if book.get("isbn"):
+        try:
+            response = get_http_session().head(OPEN_LIBRARY_COVER_URL.format(isbn=book["isbn"]), timeout=10, allow_redirects=True)
+            if response.ok:
+                return response.url
+        except requests.exceptions.RequestException as e:
+            print(f"Warn: Open Library lookup failed for {book['isbn']} ({e})")
+    try:
+        wait_for_host_slot(book["book_url"])
+        response = http_get(book["book_url"], headers=SHELF_HEADERS, timeout=10)
+        response.raise_for_status()
+        match = OG_IMAGE_PATTERN.search(response.text)
+        if match and "nophoto" not in match.group(1):
+            return match.group(1)
+    except requests.exceptions.RequestException as e:
+        print(f"Warn: Cover lookup failed for {book['book_url']} ({e})")
+    return None
+
+def resolve_cover_url(book, timings=None):
+    cache = get_cover_cache()
+    image_url = cache.get_lookup(book["book_url"]) if cache else None
+    if image_url is None:
+        metrics.count("bookshelf_cover_lookups_total", result="miss")
+        with timed("cover_lookup", timings):
+            image_url = find_cover_url(book)
+        if cache:
+            cache.put_lookup(book["book_url"], image_url)
+    else:
+        metrics.count("bookshelf_cover_lookups_total", result="hit")
+    return image_url or None
+
+def iter_books_from_csv(lines, progress=None):
+    progress = progress if progress is not None else JobProgress()
+    try:
+        progress["books_processed"] = 0
+        pages = {} # one row per "page", so rows are released in file order
+        def books_as_rows_arrive():
+            for book in iter_csv_books(lines):
+                pages[len(pages) + 1] = [book]
+                progress.increment("total_books")
+                progress.increment("books_parsed")
+                yield book
+
+        def counted(finished_books):
+            for book in finished_books:
+                progress.increment("books_processed")
+                yield book
+
+        books = []
+        for book in iter_in_shelf_order(pages, counted(iter_analyzed_covers(books_as_rows_arrive(), progress.timings))):
+            register_cover_url(book)
+            books.append(book)
+            yield book
+        persist_cover_urls(books)
+        if not books:
+            progress["error"] = f"No books on the '{CSV_IMPORT_SHELF}' shelf in this CSV."
+        progress["total_books"] = max(1, progress["total_books"])
+        progress["complete"] = True
+        print(f"\nCSV import finished. Found: {len(books)} books.")
+    except (csv.Error, UnicodeDecodeError) as e:
+        print(f"CSV import failed: {e}")
+        progress["error"] = f"Could not read CSV: {e}"
+        progress["complete"] = True
+    except Exception as e:
+        print(f"Unexpected error in iter_books_from_csv: {e}")
+        traceback.print_exc()
+        progress["error"] = str(e)
+        progress["complete"] = True
+
+def get_books_from_csv(path, progress=None):
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        return list(iter_books_from_csv(f, progress))
 
 
 # --- Flask App ---
@@ -290,6 +1731,96 @@ app = Flask(__name__)
 
 print("Test change - Version 1.2 (Fixed Regex Error)") # Version Bump
 
+# --- Response Compression & Caching ---
+# Text responses are compressed (brotli when installed and accepted, else gzip) and every GET 200
+# carries an ETag, so repeat loads revalidate with a 304. Compressed bodies are memoized by ETag,
+# which makes the page itself and re-fetched results free to serve after the first hit.
+# /stream is compressed incrementally, flushing after each line.
+GZIP_LEVEL = min(9, max(1, int(os.environ.get("GZIP_LEVEL", 6))))
+BROTLI_QUALITY = min(11, max(0, int(os.environ.get("BROTLI_QUALITY", 5))))
+COMPRESS_MIN_BYTES = 1024
+COMPRESSED_CACHE_MAX_BYTES = max(0, int(os.environ.get("COMPRESSED_CACHE_MAX_BYTES", 16 * 1024 * 1024)))
+COMPRESSIBLE_MIMETYPES = {"text/html", "text/plain", "application/json", "application/x-ndjson"}
+_compressed_bodies = OrderedDict()
+_compressed_bytes = 0
+_compressed_lock = threading.Lock()
+
+def negotiate_encoding():
+    if brotli is not None and request.accept_encodings.quality("br") > 0:
+        return "br"
+    if request.accept_encodings.quality("gzip") > 0:
+        return "gzip"
+    return None
+
+def compress_body(etag, data, encoding):
+    global _compressed_bytes
+    key = (etag, encoding)
+    with _compressed_lock:
+        if key in _compressed_bodies:
+            _compressed_bodies.move_to_end(key)
+            return _compressed_bodies[key]
+    body = brotli.compress(data, quality=BROTLI_QUALITY) if encoding == "br" else gzip.compress(data, GZIP_LEVEL, mtime=0)
+    if len(body) <= COMPRESSED_CACHE_MAX_BYTES:
+        with _compressed_lock:
+            if key not in _compressed_bodies:
+                _compressed_bodies[key] = body
+                _compressed_bytes += len(body)
+            while _compressed_bytes > COMPRESSED_CACHE_MAX_BYTES:
+                _compressed_bytes -= len(_compressed_bodies.popitem(last=False)[1])
+    return body
+
+def compress_chunks(chunks, encoding):
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        for chunk in chunks:
+            yield compressor.process(chunk.encode("utf-8")) + compressor.flush()
+        yield compressor.finish()
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31) # 31: gzip container
+        for chunk in chunks:
+            yield compressor.compress(chunk.encode("utf-8")) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+@app.after_request
+def compress_and_tag(response):
+    if request.method != "GET" or response.status_code != 200 or response.is_streamed or response.direct_passthrough or "Content-Encoding" in response.headers:
+        return response
+    if "ETag" not in response.headers:
+        response.add_etag()
+    response.make_conditional(request)
+    if response.status_code != 200 or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate_encoding()
+    if encoding is None or response.content_length < COMPRESS_MIN_BYTES:
+        return response
+    etag, _ = response.get_etag()
+    response.set_data(compress_body(etag, response.get_data(), encoding))
+    response.headers["Content-Encoding"] = encoding
+    response.set_etag(etag, weak=True) # same resource, different bytes
+    return response
+
+# Compact /result payload (?format=columns) and export format: one array per field instead of one
+# object per book, and fields with many repeats (author, publisher, rating, colors) dictionary-encoded.
+# Decoded by decodeShelfPayload in the template.
+def encode_book_columns(books):
+    fields = list(dict.fromkeys(key for book in books for key in book))
+    columns = {}
+    for field in fields:
+        values = [book.get(field) for book in books]
+        distinct = list(dict.fromkeys(values))
+        if len(distinct) * 2 <= len(values):
+            position = {value: i for i, value in enumerate(distinct)}
+            columns[field] = {"dict": distinct, "index": [position[value] for value in values]}
+        else:
+            columns[field] = values
+    return {"count": len(books), "columns": columns}
+
+def books_payload(books):
+    if request.args.get("format") == "columns":
+        return {"shelf": encode_book_columns(books)}
+    return {"books": books}
+
 # --- HTML Template ---
 THREE_TEMPLATE = '''<!DOCTYPE html>
 <html lang="en">
@@ -306,6 +1837,8 @@ THREE_TEMPLATE = '''<!DOCTYPE html>
         #input-container input[type=text]:focus { border-color: #4CAF50; outline: none; }
         #input-container button { padding: 12px 24px; background-color: #4CAF50; color: #fff; border: none; border-radius: 6px; cursor: pointer; font-size: 1em; transition: background-color 0.2s ease; }
         #input-container button:hover { background-color: #45a049; }
+        #csv-label { display: block; margin-bottom: 20px; font-size: 0.9em; color: #666; }
+        #csv-label input { display: block; margin: 8px auto 0; }
         /* Canvas Container */
         #canvas-container { width: 100%; height: 100%; position: fixed; top: 0; left: 0; z-index: 1; }
         canvas { display: block; }
@@ -342,7 +1875,7 @@ THREE_TEMPLATE = '''<!DOCTYPE html>
 </head>
 <body>
     <div id="info"> <h1>My 3D Reading Journey</h1> <div id="stats"></div> </div>
-    <div id="input-container"> <h2>Enter Goodreads Shelf URL</h2> <form id="shelfForm"> <input type="text" id="shelfUrl" name="url" required placeholder="https://www.goodreads.com/review/list/..."> <button type="submit">Load Bookshelf</button> </form> </div>
+    <div id="input-container"> <h2>Enter Goodreads Shelf URL</h2> <form id="shelfForm"> <input type="text" id="shelfUrl" name="url" placeholder="https://www.goodreads.com/review/list/..."> <label id="csv-label" for="csvFile">or upload your library export CSV <input type="file" id="csvFile" name="file" accept=".csv,text/csv"></label> <button type="submit">Load Bookshelf</button> </form> </div>
     <div id="loading-message" style="display:none"> <div id="status-text">Fetching data...</div> <div id="progress-bar"><div id="progress-fill">0%</div></div> </div>
     <div id="canvas-container"></div>
 
@@ -364,34 +1897,184 @@ THREE_TEMPLATE = '''<!DOCTYPE html>
         { "imports": { "three": "https://unpkg.com/three@0.163.0/build/three.module.js", "three/addons/": "https://unpkg.com/three@0.163.0/examples/jsm/" } }
     {% endraw %}</script>
 
+    <script>window.BOOKSHELF_BOOK = {{ book_config|tojson }}; window.BOOKSHELF_STATIC = {{ static_config|tojson }};</script>
     <script type="module">{% raw %}
         import * as THREE from 'three';
 
         // --- Constants ---
-        const BOOK_DEFAULTS = { HEIGHT: 9.0, WIDTH: 6.075, THICKNESS: 1.125 }; const PAGE_COLOR = 0xf5f5dc; const BOOK_SPACING = -6; const TARGET_ROTATION_X = THREE.MathUtils.degToRad(-90); const TARGET_ROTATION_Y = THREE.MathUtils.degToRad(88); const CAMERA_Z = 30; const CAMERA_Y = 6; const CAMERA_FOV = 35; const ANIM_START_X = 40; const ANIM_DURATION = 0.7; const ANIM_STAGGER = 0.03; const ANIM_EASE = "back.out(0.5)"; const SPINE_TEXTURE_HEIGHT = 450; const SPINE_FONT_FAMILY = 'Arial, sans-serif'; const SPINE_TITLE_SIZE_PX = 14; const SPINE_AUTHOR_SIZE_PX = 9; const SPINE_PUBLISHER_SIZE_PX = 6; const SPINE_PADDING_PX = 15; const SPINE_AUTHOR_PADDING_PX = 5; const SPINE_TEXT_OPACITY = 0.75; const SPINE_TITLE_LINE_HEIGHT = SPINE_TITLE_SIZE_PX * 1.1; const SPINE_AUTHOR_LINE_HEIGHT = SPINE_AUTHOR_SIZE_PX * 1.1; const SPINE_AUTHOR_MAX_LINES = 4; const SPINE_TITLE_MAX_LINES = 2; const SPINE_EDGE_WIDTH = 8; const SPINE_HIGHLIGHT_OPACITY = 0.4; const SPINE_SHADOW_OPACITY = 0.3; const MIN_THICKNESS = 0.2; const MAX_THICKNESS = 4.0; const AVG_PAGE_COUNT = 350; const BACK_TEXTURE_WIDTH = 300; const BACK_SCRIBBLE_OPACITY = 0.75; const BACK_SCRIBBLE_BLUR = 'blur(0.5px)'; const BACK_SCRIBBLE_LINES = 50; const BACK_SCRIBBLE_LINE_HEIGHT = 5; const MATTE_ROUGHNESS = 0.98; const MATTE_METALNESS = 0.01; const HOVER_SCALE = 1.1; const HOVER_Z_OFFSET = 1.0; const HOVER_DURATION = 0.3; const DETAIL_ANIM_DURATION = 0.7; const DETAIL_BOOK_TARGET_POS = new THREE.Vector3(-10, 0, 15); const DETAIL_BOOK_TARGET_ROT = new THREE.Euler( THREE.MathUtils.degToRad(-10), THREE.MathUtils.degToRad(20), 0, 'YXZ' ); const DETAIL_BOOK_TARGET_SCALE = 1.5; const OTHER_BOOKS_FLY_X_OFFSET = 60; const OTHER_BOOKS_FADE_SCALE = 0.01; const DETAIL_VIEW = { BOOK: { POSITION: new THREE.Vector3(-8, 0, 10), ROTATION: new THREE.Euler( THREE.MathUtils.degToRad(-5), THREE.MathUtils.degToRad(25), 0, 'YXZ' ), SCALE: 2.0, ANIMATION_DURATION: 1.2, EASE: "power3.inOut" }, OTHER_BOOKS: { FADE_DURATION: 0.4, STAGGER: 0.02, EXIT_X: 40 } };
+        const { BOOK_DEFAULTS, MIN_THICKNESS, MAX_THICKNESS, AVG_PAGE_COUNT, SPINE_TEXTURE_HEIGHT, SPINE_TITLE_SIZE_PX, SPINE_AUTHOR_SIZE_PX, SPINE_PUBLISHER_SIZE_PX, SPINE_PADDING_PX, SPINE_AUTHOR_PADDING_PX, SPINE_EDGE_WIDTH, SPINE_TEXT_OPACITY, SPINE_HIGHLIGHT_OPACITY, SPINE_SHADOW_OPACITY, SPINE_TITLE_MAX_LINES, SPINE_AUTHOR_MAX_LINES, SPINE_LINE_SPACING, BACK_TEXTURE_WIDTH, BACK_SCRIBBLE_OPACITY, BACK_SCRIBBLE_LINE_HEIGHT } = window.BOOKSHELF_BOOK; const PAGE_COLOR = 0xf5f5dc; const BOOK_SPACING = -6; const TARGET_ROTATION_X = THREE.MathUtils.degToRad(-90); const TARGET_ROTATION_Y = THREE.MathUtils.degToRad(88); const CAMERA_Z = 30; const CAMERA_Y = 6; const CAMERA_FOV = 35; const ANIM_START_X = 40; const ANIM_DURATION = 0.7; const ANIM_STAGGER = 0.03; const ANIM_EASE = "back.out(0.5)"; const SPINE_FONT_FAMILY = 'Arial, sans-serif'; const SPINE_TITLE_LINE_HEIGHT = SPINE_TITLE_SIZE_PX * SPINE_LINE_SPACING; const SPINE_AUTHOR_LINE_HEIGHT = SPINE_AUTHOR_SIZE_PX * SPINE_LINE_SPACING; const BACK_SCRIBBLE_BLUR = 'blur(0.5px)'; const BACK_SCRIBBLE_LINES = 50; const MATTE_ROUGHNESS = 0.98; const MATTE_METALNESS = 0.01; const HOVER_SCALE = 1.1; const HOVER_Z_OFFSET = 1.0; const HOVER_DURATION = 0.3; const DETAIL_ANIM_DURATION = 0.7; const DETAIL_BOOK_TARGET_POS = new THREE.Vector3(-10, 0, 15); const DETAIL_BOOK_TARGET_ROT = new THREE.Euler( THREE.MathUtils.degToRad(-10), THREE.MathUtils.degToRad(20), 0, 'YXZ' ); const DETAIL_BOOK_TARGET_SCALE = 1.5; const OTHER_BOOKS_FLY_X_OFFSET = 60; const LARGE_SHELF_THRESHOLD = 300; const ATLAS_CHUNK_SIZE = 256; const ATLAS_SPINE_CELL = [32, 256, 64]; const ATLAS_BACK_CELL = [32, 48, 16]; const ATLAS_COVER_CELL = [64, 96, 16]; const ATLAS_COVER_SIZE = 64; const ATLAS_FLUSH_MS = 250; const ATLAS_PAINT_BUDGET = 24; const VIRTUAL_WINDOW_MARGIN = 60; const VIRTUAL_WINDOW_KEEP = 10; const OTHER_BOOKS_FADE_SCALE = 0.01; const DETAIL_VIEW = { BOOK: { POSITION: new THREE.Vector3(-8, 0, 10), ROTATION: new THREE.Euler( THREE.MathUtils.degToRad(-5), THREE.MathUtils.degToRad(25), 0, 'YXZ' ), SCALE: 2.0, ANIMATION_DURATION: 1.2, EASE: "power3.inOut" }, OTHER_BOOKS: { FADE_DURATION: 0.4, STAGGER: 0.02, EXIT_X: 40 } };
 
         // --- DOM Elements ---
-        const inputContainer=document.getElementById('input-container'); const loadingMessage=document.getElementById('loading-message'); const shelfForm=document.getElementById('shelfForm'); const shelfUrlInput=document.getElementById('shelfUrl'); const statsDiv=document.getElementById('stats'); const canvasContainer=document.getElementById('canvas-container'); const progressBarFill=document.getElementById('progress-fill'); const statusText=document.getElementById('status-text'); const detailViewDiv = document.getElementById('detail-view'); const detailTitle = document.getElementById('detail-title'); const detailAuthor = document.getElementById('detail-author'); const detailPublisher = document.getElementById('detail-publisher'); const detailPageCount = document.getElementById('detail-page-count'); const closeDetailButton = document.getElementById('close-detail-button');
+        const inputContainer=document.getElementById('input-container'); const loadingMessage=document.getElementById('loading-message'); const shelfForm=document.getElementById('shelfForm'); const shelfUrlInput=document.getElementById('shelfUrl'); const csvFileInput=document.getElementById('csvFile'); const statsDiv=document.getElementById('stats'); const canvasContainer=document.getElementById('canvas-container'); const progressBarFill=document.getElementById('progress-fill'); const statusText=document.getElementById('status-text'); const detailViewDiv = document.getElementById('detail-view'); const detailTitle = document.getElementById('detail-title'); const detailAuthor = document.getElementById('detail-author'); const detailPublisher = document.getElementById('detail-publisher'); const detailPageCount = document.getElementById('detail-page-count'); const closeDetailButton = document.getElementById('close-detail-button');
         const detailRatingValue = document.getElementById('detail-rating-value'); const detailReviewValue = document.getElementById('detail-review-value');
 
 
         // --- Three.js Variables ---
-        let scene, camera, renderer; let bookData=[]; const textureLoader=new THREE.TextureLoader(); const booksGroup=new THREE.Group(); let currentScrollY=window.scrollY; let targetGroupY=0; let animationFrameId=null; let progressIntervalId=null; const raycaster = new THREE.Raycaster(); const mouse = new THREE.Vector2(); let currentlyHovered = null; let isDetailView = false; let selectedBookIndex = -1; let selectedBookMesh = null; let isTransitioning = false;
+        let scene, camera, renderer; let bookData=[]; const textureLoader=new THREE.TextureLoader(); const booksGroup=new THREE.Group(); let currentScrollY=window.scrollY; let targetGroupY=0; let animationFrameId=null; let progressIntervalId=null; let currentJobId=null; const shelfLayout = { tops: [], bottoms: [] }; const bookMeshes = new Map(); const virtualWindow = { first: 0, last: -1 }; const raycaster = new THREE.Raycaster(); const mouse = new THREE.Vector2(); let currentlyHovered = null; let isDetailView = false; let selectedBookIndex = -1; let selectedBookMesh = null; let isTransitioning = false; let largeShelf = null; let hoveredBookIndex = -1; const instanceDummy = new THREE.Object3D(); instanceDummy.rotation.order = 'YXZ'; const ZERO_MATRIX = new THREE.Matrix4().makeScale(0, 0, 0);
 
         // --- Helper Functions ---
         function hexToRgba(hex, alpha) { hex = String(hex || '').replace('#', ''); const r = parseInt(hex.substring(0, 2), 16); const g = parseInt(hex.substring(2, 4), 16); const b = parseInt(hex.substring(4, 6), 16); if (isNaN(r) || isNaN(g) || isNaN(b)) return `rgba(128, 128, 128, ${alpha})`; return `rgba(${r}, ${g}, ${b}, ${alpha})`; }
         function wrapText(context, text, maxWidth) { const words = String(text || '').split(' '); let line = ''; const lines = []; for(let n = 0; n < words.length; n++) { const testLine = line + words[n] + ' '; const metrics = context.measureText(testLine); const testWidth = metrics.width; if (testWidth > maxWidth && n > 0) { lines.push(line.trim()); line = words[n] + ' '; } else { line = testLine; } } lines.push(line.trim()); return lines; }
-        function createSpineTexture(book, widthPx, heightPx) { widthPx = Math.max(1, Math.round(widthPx)); heightPx = Math.max(1, Math.round(heightPx)); const canvas = document.createElement('canvas'); canvas.width = widthPx; canvas.height = heightPx; const ctx = canvas.getContext('2d'); if (!ctx) return null; try { ctx.fillStyle = book.spine_color || '#808080'; ctx.fillRect(0, 0, widthPx, heightPx); const shadowGradient = ctx.createLinearGradient(0, 0, SPINE_EDGE_WIDTH, 0); shadowGradient.addColorStop(0, `rgba(0, 0, 0, ${SPINE_SHADOW_OPACITY})`); shadowGradient.addColorStop(1, 'rgba(0, 0, 0, 0)'); ctx.fillStyle = shadowGradient; ctx.fillRect(0, 0, SPINE_EDGE_WIDTH, heightPx); const highlightGradient = ctx.createLinearGradient(widthPx - SPINE_EDGE_WIDTH, 0, widthPx, 0); highlightGradient.addColorStop(0, 'rgba(255, 255, 255, 0)'); highlightGradient.addColorStop(1, `rgba(255, 255, 255, ${SPINE_HIGHLIGHT_OPACITY})`); ctx.fillStyle = highlightGradient; ctx.fillRect(widthPx - SPINE_EDGE_WIDTH, 0, SPINE_EDGE_WIDTH, heightPx); ctx.fillStyle = book.spine_text_color || '#FFFFFF'; ctx.save(); ctx.translate(widthPx / 2, heightPx / 2); ctx.rotate(Math.PI / 2); ctx.translate(-heightPx / 2, -widthPx / 2); const drawWidth = heightPx; const drawHeight = widthPx; if (book.publisher) { ctx.font = `${SPINE_PUBLISHER_SIZE_PX}px ${SPINE_FONT_FAMILY}`; ctx.textAlign = 'left'; ctx.textBaseline = 'top'; ctx.globalAlpha = SPINE_TEXT_OPACITY; let pubText = book.publisher; const maxPubWidth = drawWidth - (SPINE_PADDING_PX * 2); if (ctx.measureText(pubText).width > maxPubWidth) { pubText = pubText.substring(0, Math.floor(maxPubWidth / (SPINE_PUBLISHER_SIZE_PX * 0.6))) + "..."; } ctx.fillText(pubText, SPINE_PADDING_PX, SPINE_PADDING_PX); ctx.globalAlpha = 1.0; } ctx.font = `bold ${SPINE_TITLE_SIZE_PX}px ${SPINE_FONT_FAMILY}`; ctx.textAlign = 'center'; ctx.textBaseline = 'middle'; const maxTitleWidth = drawWidth * 0.75; const titleText = book.title || ''; let titleLines = wrapText(ctx, titleText, maxTitleWidth); const requiredHeightForTwoLines = 2 * SPINE_TITLE_LINE_HEIGHT; const availableDrawHeight = drawHeight - (SPINE_PADDING_PX * 2); if (titleLines.length > 1 && requiredHeightForTwoLines > availableDrawHeight) { titleLines = [ wrapText(ctx, titleText, maxTitleWidth)[0] ]; if (ctx.measureText(titleLines[0]).width > maxTitleWidth) { let line = titleLines[0]; const ellipsis = "..."; const ellipsisWidth = ctx.measureText(ellipsis).width; while (ctx.measureText(line).width + ellipsisWidth > maxTitleWidth && line.length > 0) { line = line.slice(0, -1); } titleLines[0] = line.trim() + ellipsis; } } else if (titleLines.length > SPINE_TITLE_MAX_LINES) { titleLines = titleLines.slice(0, SPINE_TITLE_MAX_LINES); let lastLine = titleLines[SPINE_TITLE_MAX_LINES - 1]; const ellipsis = "..."; const ellipsisWidth = ctx.measureText(ellipsis).width; while (ctx.measureText(lastLine).width + ellipsisWidth > maxTitleWidth && lastLine.length > 0) { lastLine = lastLine.slice(0, -1); } titleLines[SPINE_TITLE_MAX_LINES - 1] = lastLine.trim() + ellipsis; } const totalTitleHeight = titleLines.length * SPINE_TITLE_LINE_HEIGHT; let currentTitleY = (drawHeight / 2) - (totalTitleHeight / 2) + (SPINE_TITLE_LINE_HEIGHT / 2); titleLines.forEach(line => { ctx.fillText(line, drawWidth / 2, currentTitleY); currentTitleY += SPINE_TITLE_LINE_HEIGHT; }); ctx.font = `${SPINE_AUTHOR_SIZE_PX}px ${SPINE_FONT_FAMILY}`; ctx.globalAlpha = SPINE_TEXT_OPACITY; const authorText = book.author || ''; const maxAuthorDrawWidth = drawHeight - (SPINE_AUTHOR_PADDING_PX * 2); let authorLines = wrapText(ctx, authorText, maxAuthorDrawWidth); if (authorLines.length > SPINE_AUTHOR_MAX_LINES) { authorLines = authorLines.slice(0, SPINE_AUTHOR_MAX_LINES); let lastLine = authorLines[SPINE_AUTHOR_MAX_LINES - 1]; const ellipsis = "..."; const ellipsisWidth = ctx.measureText(ellipsis).width; while (ctx.measureText(lastLine).width + ellipsisWidth > maxAuthorDrawWidth && lastLine.length > 0) { lastLine = lastLine.slice(0, -1); } authorLines[SPINE_AUTHOR_MAX_LINES - 1] = lastLine.trim() + ellipsis; } ctx.save(); ctx.translate(drawWidth - SPINE_PADDING_PX, drawHeight / 2); ctx.rotate(-Math.PI / 2); ctx.textAlign = 'center'; ctx.textBaseline = 'bottom'; let currentAuthorY = (authorLines.length -1) * SPINE_AUTHOR_LINE_HEIGHT / 2; for (let i = authorLines.length - 1; i >= 0; i--) { ctx.fillText(authorLines[i], 0, currentAuthorY); currentAuthorY -= SPINE_AUTHOR_LINE_HEIGHT; } ctx.restore(); ctx.restore(); ctx.globalAlpha = 1.0; } catch (error) { console.error("Error creating spine texture:", error); ctx.fillStyle = 'red'; ctx.fillRect(0, 0, widthPx, heightPx); } const texture = new THREE.CanvasTexture(canvas); texture.colorSpace = THREE.SRGBColorSpace; texture.needsUpdate = true; return texture; }
-        function createBackTexture(book, widthPx, heightPx) { widthPx = Math.max(1, Math.round(widthPx)); heightPx = Math.max(1, Math.round(heightPx)); const canvas = document.createElement('canvas'); canvas.width = widthPx; canvas.height = heightPx; const ctx = canvas.getContext('2d'); if (!ctx) return null; try { ctx.fillStyle = book.spine_color || '#DDDDDD'; ctx.fillRect(0, 0, widthPx, heightPx); ctx.strokeStyle = hexToRgba(book.spine_text_color || '#000000', BACK_SCRIBBLE_OPACITY); ctx.lineWidth = 0.7; ctx.filter = BACK_SCRIBBLE_BLUR; const padding = widthPx * 0.1; const lineLengthVariation = widthPx * 0.2; const lineStartXVariation = widthPx * 0.05; let currentY = padding; while (currentY < heightPx - padding) { const startX = padding + Math.random() * lineStartXVariation; const endX = widthPx - padding - Math.random() * lineLengthVariation; ctx.beginPath(); ctx.moveTo(startX, currentY); ctx.lineTo(endX, currentY); ctx.stroke(); currentY += BACK_SCRIBBLE_LINE_HEIGHT * (0.8 + Math.random() * 0.4); if (Math.random() < 0.1) { currentY += BACK_SCRIBBLE_LINE_HEIGHT * 1.5; } } ctx.filter = 'none'; } catch (error) { console.error("Error creating back texture:", error); ctx.fillStyle = 'red'; ctx.fillRect(0, 0, widthPx, heightPx); } const texture = new THREE.CanvasTexture(canvas); texture.colorSpace = THREE.SRGBColorSpace; texture.needsUpdate = true; return texture; }
+        function paintSpine(ctx, book, widthPx, heightPx) { try { ctx.fillStyle = book.spine_color || '#808080'; ctx.fillRect(0, 0, widthPx, heightPx); const shadowGradient = ctx.createLinearGradient(0, 0, SPINE_EDGE_WIDTH, 0); shadowGradient.addColorStop(0, `rgba(0, 0, 0, ${SPINE_SHADOW_OPACITY})`); shadowGradient.addColorStop(1, 'rgba(0, 0, 0, 0)'); ctx.fillStyle = shadowGradient; ctx.fillRect(0, 0, SPINE_EDGE_WIDTH, heightPx); const highlightGradient = ctx.createLinearGradient(widthPx - SPINE_EDGE_WIDTH, 0, widthPx, 0); highlightGradient.addColorStop(0, 'rgba(255, 255, 255, 0)'); highlightGradient.addColorStop(1, `rgba(255, 255, 255, ${SPINE_HIGHLIGHT_OPACITY})`); ctx.fillStyle = highlightGradient; ctx.fillRect(widthPx - SPINE_EDGE_WIDTH, 0, SPINE_EDGE_WIDTH, heightPx); ctx.fillStyle = book.spine_text_color || '#FFFFFF'; ctx.save(); ctx.translate(widthPx / 2, heightPx / 2); ctx.rotate(Math.PI / 2); ctx.translate(-heightPx / 2, -widthPx / 2); const drawWidth = heightPx; const drawHeight = widthPx; if (book.publisher) { ctx.font = `${SPINE_PUBLISHER_SIZE_PX}px ${SPINE_FONT_FAMILY}`; ctx.textAlign = 'left'; ctx.textBaseline = 'top'; ctx.globalAlpha = SPINE_TEXT_OPACITY; let pubText = book.publisher; const maxPubWidth = drawWidth - (SPINE_PADDING_PX * 2); if (ctx.measureText(pubText).width > maxPubWidth) { pubText = pubText.substring(0, Math.floor(maxPubWidth / (SPINE_PUBLISHER_SIZE_PX * 0.6))) + "..."; } ctx.fillText(pubText, SPINE_PADDING_PX, SPINE_PADDING_PX); ctx.globalAlpha = 1.0; } ctx.font = `bold ${SPINE_TITLE_SIZE_PX}px ${SPINE_FONT_FAMILY}`; ctx.textAlign = 'center'; ctx.textBaseline = 'middle'; const maxTitleWidth = drawWidth * 0.75; const titleText = book.title || ''; let titleLines = wrapText(ctx, titleText, maxTitleWidth); const requiredHeightForTwoLines = 2 * SPINE_TITLE_LINE_HEIGHT; const availableDrawHeight = drawHeight - (SPINE_PADDING_PX * 2); if (titleLines.length > 1 && requiredHeightForTwoLines > availableDrawHeight) { titleLines = [ wrapText(ctx, titleText, maxTitleWidth)[0] ]; if (ctx.measureText(titleLines[0]).width > maxTitleWidth) { let line = titleLines[0]; const ellipsis = "..."; const ellipsisWidth = ctx.measureText(ellipsis).width; while (ctx.measureText(line).width + ellipsisWidth > maxTitleWidth && line.length > 0) { line = line.slice(0, -1); } titleLines[0] = line.trim() + ellipsis; } } else if (titleLines.length > SPINE_TITLE_MAX_LINES) { titleLines = titleLines.slice(0, SPINE_TITLE_MAX_LINES); let lastLine = titleLines[SPINE_TITLE_MAX_LINES - 1]; const ellipsis = "..."; const ellipsisWidth = ctx.measureText(ellipsis).width; while (ctx.measureText(lastLine).width + ellipsisWidth > maxTitleWidth && lastLine.length > 0) { lastLine = lastLine.slice(0, -1); } titleLines[SPINE_TITLE_MAX_LINES - 1] = lastLine.trim() + ellipsis; } const totalTitleHeight = titleLines.length * SPINE_TITLE_LINE_HEIGHT; let currentTitleY = (drawHeight / 2) - (totalTitleHeight / 2) + (SPINE_TITLE_LINE_HEIGHT / 2); titleLines.forEach(line => { ctx.fillText(line, drawWidth / 2, currentTitleY); currentTitleY += SPINE_TITLE_LINE_HEIGHT; }); ctx.font = `${SPINE_AUTHOR_SIZE_PX}px ${SPINE_FONT_FAMILY}`; ctx.globalAlpha = SPINE_TEXT_OPACITY; const authorText = book.author || ''; const maxAuthorDrawWidth = drawHeight - (SPINE_AUTHOR_PADDING_PX * 2); let authorLines = wrapText(ctx, authorText, maxAuthorDrawWidth); if (authorLines.length > SPINE_AUTHOR_MAX_LINES) { authorLines = authorLines.slice(0, SPINE_AUTHOR_MAX_LINES); let lastLine = authorLines[SPINE_AUTHOR_MAX_LINES - 1]; const ellipsis = "..."; const ellipsisWidth = ctx.measureText(ellipsis).width; while (ctx.measureText(lastLine).width + ellipsisWidth > maxAuthorDrawWidth && lastLine.length > 0) { lastLine = lastLine.slice(0, -1); } authorLines[SPINE_AUTHOR_MAX_LINES - 1] = lastLine.trim() + ellipsis; } ctx.save(); ctx.translate(drawWidth - SPINE_PADDING_PX, drawHeight / 2); ctx.rotate(-Math.PI / 2); ctx.textAlign = 'center'; ctx.textBaseline = 'bottom'; let currentAuthorY = (authorLines.length -1) * SPINE_AUTHOR_LINE_HEIGHT / 2; for (let i = authorLines.length - 1; i >= 0; i--) { ctx.fillText(authorLines[i], 0, currentAuthorY); currentAuthorY -= SPINE_AUTHOR_LINE_HEIGHT; } ctx.restore(); ctx.restore(); ctx.globalAlpha = 1.0; } catch (error) { console.error("Error creating spine texture:", error); ctx.fillStyle = 'red'; ctx.fillRect(0, 0, widthPx, heightPx); } }
+        function createSpineTexture(book, widthPx, heightPx) { widthPx = Math.max(1, Math.round(widthPx)); heightPx = Math.max(1, Math.round(heightPx)); const canvas = document.createElement('canvas'); canvas.width = widthPx; canvas.height = heightPx; const ctx = canvas.getContext('2d'); if (!ctx) return null; paintSpine(ctx, book, widthPx, heightPx);  const texture = new THREE.CanvasTexture(canvas); texture.colorSpace = THREE.SRGBColorSpace; texture.needsUpdate = true; return texture; }
+        function paintBack(ctx, book, widthPx, heightPx) { try { ctx.fillStyle = book.spine_color || '#DDDDDD'; ctx.fillRect(0, 0, widthPx, heightPx); ctx.strokeStyle = hexToRgba(book.spine_text_color || '#000000', BACK_SCRIBBLE_OPACITY); ctx.lineWidth = 0.7; ctx.filter = BACK_SCRIBBLE_BLUR; const padding = widthPx * 0.1; const lineLengthVariation = widthPx * 0.2; const lineStartXVariation = widthPx * 0.05; let currentY = padding; while (currentY < heightPx - padding) { const startX = padding + Math.random() * lineStartXVariation; const endX = widthPx - padding - Math.random() * lineLengthVariation; ctx.beginPath(); ctx.moveTo(startX, currentY); ctx.lineTo(endX, currentY); ctx.stroke(); currentY += BACK_SCRIBBLE_LINE_HEIGHT * (0.8 + Math.random() * 0.4); if (Math.random() < 0.1) { currentY += BACK_SCRIBBLE_LINE_HEIGHT * 1.5; } } ctx.filter = 'none'; } catch (error) { console.error("Error creating back texture:", error); ctx.fillStyle = 'red'; ctx.fillRect(0, 0, widthPx, heightPx); } }
+        function createBackTexture(book, widthPx, heightPx) { widthPx = Math.max(1, Math.round(widthPx)); heightPx = Math.max(1, Math.round(heightPx)); const canvas = document.createElement('canvas'); canvas.width = widthPx; canvas.height = heightPx; const ctx = canvas.getContext('2d'); if (!ctx) return null; paintBack(ctx, book, widthPx, heightPx);  const texture = new THREE.CanvasTexture(canvas); texture.colorSpace = THREE.SRGBColorSpace; texture.needsUpdate = true; return texture; }
+        /* Exported bundles ship spine/back images pre-rendered by the server instead of painting canvases here. */
+        function loadStaticTexture(url) { const texture = textureLoader.load(url, undefined, undefined, (err) => { console.error(`Err loading texture ${url}:`, err); }); texture.colorSpace = THREE.SRGBColorSpace; return texture; }
         function calculateThickness(pageCount) { pageCount = Number(pageCount); if (!pageCount || isNaN(pageCount) || pageCount <= 0) { return BOOK_DEFAULTS.THICKNESS; } const ratio = pageCount / AVG_PAGE_COUNT; const thickness = BOOK_DEFAULTS.THICKNESS * ratio; const clampedThickness = Math.max(MIN_THICKNESS, Math.min(MAX_THICKNESS, thickness)); return clampedThickness; }
         function initThreeJS() { console.log("Initializing Three.js scene..."); scene = new THREE.Scene(); scene.background = new THREE.Color(0x090909); const aspect = window.innerWidth / window.innerHeight; camera = new THREE.PerspectiveCamera(CAMERA_FOV, aspect, 0.1, 1000); camera.position.set(0, CAMERA_Y, CAMERA_Z); camera.lookAt(0, 0, 0); renderer = new THREE.WebGLRenderer({ antialias: true }); renderer.setSize(window.innerWidth, window.innerHeight); renderer.setPixelRatio(window.devicePixelRatio); canvasContainer.appendChild(renderer.domElement); const ambientLight = new THREE.AmbientLight(0xffffff, 0.7); scene.add(ambientLight); const keyLight = new THREE.DirectionalLight(0xffffff, 0.8); keyLight.position.set(-8, 10, 8); scene.add(keyLight); const fillLight = new THREE.DirectionalLight(0xffffff, 0.3); fillLight.position.set(8, 2, 6); scene.add(fillLight); scene.add(booksGroup); window.addEventListener('resize', onWindowResize); if (!animationFrameId) { animate(); console.log("Animation loop started."); } }
-        function createBookMesh(book) { const dynamicThickness = calculateThickness(book.page_count); const dynamicSpineTextureWidth = Math.max(1, Math.round(SPINE_TEXTURE_HEIGHT * (dynamicThickness / BOOK_DEFAULTS.HEIGHT))); const geometry = new THREE.BoxGeometry( BOOK_DEFAULTS.WIDTH, BOOK_DEFAULTS.HEIGHT, dynamicThickness ); const pageMaterial = new THREE.MeshStandardMaterial({ color: PAGE_COLOR, roughness: MATTE_ROUGHNESS, metalness: MATTE_METALNESS }); const spineTexture = createSpineTexture(book, dynamicSpineTextureWidth, SPINE_TEXTURE_HEIGHT); if (!spineTexture) return null; const spineMaterial = new THREE.MeshStandardMaterial({ map: spineTexture, color: 0xffffff, roughness: MATTE_ROUGHNESS, metalness: MATTE_METALNESS }); const coverMaterial = new THREE.MeshStandardMaterial({ color: 0xffffff, roughness: MATTE_ROUGHNESS, metalness: MATTE_METALNESS }); const backTextureHeight = Math.round(BACK_TEXTURE_WIDTH * (BOOK_DEFAULTS.HEIGHT / BOOK_DEFAULTS.WIDTH)); const backTexture = createBackTexture(book, BACK_TEXTURE_WIDTH, backTextureHeight); if (!backTexture) return null; const backMaterial = new THREE.MeshStandardMaterial({ map: backTexture, color: 0xffffff, roughness: MATTE_ROUGHNESS, metalness: MATTE_METALNESS }); if (book.image) { textureLoader.load( book.image, (texture) => { texture.colorSpace = THREE.SRGBColorSpace; const imgAspect = texture.image.naturalWidth / texture.image.naturalHeight; const geomAspect = BOOK_DEFAULTS.WIDTH / BOOK_DEFAULTS.HEIGHT; texture.repeat.set(1, geomAspect / imgAspect); texture.offset.set(0, (1 - texture.repeat.y) / 2); coverMaterial.map = texture; coverMaterial.needsUpdate = true; }, undefined, (err) => { console.error(`Err loading texture ${book.title}:`, err); } ); } const materials = [ pageMaterial, spineMaterial, pageMaterial, pageMaterial, coverMaterial, backMaterial ]; const mesh = new THREE.Mesh(geometry, materials); mesh.rotation.order = 'YXZ'; mesh.rotation.x = TARGET_ROTATION_X; mesh.rotation.y = TARGET_ROTATION_Y; mesh.userData.bookInfo = book; return mesh; }
-        function populateScene() { if (currentlyHovered) { animateHover(currentlyHovered, false); currentlyHovered = null; } while(booksGroup.children.length > 0){ booksGroup.remove(booksGroup.children[0]); } console.log(`Creating ${bookData.length} book meshes...`); let currentY = 0; const bookMeshes = []; bookData.forEach((book, index) => { try { const bookMesh = createBookMesh(book); if (bookMesh) { bookMesh.userData.bookIndex = index; bookMeshes.push(bookMesh); } else { console.error(`Failed to create mesh for book index ${index}`, book); } } catch (meshError) { console.error(`Error creating mesh for book index ${index}:`, meshError, book); } }); if (bookMeshes.length === 0) { console.error("No valid book meshes were created."); statusText.textContent = "Error creating book visuals."; loadingMessage.style.display = 'block'; return; } const actualTotalStackHeight = bookMeshes.reduce((sum, mesh) => sum + mesh.geometry.parameters.height + BOOK_SPACING, 0) - BOOK_SPACING; const startY = actualTotalStackHeight / 2; currentY = startY; bookMeshes.forEach((bookMesh, index) => { const bookHeight = bookMesh.geometry.parameters.height; bookMesh.position.y = currentY - (bookHeight / 2); bookMesh.userData.stackY = bookMesh.position.y; /* STORE STACK Y */ currentY -= (bookHeight + BOOK_SPACING); const startX = (index % 2 === 0) ? -ANIM_START_X : ANIM_START_X; bookMesh.position.x = startX; booksGroup.add(bookMesh); gsap.to(bookMesh.position, { x: 0, duration: ANIM_DURATION, delay: 0.05 + index * ANIM_STAGGER, ease: ANIM_EASE }); }); console.log("Finished adding meshes."); loadingMessage.style.display = 'none'; document.body.style.height = `${actualTotalStackHeight * 50}px`; targetGroupY = -startY + (bookMeshes[0]?.geometry.parameters.height / 2 || 0); booksGroup.position.y = targetGroupY; window.addEventListener('scroll', onWindowScroll); onWindowScroll(); }
-        async function updateProgress() { try { const response = await fetch('/progress'); if (!response.ok) { console.warn("Progress check failed:", response.status); return; } const data = await response.json(); const percent = data.progress || 0; if(progressBarFill){ progressBarFill.style.width = percent + '%'; progressBarFill.textContent = percent + '%'; } if(statusText){ if (!data.complete && !data.error) { statusText.textContent = `Processing... (${data.books_processed}/${data.total_books})`; } } if (data.complete || data.error) { console.log("Progress poll end."); if (progressIntervalId) clearInterval(progressIntervalId); progressIntervalId = null; if(progressBarFill){ progressBarFill.style.width = '100%'; progressBarFill.textContent = '100%';} if(statusText && data.error){ statusText.textContent = `Error: ${data.error}`; } else if(statusText && data.complete && bookData.length > 0) { statusText.textContent = `✓ ${bookData.length} books loaded.`; } else if (statusText && data.complete && bookData.length == 0) { statusText.textContent = `No books found or error during process.`;} } } catch (error) { console.warn("Error fetching progress:", error); } }
-        async function handleUrlSubmit(event) { event.preventDefault(); const shelfUrl = shelfUrlInput.value.trim(); if (!shelfUrl || !shelfUrl.includes('goodreads.com/review/list/')) { alert('Error: Invalid URL.'); return; } console.log("Shelf URL:", shelfUrl); inputContainer.style.display = 'none'; loadingMessage.style.display = 'block'; statusText.textContent = "Fetching data..."; progressBarFill.style.width = '0%'; progressBarFill.textContent = '0%'; if (progressIntervalId) clearInterval(progressIntervalId); progressIntervalId = setInterval(updateProgress, 1000); try { const apiUrl = `/get_books?url=${encodeURIComponent(shelfUrl)}`; console.log("Fetching from:", apiUrl); const response = await fetch(apiUrl); let errorMsg = `HTTP error ${response.status}`; if (!response.ok) { try { const d=await response.json(); errorMsg = d.error||errorMsg; } catch (e) {} throw new Error(errorMsg); } const data = await response.json(); console.log("Received data:", data); if (progressIntervalId) clearInterval(progressIntervalId); progressIntervalId = null; if (data.error && (!data.books || data.books.length === 0)) { throw new Error(data.error); } bookData = data.books || []; statusText.textContent = `${bookData.length} books found. Building scene...`; progressBarFill.style.width = '100%'; progressBarFill.textContent = '100%'; if (!scene) { initThreeJS(); } populateScene(); } catch (error) { console.error("Fetch error:", error); alert(`Error: ${error.message}`); statusText.textContent = `Error: ${error.message}`; if (progressIntervalId) clearInterval(progressIntervalId); progressIntervalId = null; loadingMessage.style.display = 'block'; } }
-        function onWindowScroll() { if (isDetailView || isTransitioning) { return; } const actualTotalStackHeight = booksGroup.children.reduce((sum, mesh) => sum + mesh.geometry.parameters.height + BOOK_SPACING, 0) - BOOK_SPACING; const scrollableHeight = document.documentElement.scrollHeight - window.innerHeight; if (scrollableHeight <= 0) return; currentScrollY = window.scrollY; const scrollRatio = Math.max(0, Math.min(1, currentScrollY / scrollableHeight)); const startY = actualTotalStackHeight / 2; const initialGroupY = -startY + (booksGroup.children[0]?.geometry.parameters.height / 2 || 0); const maxTravel = actualTotalStackHeight - (booksGroup.children[0]?.geometry.parameters.height || BOOK_DEFAULTS.HEIGHT); targetGroupY = initialGroupY + (scrollRatio * maxTravel); }
-        function onMouseMove(event) { if (isTransitioning || !camera || !booksGroup || booksGroup.children.length === 0 || isDetailView) return; mouse.x = (event.clientX / window.innerWidth) * 2 - 1; mouse.y = - (event.clientY / window.innerHeight) * 2 + 1; raycaster.setFromCamera(mouse, camera); const intersects = raycaster.intersectObjects(booksGroup.children); if (intersects.length > 0) { const intersectedObject = intersects[0].object; if (intersectedObject.visible && currentlyHovered !== intersectedObject) { if (currentlyHovered) { animateHover(currentlyHovered, false); } currentlyHovered = intersectedObject; animateHover(currentlyHovered, true); } } else { if (currentlyHovered) { animateHover(currentlyHovered, false); currentlyHovered = null; } } }
-        function onClick(event) { if (isTransitioning) return; if (event.target === closeDetailButton || detailViewDiv.contains(event.target) && !canvasContainer.contains(event.target)) { return; } if (isDetailView) return; if (!camera || !booksGroup || booksGroup.children.length === 0) return; mouse.x = (event.clientX / window.innerWidth) * 2 - 1; mouse.y = - (event.clientY / window.innerHeight) * 2 + 1; raycaster.setFromCamera(mouse, camera); const intersects = raycaster.intersectObjects(booksGroup.children); if (intersects.length > 0) { const clickedObject = intersects[0].object; if (!clickedObject.visible) return; const index = clickedObject.userData.bookIndex; if (index !== undefined && index !== -1) { if (currentlyHovered === clickedObject) { animateHover(currentlyHovered, false); currentlyHovered = null; } showDetailView(index); } } }
+        function createBookMesh(book) { const dynamicThickness = calculateThickness(book.page_count); const dynamicSpineTextureWidth = Math.max(1, Math.round(SPINE_TEXTURE_HEIGHT * (dynamicThickness / BOOK_DEFAULTS.HEIGHT))); const geometry = new THREE.BoxGeometry( BOOK_DEFAULTS.WIDTH, BOOK_DEFAULTS.HEIGHT, dynamicThickness ); const pageMaterial = new THREE.MeshStandardMaterial({ color: PAGE_COLOR, roughness: MATTE_ROUGHNESS, metalness: MATTE_METALNESS }); const spineTexture = book.spine_url ? loadStaticTexture(book.spine_url) : createSpineTexture(book, dynamicSpineTextureWidth, SPINE_TEXTURE_HEIGHT); if (!spineTexture) return null; const spineMaterial = new THREE.MeshStandardMaterial({ map: spineTexture, color: 0xffffff, roughness: MATTE_ROUGHNESS, metalness: MATTE_METALNESS }); const coverMaterial = new THREE.MeshStandardMaterial({ color: 0xffffff, roughness: MATTE_ROUGHNESS, metalness: MATTE_METALNESS }); const backTextureHeight = Math.round(BACK_TEXTURE_WIDTH * (BOOK_DEFAULTS.HEIGHT / BOOK_DEFAULTS.WIDTH)); const backTexture = book.back_url ? loadStaticTexture(book.back_url) : createBackTexture(book, BACK_TEXTURE_WIDTH, backTextureHeight); if (!backTexture) return null; const backMaterial = new THREE.MeshStandardMaterial({ map: backTexture, color: 0xffffff, roughness: MATTE_ROUGHNESS, metalness: MATTE_METALNESS }); if (book.cover_url || book.image) { textureLoader.load( book.cover_url || book.image, (texture) => { if (coverMaterial.userData.disposed) { texture.dispose(); return; } texture.colorSpace = THREE.SRGBColorSpace; if (book.cover_url) { /* proxy textures arrive pre-cropped */ coverMaterial.map = texture; coverMaterial.needsUpdate = true; return; } const imgAspect = texture.image.naturalWidth / texture.image.naturalHeight; const geomAspect = BOOK_DEFAULTS.WIDTH / BOOK_DEFAULTS.HEIGHT; texture.repeat.set(1, geomAspect / imgAspect); texture.offset.set(0, (1 - texture.repeat.y) / 2); coverMaterial.map = texture; coverMaterial.needsUpdate = true; }, undefined, (err) => { console.error(`Err loading texture ${book.title}:`, err); } ); } const materials = [ pageMaterial, spineMaterial, pageMaterial, pageMaterial, coverMaterial, backMaterial ]; const mesh = new THREE.Mesh(geometry, materials); mesh.rotation.order = 'YXZ'; mesh.rotation.x = TARGET_ROTATION_X; mesh.rotation.y = TARGET_ROTATION_Y; mesh.userData.bookInfo = book; return mesh; }
+        // --- Shelf Layout (virtualized) ---
+        /* Every book gets a slot in a prefix-sum layout (top offset and bottom edge down the stack). Each frame two binary searches find the books
+           near the viewport; only those get meshes (or, in large-shelf mode, painted atlas chunks), and books that drift far away are disposed. */
+        function recordBookLayout(index) { const top = index === 0 ? 0 : shelfLayout.tops[index - 1] + BOOK_DEFAULTS.HEIGHT + BOOK_SPACING; shelfLayout.tops[index] = top; shelfLayout.bottoms[index] = top + BOOK_DEFAULTS.HEIGHT; }
+        function shelfBookCount() { return shelfLayout.tops.length; }
+        function shelfStackHeight() { const count = shelfBookCount(); return count > 0 ? shelfLayout.bottoms[count - 1] : -BOOK_SPACING; }
+        function bookStackY(index) { return -(shelfLayout.tops[index] + BOOK_DEFAULTS.HEIGHT / 2); }
+        function lowerBound(values, target) { let lo = 0, hi = values.length; while (lo < hi) { const mid = (lo + hi) >> 1; if (values[mid] < target) lo = mid + 1; else hi = mid; } return lo; }
+        /* Returns [first, last] book indices within VIRTUAL_WINDOW_MARGIN of the view, for both the current and the target scroll position. */
+        function visibleBookRange() { const viewHalf = camera ? Math.tan(THREE.MathUtils.degToRad(camera.fov / 2)) * CAMERA_Z + CAMERA_Y : BOOK_DEFAULTS.HEIGHT * 2; const low = Math.min(booksGroup.position.y, targetGroupY) - viewHalf - VIRTUAL_WINDOW_MARGIN; const high = Math.max(booksGroup.position.y, targetGroupY) + viewHalf + VIRTUAL_WINDOW_MARGIN; return [lowerBound(shelfLayout.bottoms, low), lowerBound(shelfLayout.tops, high) - 1]; }
+        function disposeObject(object) { if (object.geometry) object.geometry.dispose(); (Array.isArray(object.material) ? object.material : [object.material]).forEach(material => { if (!material) return; material.userData.disposed = true; if (material.map) material.map.dispose(); material.dispose(); }); }
+        function createStackMesh(index, staggerIndex) { let bookMesh = null; try { bookMesh = createBookMesh(bookData[index]); } catch (meshError) { console.error(`Error creating mesh for book index ${index}:`, meshError, bookData[index]); } if (!bookMesh) { console.error(`Failed to create mesh for book index ${index}`, bookData[index]); return null; } bookMesh.userData.bookIndex = index; bookMesh.position.y = bookStackY(index); bookMesh.userData.stackY = bookMesh.position.y; /* STORE STACK Y */ booksGroup.add(bookMesh); bookMeshes.set(index, bookMesh); if (staggerIndex !== undefined) { bookMesh.position.x = (index % 2 === 0) ? -ANIM_START_X : ANIM_START_X; gsap.to(bookMesh.position, { x: 0, duration: ANIM_DURATION, delay: 0.05 + staggerIndex * ANIM_STAGGER, ease: ANIM_EASE }); } return bookMesh; }
+        function disposeStackMesh(index) { const mesh = bookMeshes.get(index); if (!mesh) return; if (currentlyHovered === mesh) { currentlyHovered = null; } gsap.killTweensOf(mesh.position); gsap.killTweensOf(mesh.scale); booksGroup.remove(mesh); disposeObject(mesh); bookMeshes.delete(index); }
+        function updateVirtualWindow(force) {
+            if (!scene || isDetailView || isTransitioning) return;
+            const [first, last] = visibleBookRange();
+            if (!force && first === virtualWindow.first && last === virtualWindow.last) return;
+            virtualWindow.first = first; virtualWindow.last = last;
+            if (largeShelf) { updateChunkWindow(first, last); return; }
+            for (const index of Array.from(bookMeshes.keys())) { if (index < first - VIRTUAL_WINDOW_KEEP || index > last + VIRTUAL_WINDOW_KEEP) { disposeStackMesh(index); } }
+            for (let i = first; i <= last; i++) { if (!bookMeshes.has(i) && bookData[i]) { createStackMesh(i); } }
+        }
+
+        // --- Large Shelf Mode ---
+        /* Past LARGE_SHELF_THRESHOLD books the shelf switches to instanced rendering: books are packed into chunks of ATLAS_CHUNK_SIZE, each a single
+           InstancedMesh whose spine, back and cover faces sample per-chunk atlas textures through a per-instance UV rect. Picking maps instanceId back to the book index.
+           Only chunks near the viewport exist; their cells are painted a few per frame and the whole chunk is disposed once it leaves the window. */
+        function createAtlas([cellWidth, cellHeight, columns]) {
+            const canvas = document.createElement('canvas'); canvas.width = cellWidth * columns; canvas.height = cellHeight * Math.ceil(ATLAS_CHUNK_SIZE / columns);
+            const texture = new THREE.CanvasTexture(canvas); texture.colorSpace = THREE.SRGBColorSpace;
+            return { canvas, ctx: canvas.getContext('2d'), texture, cellWidth, cellHeight, columns, dirty: false };
+        }
+        /* Paints one atlas cell and returns its UV rect [u0, v0, uScale, vScale]; canvas textures are flipped, so v runs bottom-up. */
+        function paintAtlasCell(atlas, slot, paint) {
+            const x = (slot % atlas.columns) * atlas.cellWidth; const y = Math.floor(slot / atlas.columns) * atlas.cellHeight; const ctx = atlas.ctx;
+            ctx.save(); ctx.translate(x, y); ctx.beginPath(); ctx.rect(0, 0, atlas.cellWidth, atlas.cellHeight); ctx.clip(); paint(ctx, atlas.cellWidth, atlas.cellHeight); ctx.restore(); atlas.dirty = true;
+            return [x / atlas.canvas.width, 1 - (y + atlas.cellHeight) / atlas.canvas.height, atlas.cellWidth / atlas.canvas.width, atlas.cellHeight / atlas.canvas.height];
+        }
+        function createAtlasMaterial(atlas, rectAttribute) {
+            const material = new THREE.MeshStandardMaterial({ map: atlas.texture, color: 0xffffff, roughness: MATTE_ROUGHNESS, metalness: MATTE_METALNESS });
+            material.onBeforeCompile = (shader) => { shader.vertexShader = shader.vertexShader.replace('#include <common>', `#include <common>\\nattribute vec4 ${rectAttribute};`).replace('#include <uv_vertex>', `#include <uv_vertex>\\nvMapUv = ${rectAttribute}.xy + vMapUv * ${rectAttribute}.zw;`); };
+            material.customProgramCacheKey = () => `atlas-${rectAttribute}`;
+            return material;
+        }
+        function createShelfChunk(chunkIndex) {
+            const geometry = new THREE.BoxGeometry(BOOK_DEFAULTS.WIDTH, BOOK_DEFAULTS.HEIGHT, 1);
+            ['spineRect', 'backRect', 'coverRect'].forEach(name => geometry.setAttribute(name, new THREE.InstancedBufferAttribute(new Float32Array(ATLAS_CHUNK_SIZE * 4), 4)));
+            const atlases = { spine: createAtlas(ATLAS_SPINE_CELL), back: createAtlas(ATLAS_BACK_CELL), cover: createAtlas(ATLAS_COVER_CELL) };
+            const materials = [ largeShelf.pageMaterial, createAtlasMaterial(atlases.spine, 'spineRect'), largeShelf.pageMaterial, largeShelf.pageMaterial, createAtlasMaterial(atlases.cover, 'coverRect'), createAtlasMaterial(atlases.back, 'backRect') ];
+            const mesh = new THREE.InstancedMesh(geometry, materials, ATLAS_CHUNK_SIZE); mesh.count = 0; mesh.instanceMatrix.setUsage(THREE.DynamicDrawUsage); mesh.userData.firstBookIndex = chunkIndex * ATLAS_CHUNK_SIZE;
+            booksGroup.add(mesh);
+            return { mesh, atlases };
+        }
+        function ensureShelfChunk(chunkIndex) {
+            if (largeShelf.chunks.has(chunkIndex)) return;
+            largeShelf.chunks.set(chunkIndex, createShelfChunk(chunkIndex));
+            const start = chunkIndex * ATLAS_CHUNK_SIZE; const end = Math.min(start + ATLAS_CHUNK_SIZE, shelfBookCount());
+            for (let i = start; i < end; i++) { largeShelf.paintQueue.push(i); }
+        }
+        function disposeShelfChunk(chunkIndex) {
+            const chunk = largeShelf.chunks.get(chunkIndex); if (!chunk) return;
+            const start = chunkIndex * ATLAS_CHUNK_SIZE;
+            for (let i = start; i < start + ATLAS_CHUNK_SIZE; i++) { if (largeShelf.books[i]) { gsap.killTweensOf(largeShelf.books[i].hover); delete largeShelf.books[i]; } }
+            if (hoveredBookIndex >= start && hoveredBookIndex < start + ATLAS_CHUNK_SIZE) { hoveredBookIndex = -1; }
+            booksGroup.remove(chunk.mesh); disposeObject(chunk.mesh); largeShelf.chunks.delete(chunkIndex);
+        }
+        function updateChunkWindow(first, last) {
+            if (last < first) return;
+            const firstChunk = Math.floor(first / ATLAS_CHUNK_SIZE); const lastChunk = Math.floor(last / ATLAS_CHUNK_SIZE);
+            for (const chunkIndex of Array.from(largeShelf.chunks.keys())) { if (chunkIndex < firstChunk - 1 || chunkIndex > lastChunk + 1) { disposeShelfChunk(chunkIndex); } }
+            for (let chunkIndex = firstChunk; chunkIndex <= lastChunk; chunkIndex++) { ensureShelfChunk(chunkIndex); }
+            /* Paint what is on screen first. */
+            const center = (first + last) / 2; largeShelf.paintQueue.sort((a, b) => Math.abs(a - center) - Math.abs(b - center));
+        }
+        function setInstanceTransform(record, scale = 1, z = 0) {
+            instanceDummy.position.set(0, record.y, z); instanceDummy.rotation.set(TARGET_ROTATION_X, TARGET_ROTATION_Y, 0); instanceDummy.scale.set(scale, scale, record.thickness * scale); instanceDummy.updateMatrix();
+            const mesh = record.chunk.mesh; mesh.setMatrixAt(record.slot, instanceDummy.matrix); mesh.instanceMatrix.needsUpdate = true; mesh.boundingSphere = null;
+        }
+        function setInstanceRect(record, attributeName, rect) { const attribute = record.chunk.mesh.geometry.getAttribute(attributeName); attribute.setXYZW(record.slot, rect[0], rect[1], rect[2], rect[3]); attribute.needsUpdate = true; }
+        function paintInstancedBook(index) {
+            const chunk = largeShelf.chunks.get(Math.floor(index / ATLAS_CHUNK_SIZE)); const book = bookData[index];
+            if (!chunk || !book || largeShelf.books[index]) return;
+            const slot = index % ATLAS_CHUNK_SIZE; const thickness = calculateThickness(book.page_count);
+            const record = { chunk, slot, thickness, y: bookStackY(index), hover: { scale: 1, z: 0 } };
+            largeShelf.books[index] = record;
+            const spineWidth = Math.max(1, Math.round(SPINE_TEXTURE_HEIGHT * (thickness / BOOK_DEFAULTS.HEIGHT)));
+            const fillSpineColor = (ctx, w, h) => { ctx.fillStyle = book.spine_color || '#808080'; ctx.fillRect(0, 0, w, h); };
+            setInstanceRect(record, 'spineRect', paintAtlasCell(chunk.atlases.spine, slot, book.spine_url ? fillSpineColor : (ctx, w, h) => { ctx.scale(w / spineWidth, h / SPINE_TEXTURE_HEIGHT); paintSpine(ctx, book, spineWidth, SPINE_TEXTURE_HEIGHT); }));
+            setInstanceRect(record, 'backRect', paintAtlasCell(chunk.atlases.back, slot, book.back_url ? fillSpineColor : (ctx, w, h) => paintBack(ctx, book, w, h)));
+            setInstanceRect(record, 'coverRect', paintAtlasCell(chunk.atlases.cover, slot, fillSpineColor));
+            const paintAtlasImage = (atlas, url) => { const img = new Image(); img.onload = () => { if (largeShelf && largeShelf.books[index] === record) { paintAtlasCell(atlas, slot, (ctx, w, h) => ctx.drawImage(img, 0, 0, w, h)); } }; img.src = url; };
+            if (book.spine_url) { paintAtlasImage(chunk.atlases.spine, book.spine_url); }
+            if (book.back_url) { paintAtlasImage(chunk.atlases.back, book.back_url); }
+            if (book.cover_url) { paintAtlasImage(chunk.atlases.cover, `${book.cover_url}?size=${ATLAS_COVER_SIZE}`); }
+            /* Slots not painted yet keep a zero-scale matrix, so count can run ahead of painting. */
+            if (slot + 1 > chunk.mesh.count) { for (let s = chunk.mesh.count; s <= slot; s++) { chunk.mesh.setMatrixAt(s, ZERO_MATRIX); } chunk.mesh.count = slot + 1; }
+            setInstanceTransform(record);
+        }
+        function drainPaintQueue() { if (!largeShelf) return; for (let budget = ATLAS_PAINT_BUDGET; budget > 0 && largeShelf.paintQueue.length > 0; budget--) { paintInstancedBook(largeShelf.paintQueue.shift()); } }
+        /* Drops the per-book meshes built so far; the window update then builds the chunks near the viewport. */
+        function enterLargeShelfMode() {
+            console.log(`Switching to instanced rendering at ${shelfBookCount()} books.`);
+            for (const index of Array.from(bookMeshes.keys())) { disposeStackMesh(index); }
+            largeShelf = { chunks: new Map(), books: [], paintQueue: [], detached: null, lastFlush: 0, pageMaterial: new THREE.MeshStandardMaterial({ color: PAGE_COLOR, roughness: MATTE_ROUGHNESS, metalness: MATTE_METALNESS }) };
+            updateVirtualWindow(true);
+        }
+        function disposeLargeShelf() { if (!largeShelf) return; for (const chunkIndex of Array.from(largeShelf.chunks.keys())) { disposeShelfChunk(chunkIndex); } if (largeShelf.detached) { booksGroup.remove(largeShelf.detached.mesh); disposeObject(largeShelf.detached.mesh); } largeShelf.pageMaterial.dispose(); largeShelf = null; hoveredBookIndex = -1; }
+        /* Uploads changed atlases at most every ATLAS_FLUSH_MS instead of once per painted cell. */
+        function flushAtlases(now) { if (!largeShelf || now - largeShelf.lastFlush < ATLAS_FLUSH_MS) return; largeShelf.lastFlush = now; largeShelf.chunks.forEach(chunk => Object.values(chunk.atlases).forEach(atlas => { if (atlas.dirty) { atlas.texture.needsUpdate = true; atlas.dirty = false; } })); }
+        function pickInstancedBook() { const hits = raycaster.intersectObjects(Array.from(largeShelf.chunks.values(), chunk => chunk.mesh), false); for (const hit of hits) { if (hit.object.visible && hit.instanceId !== undefined && largeShelf.books[hit.object.userData.firstBookIndex + hit.instanceId]) return hit.object.userData.firstBookIndex + hit.instanceId; } return -1; }
+        function animateInstanceHover(index, hoverIn) { const record = largeShelf && largeShelf.books[index]; if (!record || (largeShelf.detached && largeShelf.detached.index === index)) return; gsap.to(record.hover, { scale: hoverIn ? HOVER_SCALE : 1.0, z: hoverIn ? HOVER_Z_OFFSET : 0, duration: HOVER_DURATION, ease: "power2.out", overwrite: true, onUpdate: () => setInstanceTransform(record, record.hover.scale, record.hover.z) }); }
+        /* The detail view animates a regular full-resolution mesh standing in for the hidden instance. */
+        function detachInstancedBook(index) { const record = largeShelf.books[index]; const mesh = record ? createBookMesh(bookData[index]) : null; if (!mesh) return null; gsap.killTweensOf(record.hover); record.hover.scale = 1; record.hover.z = 0; setInstanceTransform(record, 0); mesh.position.set(0, record.y, 0); mesh.userData.stackY = record.y; mesh.userData.bookIndex = index; booksGroup.add(mesh); largeShelf.detached = { index, mesh }; return mesh; }
+        function reattachInstancedBook() { if (!largeShelf || !largeShelf.detached) return; const { index, mesh } = largeShelf.detached; booksGroup.remove(mesh); disposeObject(mesh); if (largeShelf.books[index]) { setInstanceTransform(largeShelf.books[index]); } largeShelf.detached = null; }
+        function resetScene() { if (currentlyHovered) { animateHover(currentlyHovered, false); currentlyHovered = null; } disposeLargeShelf(); for (const index of Array.from(bookMeshes.keys())) { disposeStackMesh(index); } while(booksGroup.children.length > 0){ booksGroup.remove(booksGroup.children[0]); } shelfLayout.tops = []; shelfLayout.bottoms = []; virtualWindow.first = 0; virtualWindow.last = -1; }
+        /* Records the book's slot in the layout; a mesh (or atlas cell) is only built if the slot is near the viewport. */
+        function addBookToScene(book, index, staggerIndex) { recordBookLayout(index); document.body.style.height = `${shelfStackHeight() * 50}px`; if (!largeShelf && index >= LARGE_SHELF_THRESHOLD) { enterLargeShelfMode(); } const [first, last] = visibleBookRange(); if (largeShelf) { if (largeShelf.chunks.has(Math.floor(index / ATLAS_CHUNK_SIZE))) { largeShelf.paintQueue.push(index); } else if (index >= first && index <= last) { updateVirtualWindow(true); } return true; } if (index >= first && index <= last && !bookMeshes.has(index)) { createStackMesh(index, staggerIndex); } return true; }
+        function showScene() { loadingMessage.style.display = 'none'; if (shelfBookCount() === 1) { targetGroupY = BOOK_DEFAULTS.HEIGHT / 2; booksGroup.position.y = targetGroupY; } window.addEventListener('scroll', onWindowScroll); onWindowScroll(); }
+        function populateScene() { resetScene(); if (bookData.length > LARGE_SHELF_THRESHOLD) { enterLargeShelfMode(); } console.log(`Creating ${bookData.length} book meshes...`); bookData.forEach((book, index) => { addBookToScene(book, index, index); }); if (shelfBookCount() === 0) { console.error("No valid book meshes were created."); statusText.textContent = "Error creating book visuals."; loadingMessage.style.display = 'block'; return; } console.log("Finished adding meshes."); targetGroupY = BOOK_DEFAULTS.HEIGHT / 2; booksGroup.position.y = targetGroupY; showScene(); }
+        /* Reads /stream/<job> NDJSON and adds each book to the scene as it arrives. Returns the summary record, or null if streaming isn't available. */
+        async function streamJobBooks(jobId) {
+            const response = await fetch(`/stream/${jobId}`);
+            if (!response.ok || !response.body || !response.body.getReader) return null;
+            const reader = response.body.getReader(); const decoder = new TextDecoder(); let buffered = ''; let summary = null;
+            bookData = []; resetScene(); if (!scene) { initThreeJS(); }
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffered += decoder.decode(value, { stream: true });
+                const lines = buffered.split('\\n'); buffered = lines.pop();
+                let staggerIndex = 0;
+                for (const line of lines) {
+                    if (!line.trim()) continue;
+                    const record = JSON.parse(line);
+                    if (record.type === 'book') {
+                        bookData.push(record.book);
+                        if (addBookToScene(record.book, bookData.length - 1, staggerIndex++) && shelfBookCount() === 1) { showScene(); }
+                    } else if (record.type === 'summary') { summary = record; }
+                }
+            }
+            if (shelfBookCount() > 0) { onWindowScroll(); }
+            return summary || { total_found: bookData.length, error: null };
+        }
+        /* Columnar payloads ({shelf: {count, columns}}) come from /result?format=columns and static exports; each column is an array or {dict, index}. */
+        function decodeShelfPayload(data) { if (!data.shelf) { return data.books || []; } const { count, columns } = data.shelf; const books = Array.from({ length: count }, () => ({})); for (const [field, column] of Object.entries(columns)) { const values = Array.isArray(column) ? column : column.index.map(i => column.dict[i]); for (let i = 0; i < count; i++) { books[i][field] = values[i]; } } return books; }
+        async function fetchJobResult(jobId) { while (true) { const response = await fetch(`/result/${jobId}?format=columns`); if (response.status !== 202) return response; await new Promise(resolve => setTimeout(resolve, 1000)); } }
+        async function updateProgress() { try { const response = await fetch(`/progress/${currentJobId}`); if (!response.ok) { console.warn("Progress check failed:", response.status); return; } const data = await response.json(); const percent = data.progress || 0; if(progressBarFill){ progressBarFill.style.width = percent + '%'; progressBarFill.textContent = percent + '%'; } if(statusText){ if (!data.complete && !data.error) { statusText.textContent = `Processing... (${data.books_processed}/${data.total_books}, ${data.books_parsed} parsed)`; } } if (data.complete || data.error) { console.log("Progress poll end."); if (progressIntervalId) clearInterval(progressIntervalId); progressIntervalId = null; if(progressBarFill){ progressBarFill.style.width = '100%'; progressBarFill.textContent = '100%';} if(statusText && data.error){ statusText.textContent = `Error: ${data.error}`; } else if(statusText && data.complete && bookData.length > 0) { statusText.textContent = `✓ ${bookData.length} books loaded.`; } else if (statusText && data.complete && bookData.length == 0) { statusText.textContent = `No books found or error during process.`;} } } catch (error) { console.warn("Error fetching progress:", error); } }
+        async function handleUrlSubmit(event) { event.preventDefault(); const shelfUrl = shelfUrlInput.value.trim(); const csvFile = csvFileInput.files[0]; if (!csvFile && (!shelfUrl || !shelfUrl.includes('goodreads.com/review/list/'))) { alert('Error: Invalid URL.'); return; } console.log(csvFile ? `CSV: ${csvFile.name}` : `Shelf URL: ${shelfUrl}`); inputContainer.style.display = 'none'; loadingMessage.style.display = 'block'; statusText.textContent = "Fetching data..."; progressBarFill.style.width = '0%'; progressBarFill.textContent = '0%'; if (progressIntervalId) clearInterval(progressIntervalId); try { let submitResponse; if (csvFile) { const formData = new FormData(); formData.append('file', csvFile); submitResponse = await fetch('/import_csv', { method: 'POST', body: formData }); } else { const apiUrl = `/get_books?url=${encodeURIComponent(shelfUrl)}`; console.log("Submitting job:", apiUrl); submitResponse = await fetch(apiUrl); } const submitData = await submitResponse.json().catch(() => ({})); if (!submitResponse.ok) { throw new Error(submitData.error || `HTTP error ${submitResponse.status}`); } currentJobId = submitData.job_id; progressIntervalId = setInterval(updateProgress, 1000); const summary = await streamJobBooks(currentJobId); if (summary) { if (progressIntervalId) clearInterval(progressIntervalId); progressIntervalId = null; if (summary.error && bookData.length === 0) { throw new Error(summary.error); } if (bookData.length === 0) { throw new Error('No books found on shelf.'); } console.log(`Streamed ${bookData.length} books.`); return; } const response = await fetchJobResult(currentJobId); let errorMsg = `HTTP error ${response.status}`; if (!response.ok) { try { const d=await response.json(); errorMsg = d.error||errorMsg; } catch (e) {} throw new Error(errorMsg); } const data = await response.json(); console.log("Received data:", data); if (progressIntervalId) clearInterval(progressIntervalId); progressIntervalId = null; const books = decodeShelfPayload(data); if (data.error && books.length === 0) { throw new Error(data.error); } bookData = books; statusText.textContent = `${bookData.length} books found. Building scene...`; progressBarFill.style.width = '100%'; progressBarFill.textContent = '100%'; if (!scene) { initThreeJS(); } populateScene(); } catch (error) { console.error("Fetch error:", error); alert(`Error: ${error.message}`); statusText.textContent = `Error: ${error.message}`; if (progressIntervalId) clearInterval(progressIntervalId); progressIntervalId = null; loadingMessage.style.display = 'block'; } }
+        function onWindowScroll() { if (isDetailView || isTransitioning) { return; } const bookCount = shelfBookCount(); const actualTotalStackHeight = shelfStackHeight(); const scrollableHeight = document.documentElement.scrollHeight - window.innerHeight; if (scrollableHeight <= 0) return; currentScrollY = window.scrollY; const scrollRatio = Math.max(0, Math.min(1, currentScrollY / scrollableHeight)); const initialGroupY = bookCount > 0 ? BOOK_DEFAULTS.HEIGHT / 2 : 0; const maxTravel = actualTotalStackHeight - BOOK_DEFAULTS.HEIGHT; targetGroupY = initialGroupY + (scrollRatio * maxTravel); }
+        function onMouseMove(event) { if (isTransitioning || !camera || !booksGroup || booksGroup.children.length === 0 || isDetailView) return; mouse.x = (event.clientX / window.innerWidth) * 2 - 1; mouse.y = - (event.clientY / window.innerHeight) * 2 + 1; raycaster.setFromCamera(mouse, camera); if (largeShelf) { const index = pickInstancedBook(); if (index !== hoveredBookIndex) { if (hoveredBookIndex >= 0) { animateInstanceHover(hoveredBookIndex, false); } hoveredBookIndex = index; if (index >= 0) { animateInstanceHover(index, true); } } return; } const intersects = raycaster.intersectObjects(booksGroup.children); if (intersects.length > 0) { const intersectedObject = intersects[0].object; if (intersectedObject.visible && currentlyHovered !== intersectedObject) { if (currentlyHovered) { animateHover(currentlyHovered, false); } currentlyHovered = intersectedObject; animateHover(currentlyHovered, true); } } else { if (currentlyHovered) { animateHover(currentlyHovered, false); currentlyHovered = null; } } }
+        function onClick(event) { if (isTransitioning) return; if (event.target === closeDetailButton || detailViewDiv.contains(event.target) && !canvasContainer.contains(event.target)) { return; } if (isDetailView) return; if (!camera || !booksGroup || booksGroup.children.length === 0) return; mouse.x = (event.clientX / window.innerWidth) * 2 - 1; mouse.y = - (event.clientY / window.innerHeight) * 2 + 1; raycaster.setFromCamera(mouse, camera); if (largeShelf) { const index = pickInstancedBook(); if (index >= 0) { if (hoveredBookIndex === index) { animateInstanceHover(index, false); hoveredBookIndex = -1; } showDetailView(index); } return; } const intersects = raycaster.intersectObjects(booksGroup.children); if (intersects.length > 0) { const clickedObject = intersects[0].object; if (!clickedObject.visible) return; const index = clickedObject.userData.bookIndex; if (index !== undefined && index !== -1) { if (currentlyHovered === clickedObject) { animateHover(currentlyHovered, false); currentlyHovered = null; } showDetailView(index); } } }
         function onDetailScroll(event) { /* SCROLL BETWEEN DETAILS DISABLED */ if (true) { if (isDetailView) event.preventDefault(); return; } }
         function onWindowResize() { if (!camera || !renderer) return; camera.aspect = window.innerWidth / window.innerHeight; camera.updateProjectionMatrix(); renderer.setSize(window.innerWidth, window.innerHeight); if (!isDetailView) { onWindowScroll(); } }
         function animateHover(object, hoverIn) { if (!object || (object === selectedBookMesh && isDetailView)) return; const targetScale = hoverIn ? HOVER_SCALE : 1.0; const originalZ = object.userData.originalZ !== undefined ? object.userData.originalZ : 0; const targetZ = hoverIn ? originalZ + HOVER_Z_OFFSET : originalZ; gsap.to(object.scale, { x: targetScale, y: targetScale, z: targetScale, duration: HOVER_DURATION, ease: "power2.out", overwrite: true }); gsap.to(object.position, { z: targetZ, duration: HOVER_DURATION, ease: "power2.out", overwrite: true }); }
@@ -404,7 +2087,7 @@ THREE_TEMPLATE = '''<!DOCTYPE html>
             isTransitioning = true;
             console.log(`Showing detail view for book ${index}`);
 
-            const meshToShow = booksGroup.children[index];
+            const meshToShow = largeShelf ? detachInstancedBook(index) : bookMeshes.get(index);
             const bookInfo = bookData[index]; // Get book data
 
             if (!meshToShow || !bookInfo) {
@@ -451,7 +2134,7 @@ THREE_TEMPLATE = '''<!DOCTYPE html>
 
             // Animation (GSAP)
             const tl = gsap.timeline({ onStart: () => { console.log("Detail animation starting"); detailViewDiv.style.pointerEvents = 'auto'; detailViewDiv.classList.add('visible'); meshToShow.visible = true; meshToShow.renderOrder = 1; }, onComplete: () => { console.log("Detail animation complete"); isDetailView = true; selectedBookIndex = index; selectedBookMesh = meshToShow; isTransitioning = false; } });
-            booksGroup.children.forEach((mesh, i) => { if (i !== index) { tl.to(mesh, { x: (i % 2 === 0 ? -1 : 1) * DETAIL_VIEW.OTHER_BOOKS.EXIT_X, opacity: 0, visible: false, duration: DETAIL_VIEW.OTHER_BOOKS.FADE_DURATION, ease: "power2.inOut" }, 0); } });
+            booksGroup.children.forEach((mesh, i) => { if (mesh !== meshToShow) { tl.to(mesh, { x: (i % 2 === 0 ? -1 : 1) * DETAIL_VIEW.OTHER_BOOKS.EXIT_X, opacity: 0, visible: false, duration: DETAIL_VIEW.OTHER_BOOKS.FADE_DURATION, ease: "power2.inOut" }, 0); } });
             tl.to(meshToShow.position, { x: DETAIL_VIEW.BOOK.POSITION.x, y: DETAIL_VIEW.BOOK.POSITION.y, z: DETAIL_VIEW.BOOK.POSITION.z, duration: DETAIL_VIEW.BOOK.ANIMATION_DURATION, ease: DETAIL_VIEW.BOOK.EASE }, 0);
             tl.to(meshToShow.rotation, { x: DETAIL_VIEW.BOOK.ROTATION.x, y: DETAIL_VIEW.BOOK.ROTATION.y, z: DETAIL_VIEW.BOOK.ROTATION.z, duration: DETAIL_VIEW.BOOK.ANIMATION_DURATION, ease: DETAIL_VIEW.BOOK.EASE }, 0);
             tl.to(meshToShow.scale, { x: DETAIL_VIEW.BOOK.SCALE, y: DETAIL_VIEW.BOOK.SCALE, z: DETAIL_VIEW.BOOK.SCALE, duration: DETAIL_VIEW.BOOK.ANIMATION_DURATION, ease: DETAIL_VIEW.BOOK.EASE }, 0);
@@ -462,7 +2145,7 @@ THREE_TEMPLATE = '''<!DOCTYPE html>
             if (!isDetailView || isTransitioning || !selectedBookMesh) return;
             isTransitioning = true; console.log("Hiding detail view"); const meshToRestore = selectedBookMesh; const originalState = meshToRestore.userData.originalState;
             if (!originalState) { console.error("Missing original state"); isTransitioning = false; return; }
-            const tl = gsap.timeline({ onStart: () => { console.log("Return animation starting"); detailViewDiv.style.pointerEvents = 'none'; booksGroup.children.forEach(mesh => { mesh.visible = true; mesh.renderOrder = 0; }); }, onComplete: () => { console.log("Return animation complete"); isDetailView = false; selectedBookIndex = -1; selectedBookMesh = null; isTransitioning = false; detailViewDiv.classList.remove('visible'); booksGroup.children.forEach(mesh => { if (mesh.userData.stackY !== undefined) { mesh.position.set(0, mesh.userData.stackY, 0); mesh.rotation.set(TARGET_ROTATION_X, TARGET_ROTATION_Y, 0); mesh.scale.set(1, 1, 1); } }); onWindowScroll(); } });
+            const tl = gsap.timeline({ onStart: () => { console.log("Return animation starting"); detailViewDiv.style.pointerEvents = 'none'; booksGroup.children.forEach(mesh => { mesh.visible = true; mesh.renderOrder = 0; }); }, onComplete: () => { console.log("Return animation complete"); isDetailView = false; selectedBookIndex = -1; selectedBookMesh = null; isTransitioning = false; detailViewDiv.classList.remove('visible'); booksGroup.children.forEach(mesh => { if (mesh.userData.stackY !== undefined) { mesh.position.set(0, mesh.userData.stackY, 0); mesh.rotation.set(TARGET_ROTATION_X, TARGET_ROTATION_Y, 0); mesh.scale.set(1, 1, 1); } }); reattachInstancedBook(); onWindowScroll(); } });
             tl.to(detailViewDiv, { opacity: 0, duration: DETAIL_VIEW.OTHER_BOOKS.FADE_DURATION, ease: "power2.inOut" }, 0);
             tl.to(meshToRestore.position, { x: originalState.position.x, y: originalState.position.y, z: originalState.position.z, duration: DETAIL_VIEW.BOOK.ANIMATION_DURATION, ease: DETAIL_VIEW.BOOK.EASE }, 0);
             tl.to(meshToRestore.rotation, { x: originalState.rotation.x, y: originalState.rotation.y, z: originalState.rotation.z, duration: DETAIL_VIEW.BOOK.ANIMATION_DURATION, ease: DETAIL_VIEW.BOOK.EASE }, 0);
@@ -470,44 +2153,323 @@ THREE_TEMPLATE = '''<!DOCTYPE html>
             booksGroup.children.forEach((mesh, i) => { if (mesh !== meshToRestore) { tl.to(mesh, { x: 0, opacity: 1, visible: true, duration: DETAIL_VIEW.OTHER_BOOKS.FADE_DURATION, ease: "power2.inOut" }, DETAIL_VIEW.BOOK.ANIMATION_DURATION * 0.5); } });
         }
         // --- Animate Loop ---
-        function animate() { animationFrameId = requestAnimationFrame(animate); if (!isDetailView && !isTransitioning) { const diff = targetGroupY - booksGroup.position.y; if (Math.abs(diff) > 0.01) { booksGroup.position.y += diff * 0.15; } } renderer.render(scene, camera); }
+        function animate() { animationFrameId = requestAnimationFrame(animate); updateVirtualWindow(); drainPaintQueue(); flushAtlases(performance.now()); if (!isDetailView && !isTransitioning) { const diff = targetGroupY - booksGroup.position.y; if (Math.abs(diff) > 0.01) { booksGroup.position.y += diff * 0.15; } } renderer.render(scene, camera); }
         function showInputForm(){ loadingMessage.style.display = 'none'; inputContainer.style.display = 'block'; }
+        /* Static export: books.json sits next to index.html, so there is no form and no scraping. */
+        async function loadStaticShelf(config) { inputContainer.style.display = 'none'; loadingMessage.style.display = 'block'; statusText.textContent = "Loading shelf..."; try { const response = await fetch(config.books_url); if (!response.ok) { throw new Error(`HTTP error ${response.status}`); } const data = await response.json(); bookData = decodeShelfPayload(data); if (!scene) { initThreeJS(); } populateScene(); } catch (error) { console.error("Static shelf error:", error); statusText.textContent = `Error: ${error.message}`; } }
 
         // --- Core Setup ---
         function setupEventHandlers() { shelfForm.addEventListener('submit', handleUrlSubmit); window.addEventListener('resize', onWindowResize); window.addEventListener('mousemove', onMouseMove); window.addEventListener('click', onClick); window.addEventListener('wheel', onDetailScroll, { passive: false }); closeDetailButton.addEventListener('click', hideDetailView); }
 
         // --- Initialization ---
-        document.addEventListener('DOMContentLoaded', () => { console.log("DOM Loaded. Initializing."); if (!scene) { initThreeJS(); } else { console.warn("Scene already exists on DOMContentLoaded?"); } setupEventHandlers(); showInputForm(); });
+        document.addEventListener('DOMContentLoaded', () => { console.log("DOM Loaded. Initializing."); if (!scene) { initThreeJS(); } else { console.warn("Scene already exists on DOMContentLoaded?"); } setupEventHandlers(); if (window.BOOKSHELF_STATIC) { loadStaticShelf(window.BOOKSHELF_STATIC); } else { showInputForm(); } });
 
     {% endraw %}</script>
 </body>
 </html>'''
 
 # --- Flask Routes ---
+# Compiled and rendered once; the page only changes when the app does.
+THREE_PAGE = app.jinja_env.from_string(THREE_TEMPLATE)
+INDEX_HTML = THREE_PAGE.render(book_config=BOOK_CONFIG, static_config=None)
+INDEX_ETAG = hashlib.sha1(INDEX_HTML.encode("utf-8")).hexdigest()
+
 @app.route("/")
 def index():
-    global progress_data; progress_data = {"total_books":0,"books_processed":0,"complete":False,"error":None}
-    return render_template_string(THREE_TEMPLATE)
+    response = Response(INDEX_HTML, mimetype="text/html")
+    response.set_etag(INDEX_ETAG)
+    response.cache_control.no_cache = True
+    return response
 
 @app.route("/get_books")
 def get_books_api():
     url = request.args.get("url", "").strip();
     if not url: return jsonify({"error": "Missing URL parameter"}), 400
-    books_data = get_books_from_shelf(url); error_message = progress_data.get("error")
-    if error_message and not books_data: status_code = 500 if "page 1" in error_message or "fetch" in error_message else 404; return jsonify({"error": error_message, "books": []}), status_code
-    elif not books_data and not error_message: return jsonify({"error": "No books found on shelf.", "books": []}), 404
-    elif error_message and books_data: return jsonify({"error": f"Warning: {error_message}", "books": books_data or [], "total_found": len(books_data or [])}), 200
-    else: return jsonify({"books": books_data, "total_found": len(books_data)})
-
-@app.route("/progress")
-def get_progress():
-    total = progress_data.get("total_books", 0); processed = progress_data.get("books_processed", 0)
-    percent = min(100, int((processed / total) * 100)) if total > 0 else 0
-    return jsonify({ "progress": percent, "books_processed": processed, "total_books": total, "complete": progress_data.get("complete", False), "error": progress_data.get("error") })
+    job_id, progress, deduplicated = jobs.submit(url)
+    if job_id is None: return jsonify({"error": "Server busy, try again shortly."}), 503, {"Retry-After": "5"}
+    return jsonify({"job_id": job_id, "deduplicated": deduplicated, "progress_url": f"/progress/{job_id}", "result_url": f"/result/{job_id}"}), 202
+
+@app.route("/import_csv", methods=["POST"])
+def import_csv_api():
+    upload = request.files.get("file")
+    if upload is None: return jsonify({"error": "Missing CSV file"}), 400
+    content = upload.read()
+    try: text = content.decode("utf-8-sig")
+    except UnicodeDecodeError: return jsonify({"error": "CSV must be UTF-8"}), 400
+    job_key = f"csv:{hashlib.sha1(content).hexdigest()}"
+    job_id, progress, deduplicated = jobs.submit(job_key, lambda key, progress: iter_books_from_csv(io.StringIO(text, newline=""), progress))
+    if job_id is None: return jsonify({"error": "Server busy, try again shortly."}), 503, {"Retry-After": "5"}
+    return jsonify({"job_id": job_id, "deduplicated": deduplicated, "progress_url": f"/progress/{job_id}", "result_url": f"/result/{job_id}"}), 202
+
+@app.route("/result/<job_id>")
+def get_result(job_id):
+    progress = jobs.get(job_id)
+    if progress is None: return jsonify({"error": "Unknown or expired job", "job_id": job_id}), 404
+    if not progress.done.wait(timeout=2): return jsonify({"job_id": job_id, "complete": False}), 202
+    books_data = progress.books; error_message = progress.get("error")
+    if error_message and not books_data: status_code = 500 if "page 1" in error_message or "fetch" in error_message else 404; return jsonify({"error": error_message, "books": [], "job_id": job_id}), status_code
+    elif not books_data and not error_message: return jsonify({"error": "No books found on shelf.", "books": [], "job_id": job_id}), 404
+    elif error_message and books_data:
+        with timed("serialize", progress.timings): return jsonify({"error": f"Warning: {error_message}", **books_payload(books_data), "total_found": len(books_data), "job_id": job_id}), 200
+    else:
+        with timed("serialize", progress.timings): return jsonify({**books_payload(books_data), "total_found": len(books_data), "job_id": job_id})
+
+@app.route("/stream/<job_id>")
+def stream_books(job_id):
+    progress = jobs.get(job_id)
+    if progress is None: return jsonify({"error": "Unknown or expired job", "job_id": job_id}), 404
+    def generate():
+        sent = 0; done = False
+        progress.watch()
+        try:
+            while not done:
+                new_books, done = progress.wait_for_books(sent, timeout=15)
+                if not new_books and not done: yield "\n"; continue # keep-alive; a dropped client fails here
+                for book in new_books:
+                    with timed("serialize", progress.timings): line = json.dumps({"type": "book", "index": sent, "book": book}) + "\n"
+                    yield line; sent += 1
+        finally:
+            progress.watch(-1)
+        data = progress.snapshot()
+        yield json.dumps({"type": "summary", "total_found": sent, "total_books": data.get("total_books"), "error": data.get("error")}) + "\n"
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "Vary": "Accept-Encoding"}
+    encoding = negotiate_encoding()
+    if encoding: headers["Content-Encoding"] = encoding
+    return Response(compress_chunks(generate(), encoding) if encoding else generate(), mimetype="application/x-ndjson", headers=headers)
+
+@app.route("/progress/<job_id>")
+def get_progress(job_id):
+    progress = jobs.get(job_id)
+    if progress is None: return jsonify({"error": "Unknown or expired job", "job_id": job_id}), 404
+    data = progress.snapshot()
+    total = data.get("total_books", 0); parsed = data.get("books_parsed", 0); processed = data.get("books_processed", 0)
+    percent = min(100, int(((parsed + processed) / (2 * total)) * 100)) if total > 0 else 0 # half for parsing rows, half for covers
+    payload = { "job_id": job_id, "progress": percent, "books_parsed": parsed, "books_processed": processed, "total_books": total, "complete": data.get("complete", False), "error": data.get("error") }
+    if request.args.get("timings"): payload["timings"] = progress.timings.snapshot()
+    return jsonify(payload)
+
+@app.route("/cover/<key>")
+def get_cover(key):
+    size = request.args.get("size", THUMB_DEFAULT_SIZE, type=int)
+    if size not in THUMB_SIZES: return jsonify({"error": f"size must be one of {list(THUMB_SIZES)}"}), 400
+    if not COVER_KEY_PATTERN.match(key) or Image is None: return jsonify({"error": "Unknown cover"}), 404
+    headers = {"Cache-Control": "public, max-age=31536000, immutable", "ETag": f'"{key}-{size}-{THUMB_FORMAT.lower()}"'}
+    if request.headers.get("If-None-Match") == headers["ETag"]: return Response(status=304, headers=headers)
+    thumb = get_cover_thumb(key, size)
+    if thumb is None: return jsonify({"error": "Unknown cover"}), 404
+    return Response(thumb, mimetype=THUMB_MIMETYPE, headers=headers)
+
+@app.route("/metrics")
+def get_metrics():
+    gauges = [("bookshelf_jobs_active", "Shelf jobs queued or running.", jobs.active_count())]
+    if get_cover_cache(): gauges.append(("bookshelf_cover_cache_entries", "Rows in the cover color cache.", get_cover_cache().stats()["entries"]))
+    return Response(metrics.render(gauges), mimetype="text/plain; version=0.0.4")
+
+
+# --- Static Export ---
+# `python bookshelf_app.py --export SHELF_URL --out DIR` writes a bundle any static host can serve:
+# index.html (the template with a static config injected), books.json, Pillow-rendered spine and back
+# images and resized covers. Image names carry a hash of the fields they are drawn from, so a re-export
+# only renders new or changed books and deletes files nothing references any more.
+EXPORT_SCALE = 2 # spine/back images are rendered at twice the client canvas size
+EXPORT_COVER_SIZE = 256
+EXPORT_BOOK_KEYS = ("review_id", "title", "author", "publisher", "page_count", "rating", "review", "spine_color", "spine_text_color")
+EXPORT_STYLE_KEYS = ("title", "author", "publisher", "page_count", "spine_color", "spine_text_color")
+EXPORT_FONTS = {"bold": ("arialbd.ttf", "Arial Bold.ttf", "DejaVuSans-Bold.ttf"), "regular": ("arial.ttf", "Arial.ttf", "DejaVuSans.ttf")}
+_export_fonts = {}
+
+def calculate_thickness(page_count):
+    try:
+        page_count = float(page_count)
+    except (TypeError, ValueError):
+        return BOOK_THICKNESS
+    if page_count <= 0:
+        return BOOK_THICKNESS
+    return max(MIN_THICKNESS, min(MAX_THICKNESS, BOOK_THICKNESS * page_count / AVG_PAGE_COUNT))
+
+def export_font(weight, size):
+    key = (weight, size)
+    if key not in _export_fonts:
+        for name in EXPORT_FONTS[weight]:
+            try:
+                _export_fonts[key] = ImageFont.truetype(name, size)
+                break
+            except OSError:
+                continue
+        else:
+            _export_fonts[key] = ImageFont.load_default(size)
+    return _export_fonts[key]
+
+def rgba(hex_color, alpha):
+    return hex_to_rgb(hex_color) + (round(255 * alpha),)
+
+# Same greedy word wrap as the template's wrapText.
+def wrap_text(draw, text, font, max_width):
+    lines, line = [], ""
+    for n, word in enumerate(str(text or "").split(" ")):
+        test_line = f"{line}{word} "
+        if draw.textlength(test_line, font=font) > max_width and n > 0:
+            lines.append(line.strip())
+            line = f"{word} "
+        else:
+            line = test_line
+    lines.append(line.strip())
+    return lines
+
+def ellipsize(draw, text, font, max_width):
+    while draw.textlength(text + "...", font=font) > max_width and text:
+        text = text[:-1]
+    return text.strip() + "..."
+
+# Pillow port of createSpineTexture. Title and publisher run along the spine; the author sits across its foot.
+def render_spine_image(book, scale=EXPORT_SCALE):
+    height = SPINE_TEXTURE_HEIGHT * scale
+    width = max(1, round(SPINE_TEXTURE_HEIGHT * calculate_thickness(book.get("page_count")) / BOOK_HEIGHT)) * scale
+    spine_color, text_color = book.get("spine_color") or "#808080", book.get("spine_text_color") or "#FFFFFF"
+    img = Image.new("RGBA", (width, height), rgba(spine_color, 1))
+    for opacity, rgb, mirror in ((SPINE_SHADOW_OPACITY, (0, 0, 0), False), (SPINE_HIGHLIGHT_OPACITY, (255, 255, 255), True)):
+        edges = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(edges)
+        edge = SPINE_EDGE_WIDTH * scale
+        for x in range(min(edge, width)):
+            column = width - 1 - x if mirror else x
+            draw.line([(column, 0), (column, height)], fill=rgb + (round(255 * opacity * (1 - x / edge)),))
+        img.alpha_composite(edges)
+
+    # Drawn unrotated (draw width = spine height), then turned 90 degrees clockwise like the canvas.
+    draw_width, draw_height, padding = height, width, SPINE_PADDING_PX * scale
+    layer = Image.new("RGBA", (draw_width, draw_height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(layer)
+    if book.get("publisher"):
+        font = export_font("regular", SPINE_PUBLISHER_SIZE_PX * scale)
+        publisher = book["publisher"]
+        if draw.textlength(publisher, font=font) > draw_width - padding * 2:
+            publisher = publisher[:int((draw_width - padding * 2) / (SPINE_PUBLISHER_SIZE_PX * scale * 0.6))] + "..."
+        draw.text((padding, padding), publisher, font=font, fill=rgba(text_color, SPINE_TEXT_OPACITY))
+    font = export_font("bold", SPINE_TITLE_SIZE_PX * scale)
+    line_height = SPINE_TITLE_SIZE_PX * scale * SPINE_LINE_SPACING
+    max_title_width = draw_width * 0.75
+    lines = wrap_text(draw, book.get("title"), font, max_title_width)
+    if len(lines) > 1 and 2 * line_height > draw_height - padding * 2:
+        lines = [lines[0] if draw.textlength(lines[0], font=font) <= max_title_width else ellipsize(draw, lines[0], font, max_title_width)]
+    elif len(lines) > SPINE_TITLE_MAX_LINES:
+        lines = lines[:SPINE_TITLE_MAX_LINES - 1] + [ellipsize(draw, lines[SPINE_TITLE_MAX_LINES - 1], font, max_title_width)]
+    y = draw_height / 2 - len(lines) * line_height / 2 + line_height / 2
+    for line in lines:
+        draw.text((draw_width / 2, y), line, font=font, fill=rgba(text_color, 1), anchor="mm")
+        y += line_height
+    img.alpha_composite(layer.rotate(-90, expand=True))
+
+    draw = ImageDraw.Draw(img)
+    font = export_font("regular", SPINE_AUTHOR_SIZE_PX * scale)
+    line_height = SPINE_AUTHOR_SIZE_PX * scale * SPINE_LINE_SPACING
+    max_author_width = width - SPINE_AUTHOR_PADDING_PX * scale * 2
+    lines = wrap_text(draw, book.get("author"), font, max_author_width)
+    if len(lines) > SPINE_AUTHOR_MAX_LINES:
+        lines = lines[:SPINE_AUTHOR_MAX_LINES - 1] + [ellipsize(draw, lines[SPINE_AUTHOR_MAX_LINES - 1], font, max_author_width)]
+    y = height - padding + (len(lines) - 1) * line_height / 2
+    for line in reversed(lines):
+        draw.text((width / 2, y), line, font=font, fill=rgba(text_color, SPINE_TEXT_OPACITY), anchor="md")
+        y -= line_height
+    return img.convert("RGB")
+
+# Pillow port of createBackTexture; the scribble is seeded per book so re-exports are stable.
+def render_back_image(book, scale=EXPORT_SCALE):
+    width = BACK_TEXTURE_WIDTH * scale
+    height = round(BACK_TEXTURE_WIDTH * BOOK_HEIGHT / BOOK_WIDTH) * scale
+    img = Image.new("RGBA", (width, height), rgba(book.get("spine_color") or "#DDDDDD", 1))
+    lines = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(lines)
+    rng = random.Random(str(book.get("review_id") or book.get("book_id") or book.get("title")))
+    padding, line_height = width * 0.1, BACK_SCRIBBLE_LINE_HEIGHT * scale
+    y = padding
+    while y < height - padding:
+        start_x = padding + rng.random() * width * 0.05
+        end_x = width - padding - rng.random() * width * 0.2
+        draw.line([(start_x, y), (end_x, y)], fill=rgba(book.get("spine_text_color") or "#000000", BACK_SCRIBBLE_OPACITY), width=max(1, round(0.7 * scale)))
+        y += line_height * (0.8 + rng.random() * 0.4)
+        if rng.random() < 0.1:
+            y += line_height * 1.5
+    img.alpha_composite(lines.filter(ImageFilter.GaussianBlur(0.5 * scale)))
+    return img.convert("RGB")
+
+def export_static_shelf(shelf_url, out_dir):
+    if Image is None:
+        print("ERROR: Pillow is required for --export.")
+        return 1
+    books = get_books_from_csv(shelf_url) if os.path.isfile(shelf_url) else get_books_from_shelf(shelf_url)
+    if not books:
+        print("ERROR: No books found; nothing exported.")
+        return 1
+    for folder in ("spines", "backs", "covers"):
+        os.makedirs(os.path.join(out_dir, folder), exist_ok=True)
+
+    exported, referenced, rendered = [], set(), 0
+    for i, book in enumerate(books):
+        entry = {key: book.get(key) for key in EXPORT_BOOK_KEYS}
+        style = hashlib.sha1(json.dumps([book.get(key) for key in EXPORT_STYLE_KEYS]).encode("utf-8")).hexdigest()[:10]
+        name = f"{re.sub(r'[^A-Za-z0-9_-]', '', str(book.get('review_id') or book.get('book_id') or '')) or f'book{i}'}-{style}"
+        for folder, field, render in (("spines", "spine_url", render_spine_image), ("backs", "back_url", render_back_image)):
+            relative = f"{folder}/{name}.png"
+            path = os.path.join(out_dir, relative)
+            if not os.path.exists(path):
+                render(book).save(path, optimize=True)
+                rendered += 1
+            entry[field] = relative
+            referenced.add(relative)
+        if book.get("image"):
+            key = cover_key(book["image"])
+            relative = f"covers/{key}.{'webp' if THUMB_FORMAT == 'WEBP' else 'jpg'}"
+            path = os.path.join(out_dir, relative)
+            if not os.path.exists(path):
+                register_cover_url(book)
+                thumb = get_cover_thumb(key, EXPORT_COVER_SIZE)
+                if thumb is not None:
+                    with open(path, "wb") as f:
+                        f.write(thumb)
+            if os.path.exists(path):
+                entry["cover_url"] = relative
+                referenced.add(relative)
+        exported.append(entry)
+
+    with open(os.path.join(out_dir, "books.json"), "w", encoding="utf-8") as f:
+        json.dump({"shelf": encode_book_columns(exported), "shelf_url": shelf_url, "exported_at": time.time()}, f, separators=(",", ":"))
+    html = THREE_PAGE.render(book_config=BOOK_CONFIG, static_config={"books_url": "books.json"})
+    with open(os.path.join(out_dir, "index.html"), "w", encoding="utf-8") as f:
+        f.write(html)
+    removed = 0
+    for folder in ("spines", "backs", "covers"):
+        for filename in os.listdir(os.path.join(out_dir, folder)):
+            if f"{folder}/{filename}" not in referenced:
+                os.remove(os.path.join(out_dir, folder, filename))
+                removed += 1
+    print(f"Exported {len(exported)} books to {out_dir}: {rendered} images rendered, {removed} stale files removed.")
+    return 0
 
 
 # --- Main Execution ---
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="3D bookshelf server.")
+    parser.add_argument("--check-parser", nargs="+", metavar="HTML", help="diff the fast shelf-row parser against the reference parser on saved shelf pages, then exit")
+    parser.add_argument("--check-fidelity", nargs="+", metavar="COVER", help="compare downscaled vs full-resolution color analysis for cover URLs or files, then exit")
+    parser.add_argument("--fidelity-tolerance", type=int, default=2, metavar="N", help="largest per-channel drift --check-fidelity accepts (default: 2)")
+    parser.add_argument("--export", metavar="SHELF_URL", help="write a static bundle of this shelf URL or Goodreads library export CSV (see --out), then exit")
+    parser.add_argument("--out", default="bookshelf_export", help="output directory for --export (default: bookshelf_export)")
+    args = parser.parse_args()
     if Image is None: print("\nERROR: Pillow library is required. Run 'pip install Pillow'\n")
-    if colorgram is None: print("\nERROR: colorgram.py library is required. Run 'pip install colorgram.py'\n")
+    if colorgram is None and np is None: print("\nERROR: NumPy or colorgram.py is required. Run 'pip install numpy'\n")
+    if args.check_parser:
+        mismatches = check_shelf_parser(args.check_parser)
+        for path, index, fast, reference in mismatches:
+            print(f"MISMATCH {path} row {index}:\n  fast:      {fast}\n  reference: {reference}")
+        print(f"{len(mismatches)} mismatching rows in {len(args.check_parser)} file(s).")
+        raise SystemExit(1 if mismatches else 0)
+    if args.check_fidelity:
+        report = check_cover_fidelity(args.check_fidelity, tolerance=args.fidelity_tolerance)
+        for entry in report:
+            print(f"{'OK ' if entry['ok'] else 'BAD'} spine {entry['full'][0]} -> {entry['reduced'][0]} (d={entry['spine_delta']}), text {entry['full'][1]} -> {entry['reduced'][1]} (d={entry['text_delta']})  {entry['source']}")
+        raise SystemExit(0 if all(entry["ok"] for entry in report) else 1)
+    if args.export:
+        raise SystemExit(export_static_shelf(args.export, args.out))
     app.run(debug=True, port=5000)
\ No newline at end of file
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# Keep the app's SQLite caches and thumbnail directory out of the repo while testing.
+os.environ.setdefault("COVER_CACHE_PATH", "")
+os.environ.setdefault("SHELF_CACHE_PATH", "")
+os.environ.setdefault("THUMB_CACHE_DIR", tempfile.mkdtemp(prefix="bookshelf-thumbs-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,34 @@
+import io
+
+import pytest
+
+import bookshelf_app
+
+pytestmark = pytest.mark.skipif(bookshelf_app.Image is None, reason="Pillow not installed")
+
+
+def cover_bytes(mode, size=(600, 900)):
+    Image = bookshelf_app.Image
+    img = Image.new("RGB", size, (200, 30, 40))
+    img.paste((250, 240, 230), (size[0] // 3, 0, size[0], size[1]))
+    if mode == "P":
+        img = img.quantize(16)
+    elif mode == "1":
+        img = img.convert("1", dither=Image.Dither.NONE)
+    elif mode == "I;16":
+        img = img.convert("L").convert("I").point(lambda v: v * 256).convert("I;16")
+    elif mode != "RGB":
+        img = img.convert(mode)
+    out = io.BytesIO()
+    img.save(out, "PNG")
+    return out.getvalue()
+
+
+@pytest.mark.parametrize("mode", ["RGB", "RGBA", "L", "LA", "P", "1", "I;16"])
+def test_downscaled_analysis_handles_every_mode(mode):
+    content = cover_bytes(mode)
+    assert bookshelf_app.Image.open(io.BytesIO(content)).mode == mode
+    reduced = bookshelf_app.analyze_cover_bytes(content, max_side=256)
+    full = bookshelf_app.analyze_cover_bytes(content, max_side=0)
+    assert reduced[2] is not None
+    assert reduced[:2] == full[:2]
@@ -0,0 +1,50 @@
+import io
+
+import pytest
+
+import bookshelf_app
+
+pytestmark = pytest.mark.skipif(bookshelf_app.Image is None, reason="Pillow not installed")
+
+
+def cover_jpeg(n):
+    img = bookshelf_app.Image.new("RGB", (300, 450), (n * 40 % 256, 90, 160))
+    out = io.BytesIO()
+    img.save(out, "JPEG")
+    return out.getvalue()
+
+
+@pytest.fixture
+def thumb_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(bookshelf_app, "THUMB_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(bookshelf_app, "_cover_sources", bookshelf_app.OrderedDict())
+    monkeypatch.setattr(bookshelf_app, "_cover_sources_bytes", 0)
+    return tmp_path
+
+
+def test_analyzed_covers_are_never_fetched_again(thumb_dir, monkeypatch):
+    covers = {f"https://i.gr-assets.com/images/books/{n}.jpg": cover_jpeg(n) for n in range(6)}
+    # Room for one cover: the rest are evicted from memory before their /cover request.
+    monkeypatch.setattr(bookshelf_app, "COVER_SOURCE_MEMORY_BYTES", max(map(len, covers.values())))
+    for url, content in covers.items():
+        bookshelf_app.register_cover_url({"image": url})
+        bookshelf_app.remember_cover_source(url, content)
+    bookshelf_app._cover_source_writes.join()
+
+    fetched = []
+    monkeypatch.setattr(bookshelf_app, "fetch_cover_bytes", lambda url: fetched.append(url) or covers[url])
+    for url in covers:
+        for size in (128, 256):
+            thumb = bookshelf_app.get_cover_thumb(bookshelf_app.cover_key(url), size)
+            assert bookshelf_app.Image.open(io.BytesIO(thumb)).width == size
+    assert fetched == []
+
+
+def test_unknown_source_is_fetched_once(thumb_dir, monkeypatch):
+    url = "https://i.gr-assets.com/images/books/cached-colors.jpg"
+    bookshelf_app.register_cover_url({"image": url})
+    fetched = []
+    monkeypatch.setattr(bookshelf_app, "fetch_cover_bytes", lambda u: fetched.append(u) or cover_jpeg(1))
+    for size in (64, 128, 256):
+        assert bookshelf_app.get_cover_thumb(bookshelf_app.cover_key(url), size) is not None
+    assert fetched == [url]
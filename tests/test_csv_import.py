@@ -0,0 +1,35 @@
+import pytest
+
+import bookshelf_app
+
+
+@pytest.mark.parametrize("row, expected", [
+    ({"ISBN13": '="9780316769488"', "ISBN": '=""'}, "9780316769488"),
+    ({"ISBN13": '=""', "ISBN": '="0316769487"'}, "0316769487"),
+    ({"ISBN13": '=""', "ISBN": '="080442957X"'}, "080442957X"),
+    ({"ISBN13": '="9780316769488"', "ISBN": '="0316769487"'}, "9780316769488"),
+    ({"ISBN13": '=""', "ISBN": '=""'}, None),
+    ({}, None),
+])
+def test_csv_isbn_reads_both_columns(row, expected):
+    assert bookshelf_app.csv_isbn(row) == expected
+
+
+def test_book_from_csv_row_uses_book_id_and_first_last_author():
+    book = bookshelf_app.book_from_csv_row({
+        "Book Id": "5107", "Title": "The Catcher in the Rye", "Author": "J.D. Salinger",
+        "Author l-f": "Salinger, J.D.", "ISBN": '="0316769487"', "ISBN13": '="9780316769488"',
+        "My Rating": "4", "Publisher": "Little, Brown", "Number of Pages": "277",
+    })
+    assert book["review_id"] == ""
+    assert book["book_id"] == "5107"
+    assert book["book_url"] == "https://www.goodreads.com/book/show/5107"
+    assert book["author"] == "J.D. Salinger"
+    assert book["isbn"] == "9780316769488"
+    assert book["page_count"] == 277
+    assert book["rating"] == "really liked it"
+
+
+def test_book_from_csv_row_falls_back_to_author_column():
+    book = bookshelf_app.book_from_csv_row({"Book Id": "1", "Title": "Plato", "Author": "Plato"})
+    assert book["author"] == "Plato"
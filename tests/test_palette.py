@@ -0,0 +1,48 @@
+import random
+
+import pytest
+
+import bookshelf_app
+
+np = bookshelf_app.np
+colorgram = bookshelf_app.colorgram
+pytestmark = pytest.mark.skipif(np is None or colorgram is None or bookshelf_app.Image is None,
+                                reason="NumPy, colorgram.py and Pillow are all needed for the comparison")
+
+
+def generated_cover(seed, size=(90, 135)):
+    rnd = random.Random(seed)
+    img = bookshelf_app.Image.new("RGB", size, tuple(rnd.randrange(256) for _ in range(3)))
+    draw = bookshelf_app.ImageDraw.Draw(img)
+    for _ in range(rnd.randrange(3, 15)):
+        x, y = rnd.randrange(size[0]), rnd.randrange(size[1])
+        box = (x, y, x + rnd.randrange(5, size[0]), y + rnd.randrange(5, size[1]))
+        draw.rectangle(box, fill=tuple(rnd.randrange(256) for _ in range(3)))
+    if seed % 2:
+        noise = np.random.default_rng(seed).integers(-40, 41, (size[1], size[0], 3))
+        img = bookshelf_app.Image.fromarray(np.clip(np.asarray(img, dtype=np.int64) + noise, 0, 255).astype(np.uint8))
+    return img
+
+
+def reference_text_color(palette, spine_bg_hex, min_contrast, monkeypatch):
+    with monkeypatch.context() as patch:
+        patch.setattr(bookshelf_app, "np", None)
+        return bookshelf_app.pick_text_color(palette, spine_bg_hex, min_contrast)
+
+
+@pytest.mark.parametrize("seed", range(12))
+def test_numpy_palette_matches_colorgram(seed):
+    img = generated_cover(seed)
+    expected = [(color.rgb.r, color.rgb.g, color.rgb.b) for color in colorgram.extract(img, 6)]
+    assert bookshelf_app.extract_palette_array(np.asarray(img), 6) == expected
+
+
+# 1.5 lets most covers pick a palette color instead of falling back to black/white.
+@pytest.mark.parametrize("min_contrast", [4.5, 1.5])
+def test_vectorized_text_colors_match_scalar_contrast(min_contrast, monkeypatch):
+    rnd = random.Random(7)
+    palettes = [[(c.rgb.r, c.rgb.g, c.rgb.b) for c in colorgram.extract(generated_cover(seed), 6)] for seed in range(12)]
+    palettes += [None, [], [(128, 128, 128)]]
+    backgrounds = ["#{:02x}{:02x}{:02x}".format(*(rnd.randrange(256) for _ in range(3))) for _ in palettes]
+    expected = [reference_text_color(p, bg, min_contrast, monkeypatch) for p, bg in zip(palettes, backgrounds)]
+    assert bookshelf_app.pick_text_colors(palettes, backgrounds, min_contrast) == expected
@@ -0,0 +1,118 @@
+import pytest
+
+import bookshelf_app
+
+PER_PAGE = 30
+URL = "https://www.goodreads.com/review/list/1?shelf=read&sort=date_updated"
+
+
+def row_html(review_id, title):
+    return f'''<tr id="review_{review_id}" class="bookalike review">
+  <td class="field title"><label>title</label><div class="value"><a href="/book/show/{review_id}">{title}</a></div></td>
+  <td class="field author"><label>author</label><div class="value"><a href="/author/show/1">Author, Pat</a></div></td>
+  <td class="field num_pages"><label>num pages</label><div class="value"><nobr>300<span class="greyText">pp</span></nobr></div></td>
+</tr>'''
+
+
+def page_html(rows, page, per_page=PER_PAGE):
+    start = (page - 1) * per_page
+    page_rows = rows[start:start + per_page]
+    return f'''<html><body><div id="shelfHeader"><span class="greyText">(showing {start + 1}-{start + len(page_rows)} of {len(rows)} books)</span></div>
+<table id="books"><tbody id="booksBody">{"".join(row_html(*row) for row in page_rows)}</tbody></table></body></html>'''
+
+
+def shelf(n):
+    return [(1000 + i, f"Book {i}") for i in range(n)]
+
+
+@pytest.fixture
+def goodreads(monkeypatch):
+    state = {"rows": [], "fetched": []}
+
+    def fetch_shelf_page(url, page, timeout=10, timings=None):
+        state["fetched"].append(page)
+        return page_html(state["rows"], page)
+
+    monkeypatch.setattr(bookshelf_app, "fetch_shelf_page", fetch_shelf_page)
+    return state
+
+
+@pytest.fixture
+def shelf_cache(tmp_path, monkeypatch):
+    cache = bookshelf_app.ShelfCache(str(tmp_path / "shelves.sqlite3"), 10)
+    monkeypatch.setattr(bookshelf_app, "get_shelf_cache", lambda: cache)
+    monkeypatch.setattr(bookshelf_app, "SHELF_CACHE_FRESH_SECONDS", 0)
+    return cache
+
+
+def load(url=URL):
+    return [(int(book["review_id"]), book["title"]) for book in bookshelf_app.get_books_from_shelf(url)]
+
+
+def refresh(goodreads, cached_rows):
+    cached_books = bookshelf_app.parse_shelf_rows(page_html(cached_rows, 1, len(cached_rows)))
+    goodreads["fetched"] = []
+    first_page = page_html(goodreads["rows"], 1)
+    result = bookshelf_app.refresh_shelf_books(URL, cached_books, first_page, len(goodreads["rows"]), bookshelf_app.JobProgress())
+    if result is None:
+        return None
+    books, changed = result
+    return [(int(book["review_id"]), book["title"]) for book in books], [book["title"] for book in changed]
+
+
+def test_refresh_picks_up_a_new_row(goodreads):
+    old = shelf(70)
+    goodreads["rows"] = [(2000, "New Book")] + old
+    books, changed = refresh(goodreads, old)
+    assert books == goodreads["rows"]
+    assert changed == ["New Book"]
+    assert goodreads["fetched"] == [2]
+
+
+def test_refresh_picks_up_an_edit_deep_in_the_shelf(goodreads):
+    old = shelf(70)
+    # date_updated moves the edited row to the top.
+    goodreads["rows"] = [(old[60][0], "Book 60, Renamed")] + old[:60] + old[61:]
+    books, changed = refresh(goodreads, old)
+    assert books == goodreads["rows"]
+    assert changed == ["Book 60, Renamed"]
+
+
+def test_refresh_with_a_remove_and_an_add_is_never_stale(goodreads):
+    old = shelf(70)
+    goodreads["rows"] = [(2000, "New Book")] + old[:60] + old[61:]
+    assert refresh(goodreads, old) is None
+
+
+def test_refresh_drops_a_removed_row_near_the_top(goodreads):
+    old = shelf(70)
+    goodreads["rows"] = old[:5] + old[6:]
+    books, changed = refresh(goodreads, old)
+    assert books == goodreads["rows"]
+    assert changed == []
+
+
+def test_date_added_sort_always_scrapes_in_full(goodreads, shelf_cache):
+    url = URL.replace("date_updated", "date_added")
+    goodreads["rows"] = shelf(70)
+    load(url)
+    goodreads["rows"][60] = (goodreads["rows"][60][0], "Book 60, Renamed")
+    goodreads["fetched"] = []
+    assert load(url) == goodreads["rows"]
+    assert sorted(goodreads["fetched"]) == [1, 2, 3]
+
+
+def test_full_scrape_once_the_cache_is_too_old(goodreads, shelf_cache, monkeypatch):
+    goodreads["rows"] = shelf(70)
+    load()
+    scraped = shelf_cache.get(URL)["scraped"]
+    goodreads["fetched"] = []
+    assert load() == goodreads["rows"]
+    assert goodreads["fetched"] == [1]  # unchanged first page ends the refresh
+    assert shelf_cache.get(URL)["scraped"] == scraped  # a refresh doesn't restart the clock
+
+    monkeypatch.setattr(bookshelf_app, "SHELF_CACHE_MAX_AGE", 0)
+    goodreads["rows"][60] = (goodreads["rows"][60][0], "Book 60, New Cover")
+    goodreads["fetched"] = []
+    assert load() == goodreads["rows"]
+    assert sorted(goodreads["fetched"]) == [1, 2, 3]
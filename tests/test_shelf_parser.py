@@ -0,0 +1,62 @@
+import glob
+import os
+
+import pytest
+
+import bookshelf_app
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+SHELF_PAGES = sorted(glob.glob(os.path.join(FIXTURE_DIR, "shelf_*.html")))
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURE_DIR, name), encoding="utf-8") as f:
+        return f.read()
+
+
+@pytest.fixture(params=["lxml", "html.parser"])
+def parser_backend(request, monkeypatch):
+    if request.param == "lxml" and bookshelf_app.lxml_html is None:
+        pytest.skip("lxml not installed")
+    if request.param == "html.parser":
+        monkeypatch.setattr(bookshelf_app, "lxml_html", None)
+    return request.param
+
+
+@pytest.mark.parametrize("path", SHELF_PAGES, ids=os.path.basename)
+def test_fast_parser_matches_reference(path, parser_backend):
+    assert bookshelf_app.check_shelf_parser([path]) == []
+
+
+def test_basic_page(parser_backend):
+    html = read_fixture("shelf_basic.html")
+    books = bookshelf_app.parse_shelf_rows(html)
+    assert bookshelf_app.parse_total_books(html) == 1203
+    assert [book["review_id"] for book in books] == ["5001", "5002", "5003"]
+    dune, untitled, left_hand = books
+    assert dune["author"] == "Frank Herbert"
+    assert dune["image"].endswith("/44767458.jpg")
+    assert dune["page_count"] == 658 and dune["rating"] == "it was amazing"
+    assert untitled["page_count"] == bookshelf_app.DEFAULT_PAGE_COUNT and untitled["rating"] is None
+    assert left_hand["page_count"] == 1304 and left_hand["publisher"] == "Ace Books"
+
+
+def test_repeated_field_cells_are_all_searched(parser_backend):
+    (book,) = bookshelf_app.parse_shelf_rows(read_fixture("shelf_duplicate_class.html"))
+    assert book["title"] == "Piranesi"
+    assert book["publisher"] == "Bloomsbury"
+    assert book["page_count"] == 272
+    assert book["rating"] == "liked it"
+    assert book["image"].endswith("/9.jpg")
+
+
+def test_comments_in_review_text(parser_backend):
+    (book,) = bookshelf_app.parse_shelf_rows(read_fixture("shelf_comments.html"))
+    assert book["title"] == "Gideon the Ninth"
+    assert book["review"] == bookshelf_app.parse_shelf_rows_reference(read_fixture("shelf_comments.html"))[0]["review"]
+
+
+@pytest.mark.parametrize("html", ["", "   \n", "<!-- truncated -->"])
+def test_blank_page_has_no_rows(html, parser_backend):
+    assert bookshelf_app.parse_shelf_rows(html) == []
+    assert bookshelf_app.parse_total_books(html) == 0
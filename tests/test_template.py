@@ -0,0 +1,11 @@
+import json
+import re
+
+import bookshelf_app
+
+
+def test_page_reads_book_constants_from_python():
+    injected = re.search(r'window\.BOOKSHELF_BOOK = (\{.*?\});', bookshelf_app.INDEX_HTML).group(1)
+    assert json.loads(injected) == bookshelf_app.BOOK_CONFIG
+    for name in bookshelf_app.BOOK_CONFIG:
+        assert f"const {name} =" not in bookshelf_app.INDEX_HTML